@@ -1,18 +1,42 @@
 import typing
 
-from sklearn.decomposition import PCA as skPCA
 import numpy as np
-import scipy.stats as stats
-import statsmodels.api as sm
 import pandas as pd
-import matplotlib.pyplot as plt
-import seaborn as sns
-from typing import Optional, Union, Collection
+from typing import Optional, Union, Collection, Literal
+
+from bioscreen.utils import bh_fdr
+from bioscreen.classes.base import logger
 
 
 class CountPCA:
+    """PCA of samples in a count table (genes × samples).
+
+    Args:
+        table: counts, probably normalised & log transformed, genes × samples.
+        sample_details: per sample metadata, index matching table columns.
+        n_components: number of PCs kept, default all.
+        method:
+            'auto' - sklearn.decomposition.PCA chooses the solver (default).
+            'full' - exact SVD.
+            'randomized' - randomized SVD, much faster for large tables when
+                n_components is small.
+            'incremental' - IncrementalPCA fed batch_size samples at a time,
+                limiting memory use.
+        top_genes: if given, only this many genes, with highest variance
+            across samples, are used.
+        dtype: np.float32 halves memory use and is faster, at the cost of
+            precision.
+        batch_size: samples per batch for method='incremental'.
+        pcaKW: passed to the sklearn PCA class, e.g. random_state.
+    """
     def __init__(self, table: pd.DataFrame,
-                 sample_details:Optional[pd.DataFrame]=None, **pcaKW):
+                 sample_details:Optional[pd.DataFrame]=None,
+                 n_components:Optional[int]=None,
+                 method:Literal['auto', 'full', 'randomized', 'incremental']='auto',
+                 top_genes:Optional[int]=None,
+                 dtype=np.float64,
+                 batch_size:int=500,
+                 **pcaKW):
 
 
         # check that the tables are compatable, and in same order
@@ -21,9 +45,22 @@ class CountPCA:
             sample_details = sample_details.reindex(index=table.columns)
         self.sample_details = sample_details
 
-        pca = skPCA(**pcaKW)
+        if top_genes is not None and top_genes < table.shape[0]:
+            variance = table.to_numpy(dtype=dtype).var(axis=1)
+            # keep the table order of selected genes
+            keep = np.sort(np.argsort(-variance, kind='stable')[:top_genes])
+            table = table.iloc[keep]
+
+        if method == 'incremental':
+            scores, pca = self._fit_incremental(table, n_components, dtype, batch_size, pcaKW)
+        elif method in ('auto', 'full', 'randomized'):
+            from sklearn.decomposition import PCA as skPCA
+            # an explicit svd_solver in pcaKW takes precedence
+            pca = skPCA(n_components=n_components, **({'svd_solver':method} | pcaKW))
+            scores = pca.fit_transform(table.to_numpy(dtype=dtype).T)
+        else:
+            raise ValueError(f"Unknown method {method}")
         self.pca = pca
-        scores = pca.fit_transform(table.T)
 
         pc_idx = [f"PC{i}" for i in range(1, scores.shape[1]+1)]
 
@@ -44,6 +81,114 @@ class CountPCA:
         self.samples = table.columns
         self.genes = table.index
 
+        # fitted model, used to project new samples
+        self.center = pca.mean_
+        self.explained_variance = pca.explained_variance_
+        self.whiten = bool(getattr(pca, 'whiten', False))
+
+        self._factor_cache = None
+        self._anova_cache = None
+
+    @staticmethod
+    def _fit_incremental(table:pd.DataFrame, n_components, dtype, batch_size, pcaKW):
+        """Fit IncrementalPCA in batches of samples, only one batch is
+        converted to an array at a time."""
+        from sklearn.decomposition import IncrementalPCA
+        n_samples = table.shape[1]
+        if n_components is None:
+            n_components = min(table.shape)
+        batch_size = max(batch_size, n_components)
+        # every batch needs at least n_components samples, so a short final
+        #   batch is merged into the one before
+        bounds = list(range(0, n_samples, batch_size)) + [n_samples]
+        if len(bounds) > 2 and bounds[-1] - bounds[-2] < n_components:
+            del bounds[-2]
+        batches = list(zip(bounds[:-1], bounds[1:]))
+
+        pca = IncrementalPCA(n_components=n_components, **pcaKW)
+        for start, stop in batches:
+            pca.partial_fit(table.iloc[:, start:stop].to_numpy(dtype=dtype).T)
+        scores = np.concatenate([
+            pca.transform(table.iloc[:, start:stop].to_numpy(dtype=dtype).T)
+            for start, stop in batches
+        ])
+        return scores, pca
+
+    def transform(self, table:pd.DataFrame, batch_size=2000) -> pd.DataFrame:
+        """Scores of new samples in the fitted PC space, without refitting.
+
+        Args:
+            table: genes × samples, processed the same way as the fitted
+                table. Rows are matched to self.genes, extra genes are
+                ignored and missing genes are set to the fitted mean (i.e.
+                they don't contribute to scores).
+            batch_size: samples projected at a time.
+
+        Returns:
+            samples × PCs, like self.scores.
+        """
+        components = self.loadings.to_numpy()
+        dtype = components.dtype
+        missing = ~self.genes.isin(table.index)
+        if missing.any():
+            logger.warning(f"{missing.sum()} of {len(self.genes)} fitted genes missing from table, "
+                           "they're set to the fitted mean.")
+        rows = table.index.get_indexer(self.genes)
+        center = self.center.astype(dtype)
+
+        scores = np.empty((table.shape[1], components.shape[0]), dtype=dtype)
+        for start in range(0, table.shape[1], batch_size):
+            batch = table.iloc[:, start:start + batch_size].to_numpy(dtype=dtype)
+            X = np.where(missing[:, None], center[:, None], batch[rows])
+            scores[start:start + batch_size] = (X.T - center) @ components.T
+        if self.whiten:
+            scores /= np.sqrt(self.explained_variance)
+        return pd.DataFrame(scores, index=table.columns, columns=self.loadings.index)
+
+    def save(self, fn):
+        """Save the fitted model, scores and sample_details to a
+        compressed .npz file, see `CountPCA.load`."""
+        details = '' if self.sample_details is None else self.sample_details.to_json(orient='split')
+        np.savez_compressed(
+            fn,
+            components=self.loadings.to_numpy(),
+            center=self.center,
+            explained_variance=self.explained_variance,
+            explained_variance_perc=self.explained_variance_perc.to_numpy(),
+            whiten=self.whiten,
+            scores=self.scores.to_numpy(),
+            genes=self.genes.astype(str).to_numpy(dtype=str),
+            samples=self.samples.astype(str).to_numpy(dtype=str),
+            sample_details=np.array(details),
+        )
+
+    @classmethod
+    def load(cls, fn) -> 'CountPCA':
+        """Load a model saved with `CountPCA.save`. Gene & sample names
+        are loaded as strings. The sklearn object, CountPCA.pca, is not
+        saved and is None."""
+        with np.load(fn) as data:
+            new = cls.__new__(cls)
+            pc_idx = [f"PC{i}" for i in range(1, data['components'].shape[0] + 1)]
+            new.pca = None
+            new.genes = pd.Index(data['genes'])
+            new.samples = pd.Index(data['samples'])
+            new.loadings = pd.DataFrame(data['components'], columns=new.genes, index=pc_idx)
+            new.scores = pd.DataFrame(data['scores'], columns=pc_idx, index=new.samples)
+            new.explained_variance_perc = pd.Series(data['explained_variance_perc'], index=pc_idx)
+            new.center = data['center']
+            new.explained_variance = data['explained_variance']
+            new.whiten = bool(data['whiten'])
+            details = str(data['sample_details'])
+        new.sample_details = None
+        if details:
+            import io
+            new.sample_details = pd.read_json(io.StringIO(details), orient='split', dtype=False)
+            new.sample_details.index = new.sample_details.index.astype(str)
+        new._factor_cache = None
+        new._anova_cache = None
+        return new
+
     def scatter_plot(self, pc_x='PC1', pc_y='PC2', labels: Union[bool, Collection[str]] = False,
                      **scatterplot_kwargs):
         """Plot PCs.
@@ -56,6 +201,8 @@ class CountPCA:
 
             scatterplot_kwargs are passed to sns.scatterplot. Use hue
             and style = pd.Series to show sample properties"""
+        import matplotlib.pyplot as plt
+        import seaborn as sns
 
         if type(pc_x) is int:
             pc_x = f"PC{pc_x}"
@@ -98,38 +245,67 @@ class CountPCA:
                     size=8,
                 )
 
-    def anova(self, max_pc=np.inf) -> pd.DataFrame:
-        """Table of anova statistics for factor associations with PCs.
-
-        return: DF with level 0 columns of F, p & FDR and level 1
-        giving the PC results."""
-        table = {'F': {}, 'p': {}}
-
-        for pci in range(self.scores.shape[1]):
-            pc = f"PC{pci + 1}"
-            if pci > max_pc:
-                break
-
-            table['p'][pc] = p_res = {}
-            table['F'][pc] = f_res = {}
+    def _factor_codes(self) -> dict[str, tuple[np.ndarray, int]]:
+        """{factor: (integer codes of each sample, n levels)} for each
+        sample_details column, -1 for missing values. Cached."""
+        if self._factor_cache is None:
+            self._factor_cache = {}
             for factor in self.sample_details.columns:
-                factor_groups = self.sample_details.groupby(factor).groups
-                values = [self.scores.loc[f, pc] for f in factor_groups.values()]
-
-                # if there's only one level to the factor
-                if len(values) < 2:
+                codes, levels = pd.factorize(self.sample_details[factor])
+                self._factor_cache[factor] = (codes, len(levels))
+        return self._factor_cache
+
+    def _anova_all_pcs(self) -> tuple[pd.DataFrame, pd.DataFrame]:
+        """One-way ANOVA F & p (factors × PCs) of every factor with more
+        than one level, against every PC. Cached."""
+        if self._anova_cache is None:
+            from scipy import stats
+            scores = self.scores.to_numpy(dtype=np.float64)
+            F, p, factors = [], [], []
+            for factor, (codes, n_levels) in self._factor_codes().items():
+                # samples with missing values are dropped, as groupby
+                valid = codes >= 0
+                codes, values = codes[valid], scores[valid]
+                counts = np.bincount(codes, minlength=n_levels)
+                if (counts > 0).sum() < 2:
                     continue
+                # per group sums of every PC at once, (levels × PCs)
+                sums = np.zeros((n_levels, scores.shape[1]))
+                np.add.at(sums, codes, values)
+                with np.errstate(invalid='ignore', divide='ignore'):
+                    means = sums / counts[:, None]
+                    ss_within = ((values - means[codes]) ** 2).sum(axis=0)
+                    observed = counts > 0
+                    ss_between = (counts[observed, None]
+                                  * (means[observed] - values.mean(axis=0)) ** 2).sum(axis=0)
+                    df_between = observed.sum() - 1
+                    df_within = len(codes) - df_between - 1
+                    f = (ss_between / df_between) / (ss_within / df_within)
+                F.append(f)
+                p.append(stats.f.sf(f, df_between, df_within))
+                factors.append(factor)
+            shape = (len(factors), scores.shape[1])
+            self._anova_cache = tuple(
+                pd.DataFrame(np.reshape(x, shape), index=factors, columns=self.scores.columns)
+                for x in (F, p)
+            )
+        return self._anova_cache
 
+    def anova(self, max_pc=np.inf) -> pd.DataFrame:
+        """Table of anova statistics for factor associations with PCs.
 
-                res:typing.NamedTuple = stats.f_oneway(*values) # ignore type error
-
-                p_res[factor] = res.pvalue  # ignore
-                f_res[factor] = res.statistic
+        Statistics for every PC are calculated on the first call and
+        cached, so changing max_pc is cheap.
 
-        ptable = pd.DataFrame(table['p'])
-        fdr = sm.stats.multipletests(np.ravel(ptable), method='fdr_bh', )[1]
-        fdr = pd.DataFrame(np.reshape(fdr, ptable.shape), index=ptable.index, columns=ptable.columns)
-        return pd.concat({'F': pd.DataFrame(table['F']), 'p': ptable, 'FDR': fdr}, axis=1)
+        return: DF with level 0 columns of F, p & FDR and level 1
+        giving the PC results."""
+        F, p = self._anova_all_pcs()
+        # PCs are zero indexed here
+        n_pcs = int(min(max_pc + 1, F.shape[1]))
+        F, p = F.iloc[:, :n_pcs], p.iloc[:, :n_pcs]
+        fdr = pd.DataFrame(np.reshape(bh_fdr(np.ravel(p)), p.shape),
+                           index=p.index, columns=p.columns)
+        return pd.concat({'F': F, 'p': p, 'FDR': fdr}, axis=1)
 
 
 #todo add pca_rugplot (below)
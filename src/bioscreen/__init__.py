@@ -1,3 +1,16 @@
-from bioscreen import PCA
+import importlib
+
+# Submodules are imported on first access, so that `import bioscreen...`
+#  doesn't pull in sklearn, matplotlib etc.
+_SUBMODULES = ('PCA', 'plotting', 'gene_ontology', 'go_dag', 'geneset_enrichment',
+               'stringdb', 'pylimma', 'experiment_classes', 'classes', 'rinterfaces')
+
+def __getattr__(name):
+    if name in _SUBMODULES:
+        return importlib.import_module(f"bioscreen.{name}")
+    raise AttributeError(f"module 'bioscreen' has no attribute '{name}'")
+
+def __dir__():
+    return sorted(list(globals()) + list(_SUBMODULES))
 
 #from .PCA import CountPCA
\ No newline at end of file
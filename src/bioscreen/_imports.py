@@ -42,6 +42,19 @@ from bioscreen.utils import(
     Pathy, AMap
 )
 
-from jttools.excel import conditional_format_definitions
-sigfmtxl = conditional_format_definitions.significance()
-scrfmtxl = conditional_format_definitions.score()
\ No newline at end of file
+import functools
+
+@functools.cache
+def excel_conditional_formats() -> tuple[dict, dict]:
+    """(significance, score) conditional formats from jttools.excel, which
+    is imported on first call."""
+    from jttools.excel import conditional_format_definitions
+    return conditional_format_definitions.significance(), conditional_format_definitions.score()
+
+def __getattr__(name):
+    # sigfmtxl & scrfmtxl used to be built on import
+    if name == 'sigfmtxl':
+        return excel_conditional_formats()[0]
+    if name == 'scrfmtxl':
+        return excel_conditional_formats()[1]
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
\ No newline at end of file
@@ -116,8 +116,12 @@ class Comparison:
         # # In order to keep the to/from_df mirrored, if there's a `Groups`
         # #   column it's just going into .other_cols.
 
+        # Differential is derived from control, so it's not kept
+        derived = lc_series.index == 'differential'
+
         # find cols to be used as groups
-        bools = [(type(v) == bool) for v in compseries.values]
+        bools = np.array([(type(v) == bool) for v in compseries.values], dtype=bool)
+        bools = bools & ~(kw_mask | derived)
 
         # add the columns where bool is True
         if any(bools):
@@ -125,7 +129,7 @@ class Comparison:
         # else the default value for groups is used.
 
         # other columns get dumped in self.other_cols
-        other_mask = ~(kw_mask|bools)
+        other_mask = ~(kw_mask|bools|derived)
         if other_mask.any(): # if not all columns were kwargs
             kwargs['other_cols'] = compseries[other_mask].to_dict()
 
@@ -1,14 +1,16 @@
 from bioscreen.classes.base import logger, CompsResultDF, StatColumns, SigCols
 from bioscreen._imports import *
-from bioscreen.classes.results import AnalysisResults, comp_results_from_dir
+from bioscreen.classes.results import AnalysisResults, comp_results_from_dir, comps_table_from_arrays
 from bioscreen.classes.comparison import Comparison, CompDict
 from attrs import define
 
 __all__ = ['LimmaResults', 'load_results', 'LIMMACOLS']
 
 
-def load_results(results_dir, columns, index_name='Gene') \
+def load_results(results_dir, columns, index_name='Gene', **loader_kwargs) \
         -> tuple[CompsResultDF, CompDict]:
+    """Load limma results CSV from results_dir. loader_kwargs are passed
+    to `comp_results_from_dir`, e.g. `n_workers` to read files in parallel."""
     def fn_to_comp(fn):
         logger.info(f'DGEResults: fn_to_comp({fn})')
         test, ctrl, _ = fn.split('.')
@@ -19,7 +21,8 @@ def load_results(results_dir, columns, index_name='Gene') \
     compres, comparisons = comp_results_from_dir(
         results_dir,
         fn_to_comp,
-        columns
+        columns,
+        **loader_kwargs
     )
     compres.index.name = index_name
     return compres, comparisons
@@ -63,18 +66,40 @@ class LimmaResults(AnalysisResults):
         return cls(table=table, comparisons=comparisons,
                             columns=columns, scorekey=scorekey)
 
+    @classmethod
+    def from_arrays(cls, stat_arrays:Mapping[str, np.ndarray], index:Collection,
+                    comparisons:CompDict, scorekey='LFC'):
+        """Build from (genes × comparisons) arrays of each stat, keyed by
+        LIMMACOLS keys, with columns in comparisons.names() order.
+        p10 & FDR10 are calculated."""
+        table = comps_table_from_arrays(
+            {k:stat_arrays[k] for k in LIMMACOLS.keys() if k in stat_arrays},
+            index, comparisons.names()
+        )
+        # F isn't produced for single contrasts
+        columns = StatColumns({k:c for k, c in LIMMACOLS.items()
+                               if k in table.columns.get_level_values(1)})
+        return cls(table=table, comparisons=comparisons, columns=columns, scorekey=scorekey)
+
     @classmethod
     def from_dir(
             cls,
             results_dir,
             scorekey='LFC',
             index_name='Gene',
-            comparisons:CompDict=None):
+            comparisons:CompDict=None,
+            n_workers:int=None,
+            float_dtype=np.float64,):
+        """Load results from a directory of topTable CSV.
 
+        Set n_workers to read files concurrently, parsing only
+        LIMMACOLS stat columns as float_dtype."""
 
         (res, comps) = load_results(
             results_dir, LIMMACOLS,
-            index_name=index_name
+            index_name=index_name,
+            n_workers=n_workers,
+            float_dtype=float_dtype,
         )
         if comparisons is None:
             comparisons = comps
@@ -7,9 +7,11 @@ import pandas as pd
 
 from bioscreen._imports import *
 from bioscreen.classes.base import *
-from bioscreen.classes.results import AnalysisResults
+from bioscreen.classes.results import AnalysisResults, add_log10_sig_cols_all
 from bioscreen.classes.comparison import Comparison, CompDict
-from statsmodels.stats.multitest import fdrcorrection
+from bioscreen.classes.geneset_index import GeneSetIndex
+from bioscreen.classes.geneset_tsl import load_tsl_dir
+from bioscreen.utils import bh_fdr
 import numpy as np
 from attrs import define
 
@@ -20,43 +22,148 @@ GSName = str
 GeneSet = set
 
 class GeneSetCollections(dict[GSCollectionName, dict[GSName, GeneSet]]):
+    """{collection: {set name: genes}}.
+
+    `index` gives a GeneSetIndex, built on first use and kept until the
+    collections are changed. Replacing or removing collections resets it,
+    changes to the sets within a collection don't, so call
+    invalidate_index() after modifying them in place."""
 
     @property
-    def collections_map(self):
-        coll_gs = {}
-        for col, sets in self.items():
-            for gs in sets:
-                coll_gs[gs] = col
-        return coll_gs
+    def index(self) -> GeneSetIndex:
+        # getattr, as instances unpickled from before the index existed won't have it
+        if getattr(self, '_index', None) is None:
+            self._index = GeneSetIndex.from_collections(self)
+        return self._index
+
+    def invalidate_index(self):
+        self._index = None
+        self._collections_map = None
+
+    @property
+    def collections_map(self) -> dict[GSName, GSCollectionName]:
+        if getattr(self, '_collections_map', None) is None:
+            coll_gs = {}
+            for col, sets in self.items():
+                for gs in sets:
+                    coll_gs[gs] = col
+            self._collections_map = coll_gs
+        return self._collections_map
 
     def genes_by_setname(self, gset:GSName) -> GeneSet:
         coll = self.collections_map[gset]
         return self[coll][gset]
 
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.invalidate_index()
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self.invalidate_index()
+
+    def __ior__(self, other):
+        self.update(other)
+        return self
+
+    def update(self, *args, **kwargs):
+        super().update(*args, **kwargs)
+        self.invalidate_index()
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self.invalidate_index()
+        return super().setdefault(key, default)
+
+    def pop(self, *args):
+        self.invalidate_index()
+        return super().pop(*args)
+
+    def popitem(self):
+        self.invalidate_index()
+        return super().popitem()
+
+    def clear(self):
+        super().clear()
+        self.invalidate_index()
+
+    def __getstate__(self):
+        # don't pickle the index
+        return {k:v for k, v in self.__dict__.items()
+                if k not in ('_index', '_collections_map')}
+
     def genes_in_collection(self, collection:GSCollectionName):
         genes = GeneSet()
         for genessets in self[collection].values():
             genes.update(genessets)
         return genes
 
-    def to_tidy_df(self):
+    _tidy_columns = ['geneID', 'termID', 'termName', 'description', 'dbName']
+
+    def _tidy_chunks(self, chunk_rows:int=None, categorical=True) \
+            -> typing.Iterator[pd.DataFrame]:
+        """to_tidy_df tables, for groups of whole sets of about chunk_rows
+        rows. Columns are built from set sizes with np.repeat, term names
+        are calculated once per set."""
+        sets = [(coll, setid, genes) for coll, gsets in self.items()
+                for setid, genes in gsets.items()]
+        sizes = np.fromiter((len(g) for _, _, g in sets), dtype=np.int64, count=len(sets))
+        if chunk_rows is None:
+            bounds = [0, len(sets)]
+        else:
+            # start a new chunk each time the cumulative rows pass a multiple of chunk_rows
+            ends = np.cumsum(sizes)
+            breaks = np.flatnonzero(np.diff(ends // chunk_rows, prepend=0)) + 1
+            bounds = sorted({0, len(sets), *breaks.tolist()})
+
+        term_ids = pd.unique(pd.Series([setid for _, setid, _ in sets], dtype=object))
+        name_codes, term_names = pd.factorize(
+            pd.Series([self.set_name_from_msig(t) for t in term_ids], dtype=object)
+        )
+        colls = list(self.keys())
+        term_codes = pd.Index(term_ids).get_indexer([setid for _, setid, _ in sets])
+        coll_codes = pd.Index(colls).get_indexer([coll for coll, _, _ in sets])
+
+        for start, end in zip(bounds[:-1], bounds[1:]):
+            chunk_sizes = sizes[start:end]
+            genes = np.fromiter(
+                itertools.chain.from_iterable(g for _, _, g in sets[start:end]),
+                dtype=object, count=int(chunk_sizes.sum())
+            )
+            term_rows = np.repeat(term_codes[start:end], chunk_sizes)
+            coll_rows = np.repeat(coll_codes[start:end], chunk_sizes)
+            if categorical:
+                columns = [
+                    pd.Categorical(genes),
+                    pd.Categorical.from_codes(term_rows, categories=term_ids),
+                    pd.Categorical.from_codes(name_codes[term_rows], categories=term_names),
+                    np.full(len(genes), '', dtype=object),
+                    pd.Categorical.from_codes(coll_rows, categories=colls),
+                ]
+            else:
+                columns = [
+                    genes,
+                    np.asarray(term_ids, dtype=object)[term_rows],
+                    np.asarray(term_names, dtype=object)[name_codes[term_rows]],
+                    np.full(len(genes), '', dtype=object),
+                    np.asarray(colls, dtype=object)[coll_rows],
+                ]
+            yield pd.DataFrame(dict(zip(self._tidy_columns, columns)))
+
+    def to_tidy_df(self, categorical=True):
         """Each row a unique combination of gene and set name.
         Uses SetRank column names:
             geneID termID termName description dbName
-        """
-        cols = 'geneID termID termName description dbName'.split()
-        dat = {c: [] for c in cols}
-        for coll, gsets in self.items():
-            for setid, genes in gsets.items():
-                for gn in genes:
-                    dat['geneID'].append(gn)
-                    dat['termID'].append(setid)
-                    dat['termName'].append(self.set_name_from_msig(setid))
-                    dat['description'] = ''
-                    dat['dbName'].append(coll)
-        # return pd.DataFrame(dat)
-        msig_tidy = pd.DataFrame(dat)
-        return msig_tidy
+
+        With categorical, all but description are categorical dtype."""
+        return next(self._tidy_chunks(categorical=categorical))
+
+    def write_tidy(self, filename:Pathy, chunk_rows=1_000_000, sep='\t', **to_csv_kwargs):
+        """Write to_tidy_df table to filename, generated and written
+        chunk_rows at a time (chunks contain whole sets)."""
+        with open(filename, 'w', newline='') as f:
+            for i, chunk in enumerate(self._tidy_chunks(chunk_rows, categorical=False)):
+                chunk.to_csv(f, sep=sep, header=(i == 0), index=False, **to_csv_kwargs)
 
     @staticmethod
     def set_name_from_msig(n):
@@ -82,18 +189,20 @@ class GeneSetCollections(dict[GSCollectionName, dict[GSName, GeneSet]]):
         return gene_sets
 
     @classmethod
-    def from_tsl_dir(cls, directory):
+    def from_tsl_dir(cls, directory, collections:Collection[str]=None,
+                     set_names:Collection[str]=None, min_size:int=None, max_size:int=None,
+                     n_workers:int=None, cache=True, cache_dir=None, lazy=False):
         """Assumes filnames are '{collection name}.tsl', first value
-        is gene set names, and all after are genes. """
-        gsets_dir = pathlib.Path(directory)
-        gcollections = {}
-        for fn in os.listdir(gsets_dir):
-            if fn.endswith('.tsl'):
-                collname = fn.__str__().split('.')[-2]
-                gcollections[collname] = GeneSetCollections.sets_from_tsl(
-                    gsets_dir/fn
-                )
-        return cls(gcollections)
+        is gene set names, and all after are genes.
+
+        Files are parsed in parallel and cached in binary form, by default
+        in the user cache directory (not next to directory), so later
+        loads of unchanged files are read from the cache. See `geneset_tsl.load_tsl_dir` for args."""
+        return cls(load_tsl_dir(
+            directory, collections=collections, set_names=set_names,
+            min_size=min_size, max_size=max_size, n_workers=n_workers,
+            cache=cache, cache_dir=cache_dir, lazy=lazy,
+        ))
 
 # @define
 # class GeneSet:
@@ -132,10 +241,7 @@ class GeneSetEnrichmentResults(AnalysisResults):
             columns.rename_df_columns(tbl, inplace=True)
 
             if do_fdr:
-                tbl.loc[:, 'FDR'] = fdrcorrection(tbl.p)[1]
-            if do_log10:
-                tbl.loc[:, 'p10'] = tbl.p.apply(neglog10)
-                tbl.loc[:, 'FDR10'] = tbl.FDR.apply(neglog10)
+                tbl.loc[:, 'FDR'] = bh_fdr(tbl.p.to_numpy())
 
             # put the table into the structure
             if coll not in res_by_collctn:
@@ -153,12 +259,17 @@ class GeneSetEnrichmentResults(AnalysisResults):
         results = CompsResultDF(
             pd.concat(tables, axis='index')
         )
+        if do_log10:
+            results = add_log10_sig_cols_all(results, ('p', 'FDR'))
         return (results, comparisons)
 
     def result_table(self, ctrl_or_comp, test=None, ) -> \
             pd.DataFrame:
         table = super().result_table(ctrl_or_comp, test)
-        table.loc[:, 'Collection'] = self.table.Collection
+        if self._lazy:
+            table.loc[:, 'Collection'] = self._store.extra_column('Collection')
+        else:
+            table.loc[:, 'Collection'] = self.table.Collection
         return table
 
 
@@ -224,7 +335,6 @@ class PadogResults(GeneSetEnrichmentResults):
 
 
 #from bioscreen.classes.experiment import get_replicates_of_comparison
-from jttools.data_wrangling import index_of_true
 
 def get_replicates_of_comparison(sample_details, comparison:Comparison) -> np.ndarray[Sample]:
     """Control and test samples used in a comparison. Controls first."""
@@ -249,62 +359,105 @@ class CountRemapperWithDuplicates:
         self.comparisons = comparisons
         self.scorecol = scorecol
         self.sigcol = sigcol
-
-    def _get_bad_duplicates_by_sig(self, compk:str, direction: Literal['up', 'down'], ):
-        """Get list of indexes to drop to keep the strongest hits in
-        both directions for all in fdr and lfc tables.
-
-        idmap should map from index values in fdr10/lfc to new values
-        containing the duplicates that you want to select from."""
-
-        # we'll get the order right by having things going
-        # in the wrong direction be neg
-        lfc = self.result_table[compk][self.scorecol].copy()
-        sig = self.result_table[compk][self.sigcol].copy()
-
-        if direction == 'up':
-            wrongdir = lfc < 0
-        else:
-            wrongdir = lfc > 0
-
-        sig[wrongdir] *= -1
-        f = sig.sort_values()
-
-        droppers = self.symbolmapper.loc[f.index].duplicated(keep='last')
-
-        return index_of_true(droppers)
-
-    def _get_count_better_duplicates(
-            self, samples:Collection[Sample], worse_in_direction:Collection[str]
-    ):
-        """Worse in direction is a list of indexes that should be dropped for the direction we're
-        looking at"""
-        newcnt = self.counts.loc[:, samples].drop(worse_in_direction)
-        newcnt.index = newcnt.index.map(self.symbolmapper.loc[newcnt.index])
-        newcnt = newcnt.loc[~newcnt.isna().all(1)]
-        newcnt = newcnt.loc[~newcnt.index.isna()]
-        return newcnt
+        self._best_rows = None
+        self._count_values = None
+
+    def best_rows(self) -> dict[Literal['up', 'down'], pd.DataFrame]:
+        """Position in counts of the best row of each symbol for every
+        comparison, {direction: table (symbols × comparisons)}.
+
+        The best row is the most significant in the direction, rows changing
+        in the other direction rank below all those that don't, as
+        significance is made negative. Rows with NaN significance rank above
+        everything, as they always have. Ties go to the last row. Only rows
+        in both result_table and counts are used.
+
+        Selected for all comparisons and directions at once, as a grouped
+        argmax over the (rows × comparisons) score and sig matrices."""
+        if self._best_rows is not None:
+            return self._best_rows
+
+        comps = list(self.comparisons.keys())
+        score = self.result_table.xs(self.scorecol, level=1, axis=1).reindex(columns=comps)
+        sig = self.result_table.xs(self.sigcol, level=1, axis=1).reindex(columns=comps)
+
+        count_rows = self.counts.index.get_indexer(score.index)
+        codes, symbols = pd.factorize(
+            self.symbolmapper.reindex(score.index).to_numpy()
+        )
+        usable = np.flatnonzero((codes >= 0) & (count_rows >= 0))
+        # group rows of the same symbol together, keeping their order
+        usable = usable[np.argsort(codes[usable], kind='stable')]
+        group_codes = codes[usable]
+        starts = np.flatnonzero(np.r_[True, group_codes[1:] != group_codes[:-1]])
+
+        score = score.to_numpy(dtype=np.float64)[usable]
+        sig = sig.to_numpy(dtype=np.float64)[usable]
+        # up and down side by side. NaN sig above everything, as the
+        #   original sort_values & duplicated(keep='last') implementation
+        signed = np.concatenate([np.where(score < 0, -sig, sig),
+                                 np.where(score > 0, -sig, sig)], axis=1)
+        signed = np.nan_to_num(signed, nan=np.inf)
+
+        # groupby max is much faster than ufunc.reduceat over columns
+        def group_max(values):
+            return pd.DataFrame(values, copy=False).groupby(group_codes, sort=False).max().to_numpy()
+
+        best = group_max(signed)
+        is_best = signed == np.repeat(best, np.diff(np.r_[starts, len(usable)]), axis=0)
+        position = np.where(is_best, np.arange(len(usable))[:, None], -1)
+        last_best = group_max(position)
+
+        rows = count_rows[usable][last_best]
+        index = pd.Index(symbols[group_codes[starts]], name=self.symbolmapper.name)
+        ncomp = len(comps)
+        self._best_rows = {
+            'up': pd.DataFrame(rows[:, :ncomp], index=index, columns=comps),
+            'down': pd.DataFrame(rows[:, ncomp:], index=index, columns=comps),
+        }
+        return self._best_rows
 
     def remap_count_index_keeping_better_duplicates(
             self,
             direction:Literal['up', 'down'],
             compk) -> pd.DataFrame:
+        """Counts of the comparison's samples, indexed by symbol, keeping the
+        best row of each symbol (see `best_rows`). Rows that are all NaN
+        are dropped."""
         reps = get_replicates_of_comparison(
             self.sample_details,
             self.comparisons[compk]
         )
-        worse_indexes = self._get_bad_duplicates_by_sig(
-            compk, direction
-        )
-        return self._get_count_better_duplicates(reps, worse_indexes)
-
-    def iter(self) -> Tuple[Literal['up', 'down'], Comparison, pd.Series]:
+        rows = self.best_rows()[direction][compk]
+        cols = self.counts.columns.get_indexer(reps)
+        # a single fancy index into the counts
+        if self._count_values is None:
+            self._count_values = self.counts.to_numpy()
+        values = self._count_values[np.ix_(rows.to_numpy(), cols)]
+        keep = ~pd.isna(values).all(1)
+        return pd.DataFrame(values[keep], index=rows.index[keep], columns=self.counts.columns[cols])
+
+    def view(self, direction:Literal['up', 'down'], compk) -> 'RemappedCountsView':
+        """Lazy version of `remap_count_index_keeping_better_duplicates`,
+        holding only the row & column selectors."""
+        return RemappedCountsView(self, direction, compk)
+
+    def iter(self, lazy=False) -> Tuple[Literal['up', 'down'], Comparison, pd.Series]:
         """Iterate through counts, returning string indicating direction, comparison
-        object, and new count."""
+        object, and new count.
+
+        Best rows are selected for everything up front, each count table is
+        only built when it's reached. With lazy=True, RemappedCountsView
+        are returned in place of tables, so nothing is copied until
+        `.to_frame()` is called, e.g. for large runs where not every
+        table is used or they're consumed elsewhere."""
         for direction in ('up', 'down',):
             direction:Literal['up', 'down']
             for compk, comp in self.comparisons.items():
-                t = self.remap_count_index_keeping_better_duplicates(direction, compk)
+                if lazy:
+                    t = self.view(direction, compk)
+                else:
+                    t = self.remap_count_index_keeping_better_duplicates(direction, compk)
                 yield direction, comp, t
 
     def __iter__(self):
@@ -343,6 +496,30 @@ class CountRemapperWithDuplicates:
     #     display(testcount.loc[:, c.columns])
     #     break
 
+
+class RemappedCountsView:
+    """A remapped count table of CountRemapperWithDuplicates that hasn't
+    been built. rows & columns are positions in the counts, index gives
+    the symbol of each row. Unlike the built table, rows that are all NaN
+    are only dropped by to_frame()."""
+    def __init__(self, remapper:CountRemapperWithDuplicates, direction:Literal['up', 'down'], compk):
+        self.remapper = remapper
+        self.direction = direction
+        self.compk = compk
+        selected = remapper.best_rows()[direction][compk]
+        self.index = selected.index
+        self.rows = selected.to_numpy()
+        reps = get_replicates_of_comparison(remapper.sample_details, remapper.comparisons[compk])
+        self.columns = remapper.counts.columns.get_indexer(reps)
+
+    @property
+    def shape(self) -> tuple[int, int]:
+        return len(self.rows), len(self.columns)
+
+    def to_frame(self) -> pd.DataFrame:
+        return self.remapper.remap_count_index_keeping_better_duplicates(self.direction, self.compk)
+
+
 if __name__ == '__main__':
     print('testing padog reading')
     fnp = '/mnt/m/tasks/MTX639_TAC_MoA_RNAseq/padog/test_first/t3_htseq/'
@@ -350,3 +527,4 @@ if __name__ == '__main__':
 
     t = PadogResults.from_dirs(fnp, fngs)
     print(t.table.columns.levels[1])
+
@@ -0,0 +1,187 @@
+"""Compiled, array based, form of GeneSetCollections.
+
+Genes are interned into a sorted vocabulary and given integer IDs, and set
+membership is held as a CSR style sparse matrix (sets × genes), so that
+membership, set sizes, overlaps and gene->set lookups are array operations
+rather than loops over Python sets."""
+
+from bioscreen._imports import *
+
+__all__ = ['GeneSetIndex']
+
+
+class GeneSetIndex:
+    """Sparse gene set membership. Rows are gene sets, in the order of
+    iterating over the collections; columns are genes, in sorted order.
+
+    Build with `GeneSetIndex.from_collections`, or get the cached index of a
+    GeneSetCollections with `GeneSetCollections.index`.
+
+    Attributes:
+        genes: gene vocabulary, sorted, gene ID is the position.
+        set_names: name of each set (row).
+        collections: collection names.
+        set_collection: position in collections of each set.
+        indptr, indices: CSR structure, the gene IDs of set i are
+            indices[indptr[i]:indptr[i+1]], sorted.
+    """
+
+    def __init__(self, genes:np.ndarray, set_names:np.ndarray, collections:list[str],
+                 set_collection:np.ndarray, indptr:np.ndarray, indices:np.ndarray):
+        self.genes = genes
+        self.set_names = set_names
+        self.collections = collections
+        self.set_collection = set_collection
+        self.indptr = indptr
+        self.indices = indices
+
+        self._gene_lookup = pd.Index(genes)
+        # sets with the same name in different collections resolve to the
+        #   last one, as GeneSetCollections.collections_map
+        names = pd.Series(np.arange(len(set_names)), index=set_names)
+        names = names[~names.index.duplicated(keep='last')]
+        self._set_lookup = names.index
+        self._set_rows = names.to_numpy()
+        # row of each stored value, for vectorised ops
+        self._nnz_rows = np.repeat(np.arange(len(set_names), dtype=np.int32), np.diff(indptr))
+        self._gene_sets = None
+
+    @classmethod
+    def from_collections(cls, collections:Mapping[str, Mapping[str, Collection[str]]]) \
+            -> 'GeneSetIndex':
+        set_names, set_coll, set_genes = [], [], []
+        coll_names = list(collections.keys())
+        for ci, sets in enumerate(collections.values()):
+            for name, genes in sets.items():
+                set_names.append(name)
+                set_coll.append(ci)
+                set_genes.append(genes)
+
+        sizes = np.fromiter((len(g) for g in set_genes), dtype=np.int64, count=len(set_genes))
+        flat = np.fromiter(itertools.chain.from_iterable(set_genes), dtype=object,
+                           count=int(sizes.sum()))
+        # factorize interns the genes, then IDs are remapped to sorted order
+        ids, genes = pd.factorize(flat)
+        order = np.argsort(genes.astype(str))
+        rank = np.empty(len(order), dtype=np.int64)
+        rank[order] = np.arange(len(order))
+        genes = genes[order]
+
+        indptr = np.zeros(len(sizes) + 1, dtype=np.int64)
+        np.cumsum(sizes, out=indptr[1:])
+        # sort gene IDs within each row, (row, id) as a single int key
+        rows = np.repeat(np.arange(len(sizes), dtype=np.int64), sizes)
+        keys = np.sort(rows * max(len(genes), 1) + rank[ids])
+        ids = (keys % max(len(genes), 1)).astype(np.int32)
+
+        return cls(
+            genes=np.asarray(genes, dtype=object),
+            set_names=np.array(set_names, dtype=object),
+            collections=coll_names,
+            set_collection=np.array(set_coll, dtype=np.int32),
+            indptr=indptr,
+            indices=ids,
+        )
+
+    @property
+    def n_sets(self) -> int:
+        return len(self.set_names)
+
+    @property
+    def n_genes(self) -> int:
+        return len(self.genes)
+
+    @property
+    def nnz_rows(self) -> np.ndarray:
+        """Row (set) of each stored value, parallel to indices."""
+        return self._nnz_rows
+
+    @property
+    def set_sizes(self) -> np.ndarray:
+        return np.diff(self.indptr)
+
+    def matrix(self):
+        """scipy.sparse.csr_matrix of membership, sets × genes."""
+        from scipy import sparse
+        return sparse.csr_matrix(
+            (np.ones(len(self.indices), dtype=np.int8), self.indices, self.indptr),
+            shape=(self.n_sets, self.n_genes),
+        )
+
+    def gene_ids(self, genes:Collection[str]) -> np.ndarray:
+        """Integer IDs of genes, -1 for genes not in any set."""
+        return self._gene_lookup.get_indexer(list(genes))
+
+    def set_rows(self, set_names:Collection[str]) -> np.ndarray:
+        """Row of each named set, -1 if not found."""
+        i = self._set_lookup.get_indexer(list(set_names))
+        return np.where(i < 0, -1, self._set_rows[i])
+
+    def set_collections(self, set_names:Collection[str]) -> np.ndarray:
+        """Collection name of each set."""
+        rows = self.set_rows(set_names)
+        if (rows < 0).any():
+            raise KeyError(f"Gene sets not found: {list(np.asarray(set_names)[rows < 0])}")
+        return np.asarray(self.collections, dtype=object)[self.set_collection[rows]]
+
+    def genes_of(self, set_name:str) -> np.ndarray:
+        row = self.set_rows([set_name])[0]
+        if row < 0:
+            raise KeyError(set_name)
+        return self.genes[self.indices[self.indptr[row]:self.indptr[row + 1]]]
+
+    def is_member(self, set_names:Collection[str], genes:Collection[str]) -> np.ndarray:
+        """Elementwise, is genes[i] in set set_names[i]."""
+        rows = self.set_rows(set_names)
+        ids = self.gene_ids(genes)
+        # rows then gene IDs are sorted, so (row, id) pairs can be searched
+        #   as a single sorted key
+        keys = self._nnz_rows.astype(np.int64) * self.n_genes + self.indices
+        query = rows.astype(np.int64) * self.n_genes + ids
+        pos = np.searchsorted(keys, query).clip(max=len(keys) - 1)
+        found = (keys[pos] == query) if len(keys) else np.zeros(len(query), dtype=bool)
+        return found & (rows >= 0) & (ids >= 0)
+
+    def membership(self, genes:Collection[str]) -> np.ndarray:
+        """Boolean array (sets × genes) of membership of the given genes."""
+        gindptr, set_rows = self._transpose()
+        ids = self.gene_ids(genes)
+        cols = np.flatnonzero(ids >= 0)
+        starts = gindptr[ids[cols]]
+        lengths = gindptr[ids[cols] + 1] - starts
+        # positions of every (gene, set) pair in the transposed structure
+        pos = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+        out = np.zeros((self.n_sets, len(ids)), dtype=bool)
+        out[set_rows[pos], np.repeat(cols, lengths)] = True
+        return out
+
+    def overlap_counts(self, genes:Collection[str]) -> np.ndarray:
+        """Number of genes in each set, duplicates in genes counted once."""
+        mask = np.zeros(self.n_genes, dtype=bool)
+        ids = self.gene_ids(genes)
+        mask[ids[ids >= 0]] = True
+        return np.bincount(self._nnz_rows[mask[self.indices]], minlength=self.n_sets)
+
+    def _transpose(self):
+        if self._gene_sets is None:
+            order = np.argsort(self.indices, kind='stable')
+            counts = np.bincount(self.indices, minlength=self.n_genes)
+            gindptr = np.zeros(self.n_genes + 1, dtype=np.int64)
+            np.cumsum(counts, out=gindptr[1:])
+            self._gene_sets = (gindptr, self._nnz_rows[order])
+        return self._gene_sets
+
+    def sets_of_gene(self, gene:str) -> np.ndarray:
+        """Names of sets containing gene."""
+        gindptr, rows = self._transpose()
+        i = self.gene_ids([gene])[0]
+        if i < 0:
+            return np.array([], dtype=object)
+        return self.set_names[rows[gindptr[i]:gindptr[i + 1]]]
+
+    def gene_set_counts(self, genes:Collection[str]) -> np.ndarray:
+        """Number of sets each gene is in."""
+        gindptr, _ = self._transpose()
+        ids = self.gene_ids(genes)
+        counts = np.diff(gindptr)
+        return np.where(ids < 0, 0, counts[ids])
@@ -0,0 +1,250 @@
+"""Loading directories of .tsl gene set files, with a binary cache.
+
+Each collection file ('{collection}.tsl', one set per line, set name then
+genes, tab separated) is parsed to arrays:
+    names: set names.
+    genes: the collection's gene vocabulary.
+    indptr, indices: the genes of set i are genes[indices[indptr[i]:indptr[i+1]]].
+
+These are saved as .npy in a cache directory, by default in the user cache
+directory (see `bioscreen.utils.user_cache_dir`), and a manifest records
+the modification time and size of each source file. Collections whose source hasn't changed
+are memory-mapped from the cache rather than parsed."""
+
+import json
+from concurrent.futures import ProcessPoolExecutor
+
+from bioscreen._imports import *
+from bioscreen.classes.base import logger
+
+__all__ = ['load_tsl_dir', 'parse_tsl', 'LazyGeneSets', 'TslArrays']
+
+CACHE_VERSION = 1
+_ARRAYS = ('names', 'genes', 'indptr', 'indices')
+
+TslArrays = dict[str, np.ndarray]
+
+
+def collection_name(fn:Pathy) -> str:
+    return pathlib.Path(fn).name.split('.')[-2]
+
+
+def parse_tsl(filename:Pathy) -> TslArrays:
+    """Parse a .tsl file into arrays, see module docstring."""
+    names, sizes, flat = [], [], []
+    with open(filename) as f:
+        for line in f:
+            spline = line.strip().split('\t')
+            if spline == ['']:
+                continue
+            # sets, so drop duplicate genes
+            genes = list(dict.fromkeys(spline[1:]))
+            names.append(spline[0])
+            sizes.append(len(genes))
+            flat.extend(genes)
+
+    indices, genes = pd.factorize(pd.Series(flat, dtype=object))
+    indptr = np.zeros(len(sizes) + 1, dtype=np.int64)
+    np.cumsum(sizes, out=indptr[1:])
+    return dict(
+        names=np.array(names, dtype=str),
+        genes=np.asarray(genes, dtype=str),
+        indptr=indptr,
+        indices=indices.astype(np.int32),
+    )
+
+
+def _keep_rows(arrays:TslArrays, set_names:Collection[str]=None,
+               min_size:int=None, max_size:int=None) -> np.ndarray:
+    """Rows (sets) passing the filters."""
+    sizes = np.diff(arrays['indptr'])
+    keep = np.ones(len(sizes), dtype=bool)
+    if min_size is not None:
+        keep &= sizes >= min_size
+    if max_size is not None:
+        keep &= sizes <= max_size
+    if set_names is not None:
+        keep &= np.isin(np.asarray(arrays['names']), list(set_names))
+    return np.flatnonzero(keep)
+
+
+def arrays_to_sets(arrays:TslArrays, set_names:Collection[str]=None,
+                   min_size:int=None, max_size:int=None) -> dict[str, set[str]]:
+    """{set name: genes} for sets passing the filters."""
+    rows = _keep_rows(arrays, set_names, min_size, max_size)
+    # each gene string is created once and shared between sets, and
+    #   converting to a list once is much faster than indexing per set
+    vocab = np.asarray(arrays['genes']).astype(object)
+    genes = vocab[np.asarray(arrays['indices'])].tolist()
+    indptr = arrays['indptr'].tolist()
+    names = np.asarray(arrays['names']).tolist()
+    return {names[i]:set(genes[indptr[i]:indptr[i + 1]]) for i in rows}
+
+
+class LazyGeneSets(typing.Mapping[str, set[str]]):
+    """Read only {set name: genes} backed by parsed .tsl arrays, each set
+    is built when first accessed."""
+
+    def __init__(self, arrays:TslArrays, rows:np.ndarray):
+        self._arrays = arrays
+        names = np.asarray(arrays['names'])[rows].tolist()
+        self._rows = dict(zip(names, rows.tolist()))
+        self._vocab = None
+        self._sets = {}
+
+    def __getitem__(self, name:str) -> set[str]:
+        if name not in self._sets:
+            row = self._rows[name]
+            if self._vocab is None:
+                self._vocab = np.asarray(self._arrays['genes']).astype(object)
+            a, b = self._arrays['indptr'][row:row + 2]
+            self._sets[name] = set(self._vocab[self._arrays['indices'][a:b]].tolist())
+        return self._sets[name]
+
+    def __iter__(self):
+        return iter(self._rows)
+
+    def __len__(self):
+        return len(self._rows)
+
+    def __contains__(self, name):
+        return name in self._rows
+
+    def set_sizes(self) -> dict[str, int]:
+        """Sizes without building the sets."""
+        sizes = np.diff(self._arrays['indptr'])
+        return {k:int(sizes[r]) for k, r in self._rows.items()}
+
+    def to_dict(self) -> dict[str, set[str]]:
+        return {k:self[k] for k in self}
+
+    def __repr__(self):
+        return f"LazyGeneSets({len(self)} sets)"
+
+    def __reduce__(self):
+        # pickle as a plain dict, rather than the memory-mapped arrays
+        return dict, (self.to_dict(),)
+
+
+class TslCache:
+    """Cache of parsed .tsl arrays for a source directory."""
+
+    def __init__(self, cache_dir:Pathy, mmap=True):
+        self.cache_dir = pathlib.Path(cache_dir)
+        self._mmap_mode = 'r' if mmap else None
+        self.manifest = self._read_manifest()
+
+    def _read_manifest(self) -> dict[str, dict]:
+        fn = self.cache_dir / 'manifest.json'
+        if not fn.exists():
+            return {}
+        with open(fn) as f:
+            manifest = json.load(f)
+        if manifest.get('version') != CACHE_VERSION:
+            return {}
+        return manifest['collections']
+
+    @staticmethod
+    def _signature(source:pathlib.Path) -> dict:
+        st = source.stat()
+        return dict(mtime_ns=st.st_mtime_ns, size=st.st_size)
+
+    def get(self, collection:str, source:pathlib.Path) -> Optional[TslArrays]:
+        """Cached arrays, or None if not cached or source has changed."""
+        entry = self.manifest.get(collection)
+        if entry is None or entry['source'] != self._signature(source):
+            return None
+        try:
+            return {k:np.load(self.cache_dir / f"{collection}.{k}.npy", mmap_mode=self._mmap_mode)
+                    for k in _ARRAYS}
+        except (OSError, ValueError):
+            return None
+
+    def put(self, collection:str, source:pathlib.Path, arrays:TslArrays):
+        from bioscreen.utils import save_array
+        os.makedirs(self.cache_dir, exist_ok=True)
+        # replace files rather than overwriting, LazyGeneSets from earlier
+        #   loads may have the old ones memory-mapped
+        for k in _ARRAYS:
+            save_array(self.cache_dir / f"{collection}.{k}.npy", arrays[k])
+        self.manifest[collection] = dict(source=self._signature(source))
+
+    def write_manifest(self):
+        from bioscreen.utils import atomic_write
+        with atomic_write(self.cache_dir / 'manifest.json') as f:
+            json.dump(dict(version=CACHE_VERSION, collections=self.manifest), f)
+
+
+def default_cache_dir(directory:Pathy) -> pathlib.Path:
+    from bioscreen.utils import path_cache_dir
+    return path_cache_dir('genesets', directory)
+
+
+def load_tsl_dir(
+        directory:Pathy,
+        collections:Collection[str]=None,
+        set_names:Collection[str]=None,
+        min_size:int=None,
+        max_size:int=None,
+        n_workers:int=None,
+        cache:bool=True,
+        cache_dir:Pathy=None,
+        lazy:bool=False,
+) -> dict[str, Mapping[str, set[str]]]:
+    """Load .tsl files in directory as {collection: {set name: genes}}.
+
+    Args:
+        directory: containing '{collection}.tsl' files.
+        collections: only load these collections.
+        set_names: only include these sets.
+        min_size, max_size: only include sets with this many genes.
+        n_workers: number of processes for parsing files that aren't cached.
+            Defaults to number of CPUs, 1 parses in this process.
+        cache: read and write the binary cache.
+        cache_dir: location of the cache, default is in the user cache
+            directory, see `bioscreen.utils.user_cache_dir`.
+        lazy: return LazyGeneSets, that build each set when it's accessed,
+            rather than dict. With a cache hit, loading is then just
+            memory-mapping the arrays.
+    """
+    directory = pathlib.Path(directory)
+    sources = {collection_name(fn):directory / fn
+               for fn in sorted(os.listdir(directory)) if fn.endswith('.tsl')}
+    if collections is not None:
+        missing = set(collections).difference(sources)
+        if missing:
+            raise FileNotFoundError(f"No .tsl files for collections {sorted(missing)} in {directory}")
+        sources = {k:sources[k] for k in collections}
+
+    tsl_cache = TslCache(cache_dir or default_cache_dir(directory)) if cache else None
+
+    arrays = {}
+    if tsl_cache is not None:
+        for coll, fn in sources.items():
+            cached = tsl_cache.get(coll, fn)
+            if cached is not None:
+                arrays[coll] = cached
+    to_parse = {k:fn for k, fn in sources.items() if k not in arrays}
+
+    if to_parse:
+        logger.info(f"Parsing {len(to_parse)} .tsl files, {len(arrays)} loaded from cache.")
+        if n_workers == 1 or len(to_parse) == 1:
+            parsed = map(parse_tsl, to_parse.values())
+            arrays |= dict(zip(to_parse.keys(), parsed))
+        else:
+            with ProcessPoolExecutor(max_workers=n_workers) as pool:
+                arrays |= dict(zip(to_parse.keys(), pool.map(parse_tsl, to_parse.values())))
+
+        if tsl_cache is not None:
+            try:
+                for coll in to_parse:
+                    tsl_cache.put(coll, to_parse[coll], arrays[coll])
+                tsl_cache.write_manifest()
+            except OSError as err:
+                logger.warning(f"Couldn't write gene set cache to {tsl_cache.cache_dir}: {err}")
+
+    if lazy:
+        return {coll:LazyGeneSets(arrays[coll], _keep_rows(arrays[coll], set_names, min_size, max_size))
+                for coll in sources}
+    return {coll:arrays_to_sets(arrays[coll], set_names, min_size, max_size)
+            for coll in sources}
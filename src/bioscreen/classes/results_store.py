@@ -0,0 +1,174 @@
+"""Binary on-disk format for AnalysisResults.
+
+A store is a directory containing:
+    meta.json: scorekey, comparison & stat keys, and the class it came from.
+    comparisons.json: CompDict.to_df() as a dict.
+    columns.json: StatColumns.to_records().
+    index.npy: the row index.
+    stat.{i}.npy: a (genes × comparisons) array for each stat, saved in
+        Fortran order so that each comparison is contiguous on disk.
+    extra.{i}.npy: single level columns, e.g. 'Collection' in gene set results.
+
+Numeric arrays are memory-mapped when opened, so getting a single
+comparison or stat only reads that part of the files."""
+
+import json
+
+from bioscreen._imports import *
+from bioscreen.classes.base import *
+from bioscreen.classes.comparison import CompDict
+
+__all__ = ['ResultsStore']
+
+STORE_VERSION = 1
+
+
+def _to_saveable(values:np.ndarray) -> np.ndarray:
+    """Convert string arrays to fixed width unicode so they can be memory-mapped."""
+    if values.dtype != object:
+        return values
+    if all(isinstance(v, str) for v in values.ravel()):
+        return values.astype(str)
+    return values
+
+
+class ResultsStore:
+    """Read access to results written by `ResultsStore.write`. Arrays
+    are opened on first use and kept.
+
+    Args:
+        path: store directory.
+        mmap: memory-map the arrays, otherwise they're read fully
+            when first accessed.
+    """
+    def __init__(self, path:Pathy, mmap=True):
+        self.path = pathlib.Path(path)
+        with open(self.path / 'meta.json') as f:
+            self.meta:dict = json.load(f)
+        if self.meta['version'] > STORE_VERSION:
+            raise RuntimeError(f"Store version {self.meta['version']} is newer than "
+                               f"supported version {STORE_VERSION}.")
+        self.comp_keys = pd.Index(self.meta['comparisons'])
+        self.stat_keys:list[str] = self.meta['stats']
+        self.extra_keys:list[str] = self.meta['extra']
+        self.scorekey:str = self.meta['scorekey']
+        self._mmap_mode = 'r' if mmap else None
+        self._arrays = {}
+        self._index = None
+
+    @staticmethod
+    def write(path:Pathy, table:CompsResultDF, comparisons:CompDict,
+              columns:StatColumns, scorekey:str, results_class:str=None):
+        """Write a comparisons results table, and associated info, to
+        the directory `path`."""
+        if not hasattr(table.columns, 'levels'):
+            raise ValueError("Comparisons results table must be multiindexed, by comparison")
+        path = pathlib.Path(path)
+        os.makedirs(path, exist_ok=True)
+
+        # single level columns (added with df.loc[:, 'Col'] = ...) have an empty level 1
+        lvl0 = table.columns.get_level_values(0)
+        lvl1 = table.columns.get_level_values(1)
+        is_extra = lvl1 == ''
+        extra_keys = list(lvl0[is_extra])
+        comp_keys = list(lvl0[~is_extra].unique())
+        stat_keys = list(lvl1[~is_extra].unique())
+
+        for i, stat in enumerate(stat_keys):
+            stat_table = table.loc[:, ~is_extra].xs(stat, level=1, axis=1)
+            stat_table = stat_table.reindex(columns=comp_keys)
+            values = _to_saveable(np.asfortranarray(stat_table.to_numpy()))
+            np.save(path / f'stat.{i}.npy', values, allow_pickle=True)
+
+        for i, k in enumerate(extra_keys):
+            values = _to_saveable(table.loc[:, (k, '')].to_numpy())
+            np.save(path / f'extra.{i}.npy', values, allow_pickle=True)
+
+        np.save(path / 'index.npy', _to_saveable(table.index.to_numpy()),
+                allow_pickle=True)
+
+        compdf = comparisons.to_df().drop('Differential', axis='columns', errors='ignore')
+        with open(path / 'comparisons.json', 'w') as f:
+            json.dump(compdf.to_dict(orient='index'), f, default=str)
+
+        with open(path / 'columns.json', 'w') as f:
+            json.dump(columns.to_records(), f)
+
+        meta = dict(
+            version=STORE_VERSION,
+            results_class=results_class,
+            scorekey=scorekey,
+            comparisons=comp_keys,
+            stats=stat_keys,
+            extra=extra_keys,
+            index_name=table.index.name,
+        )
+        with open(path / 'meta.json', 'w') as f:
+            json.dump(meta, f)
+
+    def _load(self, fn:str) -> np.ndarray:
+        if fn not in self._arrays:
+            try:
+                arr = np.load(self.path / fn, mmap_mode=self._mmap_mode)
+            except ValueError:
+                # object arrays can't be memory-mapped
+                arr = np.load(self.path / fn, allow_pickle=True)
+            self._arrays[fn] = arr
+        return self._arrays[fn]
+
+    def _stat_array(self, key:str) -> np.ndarray:
+        return self._load(f'stat.{self.stat_keys.index(key)}.npy')
+
+    @property
+    def index(self) -> pd.Index:
+        if self._index is None:
+            self._index = pd.Index(np.array(self._load('index.npy')),
+                                   name=self.meta['index_name'])
+        return self._index
+
+    def comparisons(self) -> CompDict:
+        with open(self.path / 'comparisons.json') as f:
+            compdf = pd.DataFrame.from_dict(json.load(f), orient='index')
+        return CompDict.from_df(compdf)
+
+    def columns(self) -> StatColumns:
+        with open(self.path / 'columns.json') as f:
+            return StatColumns.from_records(json.load(f))
+
+    def stat_table(self, key:str) -> pd.DataFrame:
+        """Table of values of a single stat, comparisons as columns."""
+        if key not in self.stat_keys:
+            raise KeyError(key)
+        return pd.DataFrame(
+            np.array(self._stat_array(key)),
+            index=self.index,
+            columns=self.comp_keys.copy(),
+        )
+
+    def comp_table(self, comp:str) -> pd.DataFrame:
+        """Table of all stats for a single comparison."""
+        j = self.comp_keys.get_loc(comp)
+        return pd.DataFrame(
+            {k:np.array(self._stat_array(k)[:, j]) for k in self.stat_keys},
+            index=self.index,
+        )
+
+    def extra_column(self, key:str) -> pd.Series:
+        values = self._load(f'extra.{self.extra_keys.index(key)}.npy')
+        return pd.Series(np.array(values), index=self.index, name=key)
+
+    def load_table(self) -> CompsResultDF:
+        """Read the full multiindexed results table."""
+        table = pd.concat(
+            {comp:self.comp_table(comp) for comp in self.comp_keys},
+            axis='columns'
+        )
+        for k in self.extra_keys:
+            table.loc[:, k] = self.extra_column(k)
+        return table
+
+    def __getstate__(self):
+        # don't pickle memory-mapped arrays
+        state = self.__dict__.copy()
+        state['_arrays'] = {}
+        return state
@@ -5,67 +5,37 @@ enriched GO terms in a hierarchical format similar to the web results.
 
 Currently on supports GOslim biological process because that's the most
 interesting, but should be easy to expand."""
+from __future__ import annotations
 import typing
 
 # API reference
 # http://pantherdb.org/services/openAPISpec.jsp
-import matplotlib.pyplot as plt
+import os
 import pandas as pd
 import numpy as np
-import requests, pickle
-from typing import Collection, List, Tuple, Dict, Any, Literal
+import pickle
+from typing import Collection, List, Tuple, Dict, Any, Literal, Optional
+
+from bioscreen.go_dag import GODag, parse_obo
+
+if typing.TYPE_CHECKING:
+    import requests
+    import matplotlib.pyplot as plt
 
-from pkg_resources import resource_filename
 #gs_fn = resource_filename(__name__, "data/PANTHERGOslim.hierarchy.pickle")
 
 
 def parse_go_hierarchy(obo_fn, output_pickle_fn=None):
     """Using an OBO file, parse GO term hierarchy.
 
-    Format as a mapping {parent_id1:[child_id1, child_id2, ...], ...]
-    IDs are integers...
-
-    Check the output too, this is some fragile code."""
-
-    goslim_hierarchy = {}
-
-    parent_ids = []
-    daughter_id = 0
-    parsing_active = False # True when '[Term]\n' encountered
-    with open(obo_fn) as f:
-        for line in f:
-            if line == '[Term]\n':
-                parsing_active = True
-                # record the previous
-                if daughter_id:
-                    goslim_hierarchy[daughter_id] = parent_ids
-
-                parent_ids = []
-                line = next(f)
-
-                # go
-                if not line.startswith('id: '):
-                    raise RuntimeError('OBO file not in the expected order, this data format is awful.')
-                daughter_id = line.strip().replace('id: ', '')
+    Format as a mapping {child_id1:[parent_id1, parent_id2, ...], ...]
+    with is_a parents, in the order of the file.
 
-            if line.startswith('is_a:') and parsing_active:
-                pid = line.replace('is_a: ', '').split(' !')[0]
-                parent_ids.append(pid)
-
-            # These were all at the end when I checked, but I_guess there's no guarantee
-            #    it breaks if you keep going here, as the 'is_a: ` statements stop being
-            #    GO:numbers
-            if line == '[Typedef]\n':
-                parsing_active = False
-
-    # # check there weren't extra
-    # n = 0
-    # for l in open(obo_fn):
-    #     if l.startswith('[Term]'):
-    #         n += 1
-    #
-
-    goslim_hierarchy[daughter_id] = parent_ids
+    For querying the hierarchy, `load_go_dag` is much faster."""
+    parsed = parse_obo(obo_fn)
+    goslim_hierarchy = {term:[] for term in parsed['ids']}
+    for child, parent in parsed['edges']:
+        goslim_hierarchy[child].append(parent)
 
     if output_pickle_fn is not None:
 
@@ -96,6 +66,41 @@ def load_hierarchy(gs_fn:typing.Union[dict, str]):
     return goslim_hierarchy
 
 
+def load_go_dag(hierarchy:typing.Union[GODag, dict, str]) -> GODag:
+    """Get a GODag from an OBO file (compiled and cached, see `GODag.load`),
+    a directory written by `GODag.save`, a pickle written by
+    `parse_go_hierarchy` or its dict."""
+    if isinstance(hierarchy, GODag):
+        return hierarchy
+    if isinstance(hierarchy, dict):
+        return GODag.from_parent_map(hierarchy)
+    if str(hierarchy).endswith('.obo'):
+        return GODag.load(hierarchy)
+    if os.path.isdir(hierarchy):
+        return GODag.from_dir(hierarchy)
+    return GODag.from_parent_map(load_hierarchy(str(hierarchy)))
+
+
+_ANNOT_DATASETS = {
+    'bp': "ANNOT_TYPE_ID_PANTHER_GO_SLIM_BP",
+    'mf': "ANNOT_TYPE_ID_PANTHER_GO_SLIM_MF",
+    'cc': "ANNOT_TYPE_ID_PANTHER_GO_SLIM_CC",
+    'cl': "ANNOT_TYPE_ID_PANTHER_GO_SLIM_CC",
+    'pc': "ANNOT_TYPE_ID_PANTHER_PC",
+    'pp': "ANNOT_TYPE_ID_PANTHER_PATHWAY",
+    'rp': "ANNOT_TYPE_ID_REACTOME_PATHWAY",
+}
+PANTHER_URL = "http://pantherdb.org/services/oai/pantherdb/enrich/overrep"
+
+
+def _annot_dataset(annot_type:str) -> str:
+    try:
+        return _ANNOT_DATASETS[annot_type]
+    except KeyError:
+        raise RuntimeError(f"Annotation type of '{annot_type}' not recognised, see"
+                           " documentation (i.e. this function's docstring) for details.")
+
+
 def query_panther(gene_list:Collection[str], reference_list:Collection[str]=None,
                   annot_type:Literal["bp", "mf", "pc", "cc", "cl", "pp", "rp"]='bp') -> requests.Response:
     """Get enrichment results from PANTHER service.
@@ -112,33 +117,281 @@ def query_panther(gene_list:Collection[str], reference_list:Collection[str]=None
             pp - PANTHER pathway
             rp - Reactome pathway
 
-    Use `parse_results` to get tables etc. from returned `Response`
+    Use `parse_results` to get tables etc. from returned `Response`. For
+    cached, batched or offline queries see `query_panther_json`.
     """
-    urlfmt = "http://pantherdb.org/services/oai/pantherdb/enrich/overrep?geneInputList={geneList}&organism=9606&annotDataSet={annot}&enrichmentTestType=FISHER&correction=FDR"
+    urlfmt = PANTHER_URL + "?geneInputList={geneList}&organism=9606&annotDataSet={annot}&enrichmentTestType=FISHER&correction=FDR"
     geneList = ','.join(gene_list)
-    if annot_type == 'bp':
-        annot= "ANNOT_TYPE_ID_PANTHER_GO_SLIM_BP"
-    elif annot_type == 'mf':
-        annot = "ANNOT_TYPE_ID_PANTHER_GO_SLIM_MF"
-    elif annot_type in ('cc', 'cl'):
-        annot = "ANNOT_TYPE_ID_PANTHER_GO_SLIM_CC"
-    elif annot_type == 'pc':
-        annot = "ANNOT_TYPE_ID_PANTHER_PC"
-    elif annot_type == 'pp':
-        annot = "ANNOT_TYPE_ID_PANTHER_PATHWAY"
-    elif annot_type == 'rp':
-        annot = "ANNOT_TYPE_ID_REACTOME_PATHWAY"
-    else:
-        raise RuntimeError(f"Annotation type of '{annot_type}' not recognised, see"
-                           " documentation (i.e. this function's docstring) for details.")
+    annot = _annot_dataset(annot_type)
     query_url = urlfmt.format(annot=annot, geneList=geneList)
     if reference_list is not None:
         query_url = query_url + '&refOrganism=9606&refInputList=' + ','.join(reference_list)
+    import requests
     res = requests.get(query_url)
     if res.status_code != 200:
         raise requests.ConnectionError(f"Query failed, status code: {res.status_code}. Query URL:\n{query_url}")
     return res
 
+
+class _RateLimiter:
+    """Space calls to wait() at least 1/max_per_second apart, across threads."""
+    def __init__(self, max_per_second:float=None):
+        import threading
+        self.interval = 0. if not max_per_second else 1 / max_per_second
+        self._lock = threading.Lock()
+        self._next = 0.
+
+    def wait(self):
+        if not self.interval:
+            return
+        import time
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next)
+            self._next = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+
+class PantherAPI:
+    """Backend querying pantherdb.org. Gene lists are POSTed, so they
+    aren't limited by URL length, over one pooled session that is safe
+    to share between threads.
+
+    Args:
+        organism: taxon ID.
+        pool_size: connections kept open.
+        max_per_second: rate limit on requests, shared by all threads.
+        timeout: seconds.
+    """
+    def __init__(self, organism='9606', pool_size=8, max_per_second:float=5., timeout=120):
+        self.organism = organism
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.rate_limiter = _RateLimiter(max_per_second)
+        self._session = None
+
+    @property
+    def cache_id(self) -> str:
+        return f"pantherdb.org:{self.organism}"
+
+    @property
+    def session(self):
+        if self._session is None:
+            import requests
+            self._session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=self.pool_size,
+                                                    pool_maxsize=self.pool_size)
+            self._session.mount('http://', adapter)
+            self._session.mount('https://', adapter)
+        return self._session
+
+    def query(self, gene_list:Collection[str], reference_list:Collection[str]=None,
+              annot_type='bp') -> dict:
+        params = dict(geneInputList=','.join(gene_list), organism=self.organism,
+                      annotDataSet=_annot_dataset(annot_type),
+                      enrichmentTestType='FISHER', correction='FDR')
+        if reference_list is not None:
+            params |= dict(refOrganism=self.organism, refInputList=','.join(reference_list))
+        self.rate_limiter.wait()
+        res = self.session.post(PANTHER_URL, data=params, timeout=self.timeout)
+        if res.status_code != 200:
+            import requests
+            raise requests.ConnectionError(f"PANTHER query failed, status code: {res.status_code}")
+        return res.json()
+
+
+class LocalPantherBackend:
+    """Backend answering PANTHER overrepresentation queries from a local
+    annotation table, without network access. Returns JSON in the format of
+    pantherdb.org, so results go through `parse_results` in the same way.
+
+    Terms are tested for over-representation with a one-sided
+    hypergeometric test (see `bioscreen.ora`), FDR is Benjamini-Hochberg.
+    The reference defaults to all annotated genes.
+
+    Args:
+        annotations: table, or tab separated file, with columns for genes,
+            term IDs and, optionally, term labels and annotation type
+            (bp, mf etc, as query_panther). Without an annotation type
+            column every term is used for every annot_type.
+        gene_col, term_col, label_col, annot_col: column names.
+    """
+    def __init__(self, annotations:typing.Union[pd.DataFrame, str, os.PathLike],
+                 gene_col='Gene', term_col='GO_ID', label_col='GO_label', annot_col='AnnotType'):
+        self.source = str(annotations) if not isinstance(annotations, pd.DataFrame) else 'DataFrame'
+        if not isinstance(annotations, pd.DataFrame):
+            annotations = pd.read_csv(annotations, sep='\t', dtype=str)
+        self.annotations = annotations
+        self.gene_col, self.term_col = gene_col, term_col
+        self.label_col, self.annot_col = label_col, annot_col
+        self._collections = {}
+
+    @property
+    def cache_id(self) -> str:
+        return f"local:{self.source}"
+
+    def _collection(self, annot_type:str):
+        """{term: genes} for annot_type, as GeneSetCollections."""
+        if annot_type not in self._collections:
+            from bioscreen.classes.geneset_cls import GeneSetCollections
+            annot = self.annotations
+            if self.annot_col in annot.columns:
+                annot = annot.loc[annot[self.annot_col] == annot_type]
+            sets = annot.groupby(self.term_col)[self.gene_col].agg(set).to_dict()
+            self._collections[annot_type] = GeneSetCollections({annot_type:sets})
+        return self._collections[annot_type]
+
+    def labels(self) -> dict[str, str]:
+        if self.label_col not in self.annotations.columns:
+            return {}
+        return self.annotations.drop_duplicates(self.term_col).set_index(self.term_col)[self.label_col].to_dict()
+
+    def query(self, gene_list:Collection[str], reference_list:Collection[str]=None,
+              annot_type='bp') -> dict:
+        from bioscreen.ora import ora
+        collection = self._collection(annot_type)
+        if reference_list is None:
+            reference_list = self.annotations[self.gene_col].unique()
+        reference = set(reference_list)
+        genes = [g for g in dict.fromkeys(gene_list) if g in reference]
+
+        table = ora({'list':genes}, collection, universe=reference)['list']
+        labels = self.labels()
+        groups = []
+        for term, row in table.sort_values('p').iterrows():
+            groups.append({
+                'number_in_list': int(row.Overlap),
+                'fold_enrichment': float(row.FoldEnrichment),
+                'fdr': float(row.FDR),
+                'expected': float(row.Expected),
+                'number_in_reference': int(row.Size),
+                'pValue': float(row.p),
+                'plus_minus': '+' if row.Overlap >= row.Expected else '-',
+                'term': {'id':term, 'label':labels.get(term, term)},
+            })
+        return {
+            'search': {'search_type': 'overrepresentation', 'annotDataSet': annot_type,
+                       'fdr': True, 'test_type': 'HYPERGEOMETRIC', 'backend': self.cache_id},
+            'reference': {'mapped_count': len(reference)},
+            'input_list': {'mapped_count': len(genes),
+                           'unmapped_count': len(set(gene_list)) - len(genes)},
+            'overrepresentation': {'group': groups},
+        }
+
+
+class PantherCache:
+    """On-disk store of PANTHER query results (JSON), keyed on the gene list,
+    reference list, annotation type and backend. Entries older than ttl
+    seconds are ignored and replaced.
+
+    Attributes:
+        hits, misses: counts of get() results.
+    """
+    def __init__(self, directory, ttl:float=30 * 24 * 3600):
+        import pathlib
+        self.directory = pathlib.Path(directory)
+        self.ttl = ttl
+        os.makedirs(self.directory, exist_ok=True)
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(gene_list:Collection[str], reference_list:Optional[Collection[str]],
+            annot_type:str, backend_id:str) -> str:
+        import hashlib
+        h = hashlib.blake2b(digest_size=16)
+        # order doesn't change results
+        for thing in (sorted(set(gene_list)),
+                      None if reference_list is None else sorted(set(reference_list)),
+                      annot_type, backend_id):
+            h.update(repr(thing).encode())
+        return h.hexdigest()
+
+    def _fn(self, key):
+        return self.directory / f"{key}.json"
+
+    def get(self, key:str) -> Optional[dict]:
+        import json, time
+        fn = self._fn(key)
+        try:
+            with open(fn) as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            self.misses += 1
+            return None
+        if time.time() - entry['time'] > self.ttl:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry['result']
+
+    def put(self, key:str, result:dict):
+        import json, tempfile, time
+        # write then rename, so concurrent readers never see partial files.
+        #   Temp names are unique, as threads may write the same key.
+        with tempfile.NamedTemporaryFile('w', dir=self.directory, suffix='.tmp',
+                                         delete=False) as f:
+            json.dump(dict(time=time.time(), result=result), f)
+        os.replace(f.name, self._fn(key))
+
+    def clear_expired(self):
+        import time
+        for fn in self.directory.glob('*.json'):
+            if time.time() - fn.stat().st_mtime > self.ttl:
+                fn.unlink(missing_ok=True)
+
+
+def query_panther_json(gene_list:Collection[str], reference_list:Collection[str]=None,
+                       annot_type:Literal["bp", "mf", "pc", "cc", "cl", "pp", "rp"]='bp',
+                       backend:typing.Union[PantherAPI, LocalPantherBackend]=None,
+                       cache:PantherCache=None) -> dict:
+    """PANTHER overrepresentation results JSON, from cache if available.
+
+    Args:
+        gene_list, reference_list, annot_type: see `query_panther`.
+        backend: PantherAPI (default) or LocalPantherBackend.
+        cache: optional PantherCache.
+    """
+    if backend is None:
+        backend = PantherAPI()
+    key = None
+    if cache is not None:
+        key = cache.key(gene_list, reference_list, annot_type, backend.cache_id)
+        result = cache.get(key)
+        if result is not None:
+            return result
+    result = backend.query(gene_list, reference_list, annot_type)
+    if cache is not None:
+        cache.put(key, result)
+    return result
+
+
+def query_panther_batch(gene_lists:typing.Mapping[str, Collection[str]],
+                        reference_list:Collection[str]=None,
+                        annot_type:Literal["bp", "mf", "pc", "cc", "cl", "pp", "rp"]='bp',
+                        backend:typing.Union[PantherAPI, LocalPantherBackend]=None,
+                        cache:PantherCache=None,
+                        n_workers:int=4) -> dict[str, dict]:
+    """`query_panther_json` for many gene lists concurrently, in a thread
+    pool sharing the backend's connection pool and rate limit.
+
+    Returns:
+        {name: results JSON}, in the order of gene_lists. Failed queries
+        raise after every query has finished.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    if backend is None:
+        backend = PantherAPI(pool_size=n_workers)
+
+    def run(genes):
+        return query_panther_json(genes, reference_list, annot_type, backend, cache)
+
+    with ThreadPoolExecutor(max_workers=n_workers) as pool:
+        futures = {k:pool.submit(run, genes) for k, genes in gene_lists.items()}
+    return {k:f.result() for k, f in futures.items()}
+
+
 def parse_panther_json_to_df(pnthr_json, fdr_threshold=1):
     sig_res = []
     try:
@@ -184,9 +437,11 @@ def _term_hierarchy_from_df(go_results:pd.DataFrame,
 
 
 def term_hierarchy(go_series:pd.Series,
-                   hierarchy_fn:str, ) -> List[Dict[int, Any]]:
+                   hierarchy_fn:typing.Union[GODag, dict, str], ) -> List[Dict[int, Any]]:
     """Get the structure of the hierarchical from selected GO terms in go_series.
 
+    hierarchy_fn: anything accepted by `load_go_dag`.
+
     Returns a recursive list of dicts containing lists of dicts; keys are more
     specific GOID paired with lists of less specific GOID
 
@@ -194,41 +449,44 @@ def term_hierarchy(go_series:pd.Series,
 
     Pass to `transcribe_structure()` to get the actual table with the results."""
 
-    goslim_hierarchy = load_hierarchy(hierarchy_fn)
-
-    present_ids = go_series#.apply(intgo)
+    dag = load_go_dag(hierarchy_fn)
+    terms = go_series.tolist()
 
-    cnxns = go_series.apply(lambda x: [i for i in goslim_hierarchy[x] if i in present_ids.values])
-    cnxns.index = go_series#.apply(intgo)
-
-    # We need to reverse the direction of these associations, maybe should do that
-    #   in the original goslim_hierachy, but haven't
-    rcnx = pd.Series(index=present_ids.values)
-    rcnx = rcnx.apply(lambda x: [])
-
-    for gid, lst in cnxns.items():
-        for g in lst:
-            rcnx[g].append(gid)
+    # parents of each term that are also in go_series, as positions
+    child, parent = dag.parent_pairs_within(terms)
+    parents_of = [[] for _ in terms]
+    for c, p in zip(child.tolist(), parent.tolist()):
+        parents_of[c].append(p)
 
     # Get the most specific term, these have no other term pointing to them
-    top = rcnx.loc[rcnx.apply(len) == 0]
-
-    def get_next_one(go):
-        node = {go: []}
-        for hit in cnxns[go]:
-            next_hit = get_next_one(hit)
-            node[go].append(next_hit)
-        return node
-
-    structure = [get_next_one(g) if get_next_one(g) is not None else {g:[]} for g in top.index]
-
-    return structure
+    is_parent = np.zeros(len(terms), dtype=bool)
+    is_parent[parent] = True
+
+    # Build each term's node once, parents before children, with an
+    #   iterative DFS. Nodes of shared parents are the same object in
+    #   every branch they appear in.
+    nodes = [None] * len(terms)
+    for start in np.flatnonzero(~is_parent).tolist():
+        stack = [start]
+        while stack:
+            i = stack[-1]
+            if nodes[i] is not None:
+                stack.pop()
+                continue
+            todo = [p for p in parents_of[i] if nodes[p] is None]
+            if todo:
+                stack.extend(todo)
+                continue
+            stack.pop()
+            nodes[i] = {terms[i]:[nodes[p] for p in parents_of[i]]}
+
+    return [nodes[i] for i in np.flatnonzero(~is_parent).tolist()]
 
 
 def transcribe_structure(
         structure:List[Dict[int, Any]],
         go_results:pd.DataFrame,
-        label_col:str,
+        label_col:str='GO_label',
 ) -> Tuple[pd.DataFrame, List[str]]:
 
     """Take a structure generated by `term_hierarchy_from_df` and return TWO tables
@@ -236,35 +494,50 @@ def transcribe_structure(
 
     Label col should probably indicate the Term name."""
 
-    # will be modified by iter_struct below
-    out_table = [go_results.columns.tolist() + ['Level']]
+    # rows & labels looked up by GO ID once, rather than per row
+    row_of = {gid:i for i, gid in enumerate(go_results.index)}
+    values = go_results.to_numpy(dtype=object)
+    labels = go_results[label_col].tolist()
+
+    out_table = []
     str_table = ['GO label hierarchy']
+    seen_str = set(str_table)
 
-    # parse the string row for str_Table
-    def str_level(goid, level=0):
-        s = go_results.loc[goid, label_col]
-        if level == 0:
-            prefix = ''
-        else:
-            prefix = ' ' + '+ ' * level
-        return prefix + s
-
-    # go through the structure, generating rows and strings for the returned tables
-    def iter_struct(d, level=0):
+    # depth first, in the order of the structure
+    stack = [(d, 0) for d in reversed(structure)]
+    while stack:
+        d, level = stack.pop()
         for gid, next_levels in d.items():
-            s = str_level(gid, level)
-            if not s in str_table:
+            i = row_of[gid]
+            s = labels[i] if level == 0 else ' ' + '+ ' * level + labels[i]
+            if s not in seen_str:
+                seen_str.add(s)
                 str_table.append(s)
-            row_vals = list(go_results.loc[gid].values)
-            row_vals.append(level)
-
-            out_table.append(row_vals)
-            for next_d in next_levels:
-                iter_struct(next_d, level=level + 1)
-
-    for rows in structure:
-        iter_struct(rows)
-    return pd.DataFrame(out_table[1:], columns=out_table[0]), str_table
+            out_table.append(list(values[i]) + [level])
+            stack.extend((next_d, level + 1) for next_d in reversed(next_levels))
+
+    return pd.DataFrame(out_table, columns=go_results.columns.tolist() + ['Level']), str_table
+
+
+def _benchmark_term_hierarchy(obo_fn, n_terms=(100, 1000, 5000), seed=0):
+    """Time term_hierarchy and transcribe_structure on random sets of
+    terms from obo_fn, (e.g. go-basic.obo), with a PANTHER-like results
+    table, printing the time taken for each size."""
+    import time
+    dag = load_go_dag(obo_fn)
+    rng = np.random.default_rng(seed)
+    ids = np.asarray(dag.ids)[~np.asarray(dag.obsolete)]
+    for n in n_terms:
+        terms = rng.choice(ids, min(n, len(ids)), replace=False)
+        results = pd.DataFrame({'GO_ID': terms, 'GO_label': dag.names(terms),
+                                'fdr': rng.random(len(terms))}, index=terms)
+        t0 = time.perf_counter()
+        structure = term_hierarchy(results.GO_ID, dag)
+        t1 = time.perf_counter()
+        table, _ = transcribe_structure(structure, results, 'GO_label')
+        t2 = time.perf_counter()
+        print(f"{n} terms, {len(table)} rows: term_hierarchy {t1 - t0:.3f}s, "
+              f"transcribe_structure {t2 - t1:.3f}s")
 
 
 def parse_results(res_json, hierarchy_fn:str, fdr_threshold=0.1):
@@ -290,9 +563,16 @@ def parse_results(res_json, hierarchy_fn:str, fdr_threshold=0.1):
 
 def query_panther_and_parse_results(gene_list:Collection[str],
                                     reference_list:Collection[str]=None,
-                                    fdr_threshold=0.1) -> Dict:
+                                    fdr_threshold=0.1,
+                                    hierarchy_fn:typing.Union[GODag, dict, str]=None,
+                                    annot_type='bp',
+                                    backend:typing.Union[PantherAPI, LocalPantherBackend]=None,
+                                    cache:PantherCache=None) -> Dict:
     """Query PANTHERdb using a gene list and return parsed results.
 
+    hierarchy_fn is required, see `term_hierarchy`. backend and cache, see
+    `query_panther_json`.
+
      Returns dict with keys:
         'json': full results JSON obtained from pantherdb.org,
         'full_table': the JSON in the form of a dataFrame,
@@ -302,8 +582,11 @@ def query_panther_and_parse_results(gene_list:Collection[str],
     If you wish to refilter the results with a different fdr_threshold, pass
     the JSON to `parse_results` to avoid requerying pantherdb.org. parse_results
     Has the same return value."""
-    response = query_panther(gene_list, reference_list=reference_list)
-    return parse_results(response.json(), fdr_threshold=fdr_threshold)
+    if hierarchy_fn is None:
+        raise ValueError("hierarchy_fn required, e.g. a GO OBO file.")
+    res_json = query_panther_json(gene_list, reference_list, annot_type,
+                                  backend=backend, cache=cache)
+    return parse_results(res_json, hierarchy_fn, fdr_threshold=fdr_threshold)
 
 def _test(genes = None, ):
     if genes is None:
@@ -321,6 +604,7 @@ def plot_enrichment_table(tab:pd.DataFrame, filename=None) -> (plt.Figure, plt.A
     """Plot the terms in `tab`, in the order the appear.
 
     Write image if filename given."""
+    import matplotlib.pyplot as plt
     import seaborn as sns
     fdr = tab.FDR.apply(lambda x: -np.log10(x))
     yrange = range(tab.shape[0])
@@ -1,7 +1,44 @@
-import gseapy
+"""Gene set enrichment analysis (GSEA) of ranked scores.
+
+`gsea_prerank` is a native preranked GSEA, following the algorithm of
+gseapy.prerank. The scores are ranked once; the hits of every gene set are
+positions in that ranking, so running-sum enrichment scores (ES) are
+calculated from the sorted hit positions of all sets of the same size at
+once, without building running sums over the whole ranking. The null ES
+are calculated for random sets of each size once, and shared by every set
+of that size, across collections."""
+
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
 from bioscreen._imports import *
+from bioscreen.classes.base import StatColumns, logger
+from bioscreen.classes.comparison import CompDict
+from bioscreen.classes.results import AnalysisResults, add_log10_sig_cols_all
+from bioscreen.classes.geneset_cls import GeneSetCollections, GeneSetEnrichmentResults
+from bioscreen.classes.geneset_index import GeneSetIndex
 from jttools.data_wrangling import write_stats_workbook
 
+GSEACOLS = ['GeneSetCollection', 'Term', 'ES', 'NES', 'pNOM', 'FDR', 'FWER',
+            'LeadingLen', 'Size', 'PercLeadingAll', 'LeadGenes']
+
+_gseastatcols = [
+    {'original': 'ES', 'key': 'ES', 'label': 'Enrichment score', 'table': 'ES'},
+    {'original': 'NES', 'key': 'NES', 'label': 'Normalised enrichment score', 'table': 'NES'},
+    {'original': 'pNOM', 'key': 'pNOM', 'label': 'Nominal p-value', 'table': 'p'},
+    {'original': 'FDR', 'key': 'FDR', 'label': 'FDR', 'table': 'FDR'},
+    {'original': 'FWER', 'key': 'FWER', 'label': 'FWER', 'table': 'FWER'},
+    {'original': 'LeadingLen', 'key': 'LeadingLen', 'label': 'Leading edge genes',
+     'table': 'Leading edge'},
+    {'original': 'Size', 'key': 'Size', 'label': 'Set size', 'table': 'Size'},
+    {'original': 'PercLeadingAll', 'key': 'PercLeadingAll', 'label': '% of ranking in leading edge',
+     'table': '% ranking'},
+    {'original': 'LeadGenes', 'key': 'LeadGenes', 'label': 'Leading edge gene list',
+     'table': 'Leading genes'},
+    {'original': 'FDR10', 'key': 'FDR10', 'label': '-log10(FDR)', 'table': '-log10(FDR)'},
+]
+GSEASTATCOLS = StatColumns.from_records(_gseastatcols)
+
 def format_gseapy_res2d(table):
     """Rename columns, split the "tag" column into LeadingLen and Size."""
     t = table.copy()
@@ -26,18 +63,390 @@ def score_signed_p10(res:pd.DataFrame) -> pd.Series:
     score = score.sort_values()
     return score
 
-def gsea_prerank_analysis(
+def _running_es(positions:np.ndarray, weights:np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """Enrichment scores of sets given by the sorted positions of their hits
+    in the ranking, positions.shape == (n sets, set size).
+
+    The running sum only changes direction at hits, so its maximum is at a
+    hit and its minimum is just before one. At hit j (0 indexed) at position
+    p, the sum is cumulative hit weight/total hit weight - (p - j)/misses.
+
+    Returns:
+        ES, and the index of the hit at the peak (max) or just after the
+        trough (min) of the running sum.
+    """
+    n_sets, m = positions.shape
+    n_misses = len(weights) - m
+    hit_w = weights[positions]
+    cum_w = np.cumsum(hit_w, axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        hit_w /= cum_w[:, -1:]
+        cum_w /= cum_w[:, -1:]
+    top = cum_w - (positions - np.arange(m)) / n_misses
+    bottom = top - hit_w
+
+    rows = np.arange(n_sets)
+    i_max = top.argmax(axis=1)
+    i_min = bottom.argmin(axis=1)
+    es_max = top[rows, i_max]
+    es_min = bottom[rows, i_min]
+    is_max = np.abs(es_max) > np.abs(es_min)
+    return np.where(is_max, es_max, es_min), np.where(is_max, i_max, i_min)
+
+
+def _count_beyond(sorted_null:np.ndarray, values:np.ndarray, positive:np.ndarray) -> np.ndarray:
+    """Count of sorted_null >= value where positive, else <= value."""
+    ge = len(sorted_null) - np.searchsorted(sorted_null, values, side='left')
+    le = np.searchsorted(sorted_null, values, side='right')
+    return np.where(positive, ge, le)
+
+
+def gsea_prerank(
         scores:pd.Series,
-        gene_set_collections:dict[str, dict[str, list[str]]]
+        collections:GeneSetCollections | GeneSetIndex,
+        permutation_num:int=1000,
+        weight:float=1.,
+        min_size:int=15,
+        max_size:int=500,
+        seed:int=123,
+) -> pd.DataFrame:
+    """Preranked GSEA of scores against every set in collections.
+
+    Follows gseapy.prerank with gene set permutation: NES are ES divided by
+    the mean null ES of the same sign; FDR is calculated per collection from
+    the NES of all sets; FWER is the fraction of permutations where the most
+    extreme null NES of any set in the collection is beyond the NES.
+
+    Args:
+        scores: indexed by gene, duplicated genes after the first (by
+            descending score) and NaN are dropped.
+        collections: GeneSetCollections, or its index.
+        permutation_num: number of random sets in each null.
+        weight: hits in the running sum are weighted by |score|**weight.
+        min_size, max_size: only test sets with this many genes in scores.
+        seed: random seed for the null.
+
+    Returns:
+        Table with columns GSEACOLS, as gsea_prerank_analysis, sorted by
+        FDR. LeadingLen, Size and PercLeadingAll are numbers.
+    """
+    index = collections if isinstance(collections, GeneSetIndex) else \
+        GeneSetCollections(collections).index
+
+    # rank once
+    scores = scores.dropna()
+    order = np.argsort(-scores.to_numpy(dtype=np.float64), kind='stable')
+    ranking = scores.iloc[order]
+    if ranking.index.duplicated().any():
+        logger.warning(f"{ranking.index.duplicated().sum()} duplicated genes in scores, keeping highest.")
+        ranking = ranking[~ranking.index.duplicated()]
+    n_genes = len(ranking)
+    weights = np.abs(ranking.to_numpy(dtype=np.float64)) ** weight
+
+    # positions in the ranking of each set's genes, sorted within set
+    rank_of_id = np.full(index.n_genes, -1, dtype=np.int64)
+    ids = index.gene_ids(ranking.index)
+    rank_of_id[ids[ids >= 0]] = np.flatnonzero(ids >= 0)
+    hit_pos = rank_of_id[index.indices]
+    in_ranking = hit_pos >= 0
+    set_rows = index.nnz_rows[in_ranking]
+    keys = np.sort(set_rows.astype(np.int64) * n_genes + hit_pos[in_ranking])
+    hit_pos = keys % max(n_genes, 1)
+    sizes = np.bincount(set_rows, minlength=index.n_sets)
+    starts = np.zeros(index.n_sets + 1, dtype=np.int64)
+    np.cumsum(sizes, out=starts[1:])
+
+    tested = np.flatnonzero((sizes >= min_size) & (sizes <= max_size) & (sizes < n_genes))
+    if not len(tested):
+        logger.warning("No gene sets pass size filters.")
+        return pd.DataFrame(columns=GSEACOLS)
+    tsizes = sizes[tested]
+    unique_sizes, size_i = np.unique(tsizes, return_inverse=True)
+
+    # random sets, the first m of each row are a random set of size m
+    rng = np.random.default_rng(seed)
+    null_sets = np.stack([rng.choice(n_genes, size=unique_sizes[-1], replace=False, shuffle=True)
+                          for _ in range(permutation_num)])
+
+    n_tested = len(tested)
+    es = np.empty(n_tested)
+    peak = np.empty(n_tested, dtype=np.int64)
+    null = np.empty((len(unique_sizes), permutation_num))
+    for u, m in enumerate(unique_sizes):
+        members = np.flatnonzero(size_i == u)
+        rows = tested[members]
+        positions = hit_pos[starts[rows][:, None] + np.arange(m)]
+        es[members], peak[members] = _running_es(positions, weights)
+        null[u] = _running_es(np.sort(null_sets[:, :m], axis=1), weights)[0]
+
+    # normalise by the mean of null ES with the same sign
+    with np.errstate(invalid='ignore', divide='ignore'):
+        is_pos = null >= 0
+        pos_mean = np.where(is_pos, null, 0).sum(1) / is_pos.sum(1)
+        neg_mean = -np.where(is_pos, 0, null).sum(1) / (~is_pos).sum(1)
+        nes = np.where(es >= 0, es / pos_mean[size_i], es / neg_mean[size_i])
+        null_nes = np.where(null >= 0, null / pos_mean[:, None], null / neg_mean[:, None])
+
+    # nominal p, null with the same sign as ES beyond it
+    positive = es >= 0
+    pnom = np.empty(n_tested)
+    sorted_null = np.sort(null, axis=1)
+    for u in range(len(unique_sizes)):
+        members = np.flatnonzero(size_i == u)
+        s = sorted_null[u]
+        n_pos = len(s) - np.searchsorted(s, 0, side='left')
+        beyond = _count_beyond(s, es[members], positive[members])
+        with np.errstate(invalid='ignore', divide='ignore'):
+            pnom[members] = beyond / np.where(positive[members], n_pos, len(s) - n_pos)
+
+    # FDR & FWER within each collection, null NES of every tested set
+    #   come from the shared null of its size
+    fdr = np.empty(n_tested)
+    fwer = np.empty(n_tested)
+    pos_nes = nes >= 0
+    sorted_null_nes = np.sort(null_nes, axis=1)
+    colls = index.set_collection[tested]
+    for ci in np.unique(colls):
+        members = np.flatnonzero(colls == ci)
+        q = nes[members]
+        qpos = pos_nes[members]
+        size_count = np.bincount(size_i[members], minlength=len(unique_sizes))
+
+        null_beyond = np.zeros(len(members))
+        null_pos = 0
+        for u in np.flatnonzero(size_count):
+            s = sorted_null_nes[u]
+            null_beyond += size_count[u] * _count_beyond(s, q, qpos)
+            null_pos += size_count[u] * (len(s) - np.searchsorted(s, 0, side='left'))
+        null_all = size_count.sum() * permutation_num
+        null_same_sign = np.where(qpos, null_pos, null_all - null_pos)
+
+        obs = np.sort(q)
+        obs_beyond = _count_beyond(obs, q, qpos)
+        obs_pos = len(obs) - np.searchsorted(obs, 0, side='left')
+        obs_same_sign = np.where(qpos, obs_pos, len(obs) - obs_pos)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            fdr[members] = np.minimum(
+                (null_beyond / null_same_sign) / (obs_beyond / obs_same_sign), 1.
+            )
+
+        present = np.flatnonzero(size_count)
+        max_null = np.sort(null_nes[present].max(axis=0))
+        min_null = np.sort(null_nes[present].min(axis=0))
+        fwer[members] = np.where(
+            qpos,
+            _count_beyond(max_null, q, True),
+            _count_beyond(min_null, q, False),
+        ) / permutation_num
+
+    # leading edge, hits up to the peak, or from the trough
+    lead_start = np.where(positive, 0, peak)
+    lead_len = np.where(positive, peak + 1, tsizes - peak)
+    peak_pos = hit_pos[starts[tested] + peak]
+    perc_leading = np.where(positive, peak_pos + 1, n_genes - peak_pos + 1) / n_genes * 100
+    genes = ranking.index.to_numpy(dtype=object).astype(str)
+    lead_genes = []
+    for row, a, n, p in zip(tested, lead_start, lead_len, positive):
+        lead = genes[hit_pos[starts[row] + a:starts[row] + a + n]]
+        lead_genes.append(';'.join(lead if p else lead[::-1]))
+
+    table = pd.DataFrame({
+        'GeneSetCollection': np.asarray(index.collections, dtype=object)[colls],
+        'Term': index.set_names[tested],
+        'ES': es,
+        'NES': nes,
+        'pNOM': pnom,
+        'FDR': fdr,
+        'FWER': fwer,
+        'LeadingLen': lead_len,
+        'Size': tsizes,
+        'PercLeadingAll': perc_leading,
+        'LeadGenes': lead_genes,
+    })
+    return table.sort_values('FDR', ascending=True, kind='stable').reset_index(drop=True)
+
+
+_worker_index:GeneSetIndex = None
+
+
+def _init_gsea_worker(index:GeneSetIndex):
+    global _worker_index
+    _worker_index = index
+
+
+def _timed_gsea_prerank(scores:pd.Series, index:GeneSetIndex, kwargs:dict) \
+        -> tuple[pd.DataFrame, float]:
+    t0 = time.perf_counter()
+    table = gsea_prerank(scores, index, **kwargs)
+    return table, time.perf_counter() - t0
+
+
+def _gsea_prerank_worker(scores:pd.Series, kwargs:dict) -> tuple[pd.DataFrame, float]:
+    return _timed_gsea_prerank(scores, _worker_index, kwargs)
+
+
+def gsea_prerank_many(
+        scores:Mapping[str, pd.Series],
+        collections:GeneSetCollections,
+        n_workers:int=None,
+        **gsea_kwargs,
 ) -> dict[str, pd.DataFrame]:
-    """Do pygsea.prerank analysis on scores, returning one table concating all results
-    for all supplied GS collections."""
+    """`gsea_prerank` of each score series, e.g. one per comparison, in
+    parallel.
+
+    Args:
+        scores: {name: scores}
+        collections: gene sets to test.
+        n_workers: number of processes, defaults to number of CPUs,
+            1 runs in this process.
+        **gsea_kwargs: passed to gsea_prerank.
+
+    Returns:
+        {name: table}, in the order of scores.
+    """
+    if not isinstance(collections, GeneSetCollections):
+        collections = GeneSetCollections(collections)
+    # the index is sent to each worker once, rather than with every task
+    index = collections.index
+    n = len(scores)
+    tables = {}
+
+    def log_done(k, seconds):
+        logger.info(f"GSEA {len(tables)}/{n} done: {k} in {seconds:.1f}s")
+
+    if n_workers == 1 or n == 1:
+        for k, s in scores.items():
+            tables[k], seconds = _timed_gsea_prerank(s, index, gsea_kwargs)
+            log_done(k, seconds)
+        return tables
+
+    with ProcessPoolExecutor(max_workers=n_workers, initializer=_init_gsea_worker,
+                             initargs=(index,)) as pool:
+        futures = {pool.submit(_gsea_prerank_worker, s, gsea_kwargs):k for k, s in scores.items()}
+        for future in as_completed(futures):
+            k = futures[future]
+            tables[k], seconds = future.result()
+            log_done(k, seconds)
+    return {k:tables[k] for k in scores}
+
+
+def signed_p10_scores(results:AnalysisResults, symbol_map:pd.Series=None) -> pd.DataFrame:
+    """-log10(p) with the sign of the score, for every comparison, as
+    `score_signed_p10` for a single comparison.
+
+    Args:
+        results: e.g. LimmaResults.
+        symbol_map: map from results index to gene symbols used in gene
+            sets. Unmapped values are dropped, and where several rows map
+            to the same symbol, the one with the largest absolute signed
+            score is kept, for each comparison.
+
+    Returns:
+        Table (genes × comparisons), NaN where a gene has no score.
+    """
+    p10 = results.p10_table
+    score = results.score_table.reindex(index=p10.index, columns=p10.columns)
+    signed = np.where(score.to_numpy() < 0, -1., 1.) * p10.to_numpy(dtype=np.float64)
+    if symbol_map is None:
+        return pd.DataFrame(signed, index=p10.index, columns=p10.columns)
+
+    codes, symbols = pd.factorize(p10.index.to_series().map(symbol_map))
+    deduped = np.full((len(symbols), signed.shape[1]), np.nan)
+    for j in range(signed.shape[1]):
+        v = signed[:, j]
+        rows = np.flatnonzero((codes >= 0) & ~np.isnan(v))
+        # within each symbol, largest absolute score first
+        rows = rows[np.lexsort((-np.abs(v[rows]), codes[rows]))]
+        first = np.ones(len(rows), dtype=bool)
+        first[1:] = codes[rows[1:]] != codes[rows[:-1]]
+        rows = rows[first]
+        deduped[codes[rows], j] = v[rows]
+    return pd.DataFrame(deduped, index=pd.Index(symbols, name=p10.index.name), columns=p10.columns)
 
 
+def gsea_from_results(
+        results:AnalysisResults,
+        collections:GeneSetCollections,
+        symbol_map:pd.Series=None,
+        n_workers:int=None,
+        **gsea_kwargs,
+) -> GeneSetEnrichmentResults:
+    """Preranked GSEA of every comparison in results, ranked by signed
+    -log10(p), see `signed_p10_scores`. Comparisons are run in parallel
+    with `gsea_prerank_many`.
+
+    Args:
+        results: e.g. LimmaResults.
+        collections: gene sets to test.
+        symbol_map: map from results index to gene symbols.
+        n_workers: number of processes, see gsea_prerank_many.
+        **gsea_kwargs: passed to gsea_prerank.
+
+    Returns:
+        GeneSetEnrichmentResults indexed by gene set name with columns
+        (comparison, stat) for stats in GSEASTATCOLS, plus a Collection
+        column. scorekey is 'NES'.
+    """
+    if not isinstance(collections, GeneSetCollections):
+        collections = GeneSetCollections(collections)
+    scores = signed_p10_scores(results, symbol_map)
+    logger.info(f"Running GSEA for {scores.shape[1]} comparisons.")
+    t0 = time.perf_counter()
+    tables = gsea_prerank_many(
+        {comp:scores[comp] for comp in scores.columns},
+        collections, n_workers=n_workers, **gsea_kwargs
+    )
+    logger.info(f"GSEA of {len(tables)} comparisons took {time.perf_counter() - t0:.1f}s")
+
+    # sets tested can differ between comparisons, align on (collection, set)
+    stats = [k for k in GSEASTATCOLS if k != 'FDR10']
+    table = pd.concat(
+        {comp:tbl.set_index(['GeneSetCollection', 'Term']).reindex(columns=stats)
+         for comp, tbl in tables.items()},
+        axis='columns', join='outer',
+    )
+    table = add_log10_sig_cols_all(table, ('FDR',))
+    collection = table.index.get_level_values(0)
+    table.index = pd.Index(table.index.get_level_values(1), name='GeneSet')
+    table.loc[:, 'Collection'] = np.asarray(collection)
+
+    return GeneSetEnrichmentResults(
+        table=table,
+        comparisons=CompDict({k:results.comparisons[k] for k in tables}),
+        columns=GSEASTATCOLS,
+        scorekey='NES',
+        collections=collections,
+    )
+
+
+def gsea_prerank_analysis(
+        scores:pd.Series,
+        gene_set_collections:dict[str, dict[str, list[str]]],
+        engine:Literal['gseapy', 'native']='gseapy',
+        **gsea_kwargs,
+) -> pd.DataFrame:
+    """Preranked GSEA of scores, returning one table concating all results
+    for all supplied GS collections.
+
+    Args:
+        scores: indexed by gene.
+        gene_set_collections: {collection: {set name: genes}}
+        engine: 'gseapy' calls gseapy.prerank for each collection (default).
+            'native' uses `gsea_prerank`, which is much faster, but
+            results differ from gseapy's in random nulls and dtypes
+            (e.g. LeadingLen and Size are numbers, not strings).
+        **gsea_kwargs: passed to gsea_prerank or gseapy.prerank.
+    """
+    if engine == 'native':
+        return gsea_prerank(scores, gene_set_collections, **gsea_kwargs)
+    elif engine != 'gseapy':
+        raise ValueError(f"Unknown engine {engine}")
+    import gseapy
+
     gcr = AttrMapAC()
 
     for gscname, geneset in gene_set_collections.items():
-        res = gseapy.prerank(rnk=scores, gene_sets=geneset, )
+        res = gseapy.prerank(rnk=scores, gene_sets=geneset, **gsea_kwargs)
         tbl = format_gseapy_res2d(res.res2d)
         tbl = tbl.drop('Method', axis='columns')
         tbl.insert(0, 'GeneSetCollection', gscname)
@@ -47,11 +456,8 @@ def gsea_prerank_analysis(
     gsea_table = pd.concat(gcr.values(), axis='index').sort_values('FDR', ascending=True)
     return gsea_table
 
-from jttools.excel import conditional_format_definitions
-sigfmtxl = conditional_format_definitions.significance()
-scrfmtxl = conditional_format_definitions.score()
-
 def write_gsea_tables_to_xlsx(tables:dict[str, pd.DataFrame], outfn:Pathy):
+    sigfmtxl, scrfmtxl = excel_conditional_formats()
     wrapped = dict(text_wrap=True, num_format='@')
     wb = write_stats_workbook(
         outfn, tables,
@@ -80,23 +486,10 @@ def _test_run():
     with open('/mnt/m/tasks/NA327_Proteomics_UbPulldown/pickles_combined/genesetcolls.2.pickle', 'rb') as f:
         genesetcolls = pickle.load(f)
 
-    scores = {}
-    for treat in limres_kggnorm.comparisons:
-        res = limres_kggnorm.table[treat]
-        score = score_signed_p10(res).dropna()
-
-        # get the highest scoring per gene symbol
-        ifo = info.KGG.reindex(score.index)
-
-        dupes = ifo.GeneSymbol.duplicated(keep='last')
-        s = score.loc[~dupes]
-        s.index = ifo[~dupes].GeneSymbol
+    gsea_res = gsea_from_results(limres_kggnorm, genesetcolls, symbol_map=info.KGG.GeneSymbol)
+    gsea_res_kggnorm_p3 = {k:gsea_res.result_table(k).rename_axis('Term').reset_index()
+                           for k in gsea_res.comparisons}
 
-        scores[treat] = s
-    gsea_res_kggnorm_p3 = {}
-    for k, s in scores.items():
-        gsea_res_kggnorm_p3[k] = gsea_prerank_analysis(s, genesetcolls)
-    
     write_gsea_tables_to_xlsx(gsea_res_kggnorm_p3, '/mnt/m/tasks/NA327_Proteomics_UbPulldown/data/GSEA/kGG_wholenorm.fdrscore.P3.1.xlsx')
 
 if __name__ == '__main__':
@@ -0,0 +1,408 @@
+"""Compiled Gene Ontology DAG, parsed from an OBO file.
+
+Terms are given integer IDs (position in the sorted term IDs), parent and
+child relationships are held as CSR style adjacency arrays, and the
+ancestors of every term are computed, when first needed, as a closure in
+the same format. The arrays are saved as .npy files in a cache directory
+(in the user cache directory by default, see
+`bioscreen.utils.user_cache_dir`) and memory-mapped on later loads, so
+loading the full GO after the first parse takes milliseconds.
+
+CSR structure: the parents of term i are parent_indices[parent_indptr[i]:parent_indptr[i+1]],
+likewise for children and ancestors."""
+
+import json
+import logging
+import os
+import pathlib
+from typing import Collection, Mapping, Optional
+
+import numpy as np
+import pandas as pd
+
+from bioscreen.utils import Pathy, atomic_write, path_cache_dir, save_array
+
+logger = logging.getLogger(__name__)
+
+__all__ = ['GODag', 'parse_obo']
+
+CACHE_VERSION = 1
+NAMESPACES = ('biological_process', 'molecular_function', 'cellular_component')
+_ARRAYS = ('ids', 'namespace', 'obsolete', 'name_offsets', 'names_utf8',
+           'alt_ids', 'alt_terms', 'parent_indptr', 'parent_indices',
+           'ancestor_indptr', 'ancestor_indices')
+
+
+def parse_obo(obo_fn:Pathy, relationships:Collection[str]=('is_a',)) -> dict[str, list]:
+    """Parse [Term] stanzas of an OBO file.
+
+    Args:
+        obo_fn: OBO file.
+        relationships: edges to keep, 'is_a' and/or types given in
+            'relationship:' tags, e.g. 'part_of'.
+
+    Returns:
+        Lists, per term: ids, names, namespaces, obsolete; and alt_ids
+        as (alt_id, id) pairs, edges as (child id, parent id) pairs.
+    """
+    relationships = set(relationships)
+    parsed = dict(ids=[], names=[], namespaces=[], obsolete=[], alt_ids=[], edges=[])
+    in_term = False
+    term_id = None
+
+    def value_of(line):
+        # drop trailing comments and modifiers
+        return line.split(': ', 1)[1].split(' !')[0].split(' {')[0].strip()
+
+    with open(obo_fn) as f:
+        for line in f:
+            line = line.rstrip('\n')
+            if line.startswith('['):
+                in_term = line.strip() == '[Term]'
+                term_id = None
+                continue
+            if not in_term or ': ' not in line:
+                continue
+            tag = line.split(':', 1)[0]
+            if tag == 'id':
+                term_id = value_of(line)
+                parsed['ids'].append(term_id)
+                parsed['names'].append('')
+                parsed['namespaces'].append('')
+                parsed['obsolete'].append(False)
+            elif term_id is None:
+                raise ValueError(f"Tag before id in [Term] stanza of {obo_fn}: {line}")
+            elif tag == 'name':
+                parsed['names'][-1] = line.split(': ', 1)[1].strip()
+            elif tag == 'namespace':
+                parsed['namespaces'][-1] = value_of(line)
+            elif tag == 'is_obsolete':
+                parsed['obsolete'][-1] = value_of(line) == 'true'
+            elif tag == 'alt_id':
+                parsed['alt_ids'].append((value_of(line), term_id))
+            elif tag == 'is_a' and 'is_a' in relationships:
+                parsed['edges'].append((term_id, value_of(line)))
+            elif tag == 'relationship':
+                rel, parent = value_of(line).split()[:2]
+                if rel in relationships:
+                    parsed['edges'].append((term_id, parent))
+    return parsed
+
+
+def _csr(rows:np.ndarray, cols:np.ndarray, n:int) -> tuple[np.ndarray, np.ndarray]:
+    """indptr, indices from (row, col) pairs; duplicates removed, columns
+    kept in the order given within rows."""
+    _, first = np.unique(rows.astype(np.int64) * max(n, 1) + cols, return_index=True)
+    first.sort()
+    rows, cols = rows[first], cols[first]
+    order = np.argsort(rows, kind='stable')
+    rows, cols = rows[order], cols[order]
+    indptr = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum(np.bincount(rows, minlength=n), out=indptr[1:])
+    return indptr, cols.astype(np.int32)
+
+
+def _ancestor_closure(parent_indptr:np.ndarray, parent_indices:np.ndarray) \
+        -> tuple[np.ndarray, np.ndarray]:
+    """CSR of all ancestors of each term, from parent adjacency. Terms are
+    visited in topological order (parents first), so each term's ancestors
+    are its parents and their, already complete, ancestors."""
+    n = len(parent_indptr) - 1
+    n_children = np.bincount(parent_indices, minlength=n)
+    child_indptr = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum(n_children, out=child_indptr[1:])
+    child_rows = np.repeat(np.arange(n), np.diff(parent_indptr))
+    child_indices = child_rows[np.argsort(parent_indices, kind='stable')]
+
+    n_parents = np.diff(parent_indptr)
+    pending = n_parents.copy()
+    ancestors:list[Optional[np.ndarray]] = [None] * n
+    frontier = np.flatnonzero(pending == 0)
+    visited = 0
+    while len(frontier):
+        visited += len(frontier)
+        for t in frontier.tolist():
+            parents = parent_indices[parent_indptr[t]:parent_indptr[t + 1]]
+            if len(parents):
+                ancestors[t] = np.unique(np.concatenate([parents] + [ancestors[p] for p in parents.tolist()]))
+            else:
+                ancestors[t] = parents
+        children = np.concatenate([child_indices[child_indptr[t]:child_indptr[t + 1]]
+                                   for t in frontier.tolist()] + [np.array([], dtype=np.int64)])
+        np.subtract.at(pending, children, 1)
+        frontier = np.unique(children[pending[children] == 0])
+    if visited < n:
+        raise ValueError(f"GO hierarchy contains cycles, {n - visited} terms not ordered.")
+
+    indptr = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum([len(a) for a in ancestors], out=indptr[1:])
+    indices = np.concatenate(ancestors + [np.array([], dtype=np.int32)]).astype(np.int32)
+    return indptr, indices
+
+
+def _transpose(indptr:np.ndarray, indices:np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    n = len(indptr) - 1
+    rows = np.repeat(np.arange(n, dtype=np.int32), np.diff(indptr))
+    order = np.argsort(indices, kind='stable')
+    t_indptr = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum(np.bincount(indices, minlength=n), out=t_indptr[1:])
+    return t_indptr, rows[order]
+
+
+class GODag:
+    """Gene Ontology term hierarchy as arrays.
+
+    Build with `GODag.load` (cached) or `GODag.from_obo`. Term IDs are
+    strings, e.g. 'GO:0008150'; query methods take any collection of them
+    and alt_ids are resolved to their primary term.
+
+    Attributes:
+        ids: term IDs, sorted, the integer ID of a term is its position.
+        namespace: index into NAMESPACES, -1 if other.
+        obsolete: bool per term.
+        parent_indptr, parent_indices: direct parents (CSR), in the order
+            of the OBO.
+        ancestor_indptr, ancestor_indices: all ancestors, excluding self (CSR),
+            computed on first access if not given.
+    """
+
+    def __init__(self, arrays:Mapping[str, np.ndarray]):
+        self._arrays = dict(arrays)
+        for k in ('ids', 'namespace', 'obsolete', 'parent_indptr', 'parent_indices'):
+            setattr(self, k, arrays[k])
+        self._lookup = None
+        self._children = None
+        self._descendants = None
+
+    @classmethod
+    def from_parsed(cls, parsed:Mapping[str, list]) -> 'GODag':
+        """From the output of `parse_obo`."""
+        ids = np.asarray(parsed['ids'], dtype=str)
+        order = np.argsort(ids, kind='stable')
+        ids = ids[order]
+        if len(ids) and (ids[1:] == ids[:-1]).any():
+            raise ValueError(f"Duplicate term IDs: {np.unique(ids[1:][ids[1:] == ids[:-1]])[:10]}")
+        lookup = pd.Index(ids)
+
+        ns = {k:i for i, k in enumerate(NAMESPACES)}
+        namespace = np.array([ns.get(x, -1) for x in parsed['namespaces']], dtype=np.int8)[order]
+        obsolete = np.asarray(parsed['obsolete'], dtype=bool)[order]
+        names = [parsed['names'][i].encode() for i in order.tolist()]
+        name_offsets = np.zeros(len(names) + 1, dtype=np.int64)
+        np.cumsum([len(b) for b in names], out=name_offsets[1:])
+
+        edges = np.array(parsed['edges'], dtype=str).reshape(-1, 2)
+        child, parent = lookup.get_indexer(edges[:, 0]), lookup.get_indexer(edges[:, 1])
+        unknown = parent < 0
+        if unknown.any():
+            logger.warning(f"{unknown.sum()} parent terms not defined in the OBO, e.g. "
+                           f"{edges[unknown, 1][:3].tolist()}, ignoring them.")
+        parent_indptr, parent_indices = _csr(child[~unknown], parent[~unknown], len(ids))
+
+        alt = np.array(parsed['alt_ids'], dtype=str).reshape(-1, 2)
+        return cls(dict(
+            ids=ids,
+            namespace=namespace,
+            obsolete=obsolete,
+            name_offsets=name_offsets,
+            names_utf8=np.frombuffer(b''.join(names), dtype=np.uint8),
+            alt_ids=alt[:, 0],
+            alt_terms=lookup.get_indexer(alt[:, 1]).astype(np.int32),
+            parent_indptr=parent_indptr,
+            parent_indices=parent_indices,
+        ))
+
+    @classmethod
+    def from_obo(cls, obo_fn:Pathy, relationships:Collection[str]=('is_a',)) -> 'GODag':
+        return cls.from_parsed(parse_obo(obo_fn, relationships))
+
+    @classmethod
+    def from_parent_map(cls, hierarchy:Mapping[str, Collection[str]]) -> 'GODag':
+        """From {term: [parent terms]}, as returned by `parse_go_hierarchy`."""
+        edges = [(c, p) for c, parents in hierarchy.items() for p in parents]
+        terms = list(set(hierarchy).union(p for _, p in edges))
+        return cls.from_parsed(dict(
+            ids=terms, names=[''] * len(terms), namespaces=[''] * len(terms),
+            obsolete=[False] * len(terms), alt_ids=[], edges=edges,
+        ))
+
+    # saving and loading
+    def save(self, directory:Pathy):
+        """Write arrays as .npy files, that can be memory-mapped by `from_dir`.
+        Includes the ancestor closure, computing it if needed. Existing files
+        are replaced, not overwritten, so DAGs already mapped from them are
+        unaffected."""
+        directory = pathlib.Path(directory)
+        os.makedirs(directory, exist_ok=True)
+        self.ancestor_csr()
+        for k in _ARRAYS:
+            save_array(directory / f"{k}.npy", self._arrays[k])
+
+    @classmethod
+    def from_dir(cls, directory:Pathy, mmap=True) -> 'GODag':
+        directory = pathlib.Path(directory)
+        mode = 'r' if mmap else None
+        return cls({k:np.load(directory / f"{k}.npy", mmap_mode=mode) for k in _ARRAYS})
+
+    @classmethod
+    def load(cls, obo_fn:Pathy, relationships:Collection[str]=('is_a',),
+             cache=True, cache_dir:Pathy=None) -> 'GODag':
+        """Parse obo_fn, or memory-map the compiled DAG from the cache if the
+        OBO hasn't changed since it was written.
+
+        Args:
+            obo_fn: OBO file, e.g. go-basic.obo or PANTHER GO slim.
+            relationships: see `parse_obo`.
+            cache: read and write the cache.
+            cache_dir: default is in the user cache directory, keyed by the
+                path of obo_fn, see `bioscreen.utils.path_cache_dir`.
+        """
+        obo_fn = pathlib.Path(obo_fn)
+        cache_dir = pathlib.Path(cache_dir or path_cache_dir('godag', obo_fn))
+        st = obo_fn.stat()
+        signature = dict(version=CACHE_VERSION, mtime_ns=st.st_mtime_ns, size=st.st_size,
+                         relationships=sorted(relationships))
+        manifest_fn = cache_dir / 'manifest.json'
+
+        if cache and manifest_fn.exists():
+            with open(manifest_fn) as f:
+                if json.load(f) == signature:
+                    try:
+                        return cls.from_dir(cache_dir)
+                    except (OSError, ValueError):
+                        pass
+
+        dag = cls.from_obo(obo_fn, relationships)
+        if cache:
+            try:
+                # invalidate first, the manifest is written once arrays are complete
+                manifest_fn.unlink(missing_ok=True)
+                dag.save(cache_dir)
+                with atomic_write(manifest_fn) as f:
+                    json.dump(signature, f)
+            except OSError as err:
+                logger.warning(f"Couldn't write GO DAG cache to {cache_dir}: {err}")
+        return dag
+
+    # lookups
+    @property
+    def n_terms(self) -> int:
+        return len(self.ids)
+
+    def term_index(self, terms:Collection[str]) -> np.ndarray:
+        """Integer ID of each term, alt_ids resolved, -1 if not found."""
+        if self._lookup is None:
+            self._lookup = (pd.Index(np.asarray(self.ids).astype(object)),
+                            pd.Index(np.asarray(self._arrays['alt_ids']).astype(object)))
+        primary, alt = self._lookup
+        terms = list(terms)
+        i = primary.get_indexer(terms)
+        missing = np.flatnonzero(i < 0)
+        if len(missing) and len(alt):
+            j = alt.get_indexer([terms[m] for m in missing])
+            i[missing[j >= 0]] = self._arrays['alt_terms'][j[j >= 0]]
+        return i
+
+    def _require(self, terms:Collection[str]) -> np.ndarray:
+        i = self.term_index(terms)
+        if (i < 0).any():
+            raise KeyError(f"GO terms not found: {list(np.asarray(list(terms))[i < 0][:10])}")
+        return i
+
+    def names(self, terms:Collection[str]) -> list[str]:
+        offsets, blob = self._arrays['name_offsets'], self._arrays['names_utf8']
+        return [bytes(blob[offsets[i]:offsets[i + 1]]).decode() for i in self._require(terms)]
+
+    def ancestor_csr(self) -> tuple[np.ndarray, np.ndarray]:
+        if 'ancestor_indptr' not in self._arrays:
+            indptr, indices = _ancestor_closure(self.parent_indptr, self.parent_indices)
+            self._arrays.update(ancestor_indptr=indptr, ancestor_indices=indices)
+        return self._arrays['ancestor_indptr'], self._arrays['ancestor_indices']
+
+    @property
+    def ancestor_indptr(self) -> np.ndarray:
+        return self.ancestor_csr()[0]
+
+    @property
+    def ancestor_indices(self) -> np.ndarray:
+        return self.ancestor_csr()[1]
+
+    def children_csr(self) -> tuple[np.ndarray, np.ndarray]:
+        if self._children is None:
+            self._children = _transpose(self.parent_indptr, self.parent_indices)
+        return self._children
+
+    def descendant_csr(self) -> tuple[np.ndarray, np.ndarray]:
+        if self._descendants is None:
+            self._descendants = _transpose(*self.ancestor_csr())
+        return self._descendants
+
+    @staticmethod
+    def _expand(indptr, indices, rows:np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        """(position in rows, value) pairs for every value in the given rows."""
+        starts = indptr[rows]
+        lengths = indptr[rows + 1] - starts
+        pos = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+        return np.repeat(np.arange(len(rows)), lengths), np.asarray(indices)[pos]
+
+    def _one(self, indptr, indices, term:str) -> np.ndarray:
+        i = self._require([term])[0]
+        return np.asarray(self.ids)[indices[indptr[i]:indptr[i + 1]]]
+
+    def parents(self, term:str) -> np.ndarray:
+        return self._one(self.parent_indptr, self.parent_indices, term)
+
+    def children(self, term:str) -> np.ndarray:
+        return self._one(*self.children_csr(), term)
+
+    def ancestors(self, term:str) -> np.ndarray:
+        return self._one(self.ancestor_indptr, self.ancestor_indices, term)
+
+    def descendants(self, term:str) -> np.ndarray:
+        return self._one(*self.descendant_csr(), term)
+
+    def ancestor_pairs(self, terms:Collection[str]) -> tuple[np.ndarray, np.ndarray]:
+        """Every (position in terms, ancestor integer ID) pair, for many
+        terms at once."""
+        return self._expand(self.ancestor_indptr, self.ancestor_indices, self._require(terms))
+
+    def descendant_pairs(self, terms:Collection[str]) -> tuple[np.ndarray, np.ndarray]:
+        return self._expand(*self.descendant_csr(), self._require(terms))
+
+    def is_ancestor(self, ancestors:Collection[str], terms:Collection[str]) -> np.ndarray:
+        """Elementwise, is ancestors[i] an ancestor of terms[i]."""
+        a, t = self.term_index(ancestors), self.term_index(terms)
+        # ancestors are sorted within each term, so search (term, ancestor)
+        #   as a single sorted key
+        n = self.n_terms
+        rows = np.repeat(np.arange(n, dtype=np.int64), np.diff(self.ancestor_indptr))
+        keys = rows * n + self.ancestor_indices
+        query = t.astype(np.int64) * n + a
+        pos = np.searchsorted(keys, query).clip(max=max(len(keys) - 1, 0))
+        found = keys[pos] == query if len(keys) else np.zeros(len(query), dtype=bool)
+        return found & (a >= 0) & (t >= 0)
+
+    def parent_pairs_within(self, terms:Collection[str]) -> tuple[np.ndarray, np.ndarray]:
+        """Direct parent relationships between terms.
+
+        Returns:
+            (child, parent) positions in terms, for each parent of terms[i]
+            that is also in terms. Terms can be duplicated, parents match
+            their first occurrence.
+        """
+        idx = self._require(terms)
+        child, parent = self._expand(self.parent_indptr, self.parent_indices, idx)
+        present, first = np.unique(idx, return_index=True)
+        pos = np.searchsorted(present, parent).clip(max=len(present) - 1)
+        keep = present[pos] == parent
+        return child[keep], first[pos[keep]]
+
+    def to_parent_map(self) -> dict[str, list[str]]:
+        """{term: [parent terms]}, the format of `parse_go_hierarchy`."""
+        ids = np.asarray(self.ids).tolist()
+        parents = np.asarray(self.parent_indices).tolist()
+        indptr = np.asarray(self.parent_indptr).tolist()
+        return {t:[ids[p] for p in parents[indptr[i]:indptr[i + 1]]] for i, t in enumerate(ids)}
+
+    def __repr__(self):
+        return f"GODag({self.n_terms} terms, {len(self.parent_indices)} edges)"
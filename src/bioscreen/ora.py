@@ -0,0 +1,279 @@
+"""Over-representation analysis (ORA) of gene lists in GeneSetCollections,
+done in process with a hypergeometric test.
+
+All gene lists are tested against all gene sets at once: overlaps are a
+single sparse matrix product of set membership (sets × genes) and list
+membership (genes × lists), p-values are calculated for the whole
+(sets × lists) array, and FDR is calculated per collection, per list."""
+
+from bioscreen._imports import *
+from bioscreen.classes.base import StatColumns, CompsResultDF, logger
+from bioscreen.classes.comparison import CompDict
+from bioscreen.classes.results import AnalysisResults, comps_table_from_arrays
+from bioscreen.classes.geneset_cls import GeneSetCollections, GeneSetEnrichmentResults
+from bioscreen.utils import bh_fdr
+
+__all__ = ['ora', 'ora_from_results', 'hit_lists_from_results', 'hypergeom_sf', 'ORACOLS']
+
+_oracols = [
+    {'original': 'Overlap', 'key': 'Overlap', 'label': 'Genes in set & list', 'table': 'Overlap'},
+    {'original': 'Size', 'key': 'Size', 'label': 'Set size', 'table': 'Size'},
+    {'original': 'ListSize', 'key': 'ListSize', 'label': 'List size', 'table': 'List size'},
+    {'original': 'Expected', 'key': 'Expected', 'label': 'Expected overlap', 'table': 'Expected'},
+    {'original': 'FoldEnrichment', 'key': 'FoldEnrichment', 'label': 'Fold enrichment',
+     'table': 'Fold enrichment'},
+    {'original': 'p', 'key': 'p', 'label': 'p-value', 'table': 'p'},
+    {'original': 'FDR', 'key': 'FDR', 'label': 'FDR', 'table': 'FDR'},
+    {'original': 'p10', 'key': 'p10', 'label': '-log10(p)', 'table': '-log10(p)'},
+    {'original': 'FDR10', 'key': 'FDR10', 'label': '-log10(FDR)', 'table': '-log10(FDR)'},
+]
+ORACOLS = StatColumns.from_records(_oracols)
+
+
+def _log_comb(n, k):
+    from scipy.special import gammaln
+    return gammaln(n + 1) - gammaln(k + 1) - gammaln(n - k + 1)
+
+
+def hypergeom_sf(k, N, K, n) -> np.ndarray:
+    """P(X >= k) for X ~ Hypergeometric(N population, K successes, n draws),
+    broadcast over arrays.
+
+    scipy.stats.hypergeom.sf is computed element by element, and is very
+    slow for millions of tests. Here the tail is summed from the pmf at k
+    using the ratio of consecutive terms, for all elements at once. Tails
+    above the mode are summed upwards, for k at or below the mode the
+    lower tail is summed downwards and subtracted from 1. Terms decrease
+    away from the mode so sums stop after few terms."""
+    k, N, K, n = np.broadcast_arrays(*[np.asarray(x, dtype=np.float64) for x in (k, N, K, n)])
+    shape = k.shape
+    k, N, K, n = (x.ravel() for x in (k, N, K, n))
+    lo = np.maximum(0, n - (N - K))
+    hi = np.minimum(K, n)
+    mode = np.floor((n + 1) * (K + 1) / (N + 2))
+
+    sf = np.where(k <= lo, 1.0, 0.0)
+    todo = np.flatnonzero((k > lo) & (k <= hi))
+    upper = k[todo] > mode[todo]
+
+    def log_pmf(i, idx):
+        return _log_comb(K[idx], i) + _log_comb(N[idx] - K[idx], n[idx] - i) - _log_comb(N[idx], n[idx])
+
+    # upper tail, sum pmf(k..hi)
+    idx = todo[upper]
+    sf[idx] = _sum_tail(k[idx], hi[idx], log_pmf(k[idx], idx), N[idx], K[idx], n[idx], step=1)
+    # lower tail, 1 - sum pmf(lo..k-1)
+    idx = todo[~upper]
+    start = k[idx] - 1
+    sf[idx] = 1 - _sum_tail(start, lo[idx], log_pmf(start, idx), N[idx], K[idx], n[idx], step=-1)
+
+    return np.clip(sf, 0, 1).reshape(shape)
+
+
+def _sum_tail(start, stop, log_first, N, K, n, step, rtol=1e-16):
+    """Sum hypergeometric pmf from start to stop (inclusive), stepping by
+    step, from the log pmf at start."""
+    total = np.exp(log_first)
+    # work on compacted copies of the unfinished elements
+    pos = np.flatnonzero(start != stop)
+    i, stop, term, tot = start[pos], stop[pos], total[pos], total[pos]
+    K, n, NKn = K[pos], n[pos], (N - K - n)[pos]
+    while len(pos):
+        if step == 1:
+            term *= (K - i) * (n - i) / ((i + 1) * (NKn + i + 1))
+        else:
+            term *= i * (NKn + i) / ((K - i + 1) * (n - i + 1))
+        tot += term
+        i += step
+        done = (i == stop) | (term <= tot * rtol)
+        if done.any():
+            total[pos[done]] = tot[done]
+            keep = ~done
+            pos, i, stop, term, tot, K, n, NKn = (
+                x[keep] for x in (pos, i, stop, term, tot, K, n, NKn)
+            )
+    return total
+
+
+def ora(
+        gene_lists:Mapping[str, Collection[str]],
+        collections:GeneSetCollections,
+        universe:Collection[str]=None,
+        min_size:int=1,
+        max_size:int=None,
+) -> CompsResultDF:
+    """Hypergeometric test for over-representation of each gene list in
+    each gene set.
+
+    Args:
+        gene_lists: {name: genes}, e.g. hits of each comparison.
+        collections: gene sets to test.
+        universe: all genes that could have been in a list, e.g. all
+            genes measured. Sets and lists are restricted to the universe.
+            Default is all genes in collections.
+        min_size, max_size: only test sets with this many genes in the
+            universe.
+
+    Returns:
+        Table indexed by set name with columns (list name, stat) for
+        stats in ORACOLS, plus a Collection column.
+    """
+    from scipy import sparse
+
+    if not isinstance(collections, GeneSetCollections):
+        collections = GeneSetCollections(collections)
+    index = collections.index
+
+    if universe is None:
+        in_universe = np.ones(index.n_genes, dtype=bool)
+        n_universe = index.n_genes
+    else:
+        universe = pd.Index(pd.unique(pd.Series(list(universe), dtype=object)))
+        n_universe = len(universe)
+        ids = index.gene_ids(universe)
+        in_universe = np.zeros(index.n_genes, dtype=bool)
+        in_universe[ids[ids >= 0]] = True
+
+    # list membership, genes × lists, only genes in universe and in a set can overlap
+    list_names = list(gene_lists.keys())
+    list_sizes = np.zeros(len(list_names), dtype=np.int64)
+    rows, cols = [], []
+    for j, genes in enumerate(gene_lists.values()):
+        genes = pd.unique(pd.Series(list(genes), dtype=object))
+        ids = index.gene_ids(genes)
+        if universe is None:
+            # the universe is genes in a set, others don't count
+            list_sizes[j] = (ids >= 0).sum()
+        else:
+            list_sizes[j] = (universe.get_indexer(genes) >= 0).sum()
+        ids = ids[ids >= 0]
+        ids = ids[in_universe[ids]]
+        rows.append(ids)
+        cols.append(np.full(len(ids), j))
+    lists_mtx = sparse.csc_matrix(
+        (np.ones(sum(len(r) for r in rows), dtype=np.int32),
+         (np.concatenate(rows or [[]]).astype(np.int64), np.concatenate(cols or [[]]).astype(np.int64))),
+        shape=(index.n_genes, len(list_names)),
+    )
+
+    sets_mtx = index.matrix().astype(np.int32)
+    set_sizes = sets_mtx @ in_universe.astype(np.int32)
+    overlaps = np.asarray((sets_mtx @ lists_mtx).todense())
+
+    keep = set_sizes >= max(min_size, 1)
+    if max_size is not None:
+        keep &= set_sizes <= max_size
+    overlaps = overlaps[keep]
+    set_sizes = set_sizes[keep]
+    set_colls = index.set_collection[keep]
+
+    K = set_sizes[:, None]
+    n = list_sizes[None, :]
+    p = hypergeom_sf(overlaps, n_universe, K, n)
+    expected = K * n / n_universe
+    with np.errstate(invalid='ignore', divide='ignore'):
+        fold = overlaps / expected
+
+    fdr = np.empty_like(p)
+    for ci in np.unique(set_colls):
+        m = set_colls == ci
+        fdr[m] = bh_fdr(p[m])
+
+    shape = overlaps.shape
+    table = comps_table_from_arrays(
+        dict(
+            Overlap=overlaps,
+            Size=np.broadcast_to(K, shape),
+            ListSize=np.broadcast_to(n, shape),
+            Expected=expected,
+            FoldEnrichment=fold,
+            p=p,
+            FDR=fdr,
+        ),
+        index=pd.Index(index.set_names[keep], name='GeneSet'),
+        comparisons=list_names,
+    )
+    table.loc[:, 'Collection'] = np.asarray(index.collections, dtype=object)[set_colls]
+    logger.info(f"ORA: {len(list_names)} lists tested against {keep.sum()} gene sets.")
+    return table
+
+
+def hit_lists_from_results(
+        results:AnalysisResults,
+        direction:Literal['up', 'down', 'both'],
+        fdr_threshold=0.05,
+        score_threshold=0.,
+        symbol_map:pd.Series=None,
+) -> dict[str, list[str]]:
+    """{comparison: genes} significant in a direction for each comparison.
+
+    Args:
+        results: e.g. LimmaResults.
+        direction: sign of the score.
+        fdr_threshold: FDR must be below this.
+        score_threshold: absolute score must be above this.
+        symbol_map: map from results index to gene symbols used in gene
+            sets, e.g. for protein IDs. Unmapped values are dropped.
+    """
+    fdr = results.fdr_table
+    score = results.score_table.reindex(index=fdr.index, columns=fdr.columns)
+    hits = (fdr < fdr_threshold).to_numpy()
+    if direction == 'up':
+        hits &= (score > score_threshold).to_numpy()
+    elif direction == 'down':
+        hits &= (score < -score_threshold).to_numpy()
+    elif direction == 'both':
+        hits &= (score.abs() > score_threshold).to_numpy()
+    else:
+        raise ValueError(f"Unknown direction {direction}")
+
+    genes = fdr.index.to_series()
+    if symbol_map is not None:
+        genes = genes.map(symbol_map)
+    genes = genes.to_numpy()
+    notna = pd.notna(genes)
+
+    return {comp:list(pd.unique(genes[hits[:, j] & notna]))
+            for j, comp in enumerate(fdr.columns)}
+
+
+def ora_from_results(
+        results:AnalysisResults,
+        collections:GeneSetCollections,
+        directions=('up', 'down'),
+        fdr_threshold=0.05,
+        score_threshold=0.,
+        universe:Collection[str]=None,
+        symbol_map:pd.Series=None,
+        min_size:int=1,
+        max_size:int=None,
+) -> dict[str, GeneSetEnrichmentResults]:
+    """ORA of hits of every comparison in results, see `ora` and
+    `hit_lists_from_results`. The universe defaults to every gene in
+    results (mapped by symbol_map if given).
+
+    Returns:
+        {direction: GeneSetEnrichmentResults}
+    """
+    if universe is None:
+        universe = results.score_table.index.to_series()
+        if symbol_map is not None:
+            universe = universe.map(symbol_map)
+        universe = universe.dropna()
+
+    enrichment = {}
+    for direction in directions:
+        lists = hit_lists_from_results(
+            results, direction, fdr_threshold, score_threshold, symbol_map
+        )
+        table = ora(lists, collections, universe=universe,
+                    min_size=min_size, max_size=max_size)
+        comparisons = CompDict({k:results.comparisons[k] for k in lists})
+        enrichment[direction] = GeneSetEnrichmentResults(
+            table=table,
+            comparisons=comparisons,
+            columns=ORACOLS,
+            scorekey='FoldEnrichment',
+            collections=collections,
+        )
+    return enrichment
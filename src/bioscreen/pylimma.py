@@ -0,0 +1,386 @@
+"""Limma-style moderated t-tests in NumPy, an alternative to the rpy2
+backend in `bioscreen.rinterfaces.limma` that doesn't need R.
+
+Reproduces lmFit with the no-intercept design built by get_design in
+limmaFunctions.R, contrasts.fit, eBayes (with default arguments) and the
+topTable columns in LIMMACOLS. All genes and contrasts are handled as
+arrays, so there's no per-gene or per-contrast loop.
+
+Limitations:
+    - Only the cell means design (one column per test group) is supported,
+      which allows fits to be calculated from group means.
+    - No block/duplicateCorrelation or voom.
+    - The prior is estimated with limma's fitFDist ("legacy" in limma >=3.61).
+      Newer limma uses a different estimator when residual df differ between
+      genes, i.e. when there are missing values, so results will differ slightly
+      for those data.
+"""
+
+import ast
+import re
+
+import numpy as np
+import pandas as pd
+from scipy import special, stats
+
+from typing import Collection, Mapping
+
+from bioscreen.classes.comparison import CompDict
+from bioscreen.classes.differential_gene_expression import LimmaResults
+from bioscreen.utils import bh_fdr
+
+import logging
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+
+__all__ = ['PyLimma', 'design_matrix', 'contrast_matrix', 'lm_fit',
+           'contrasts_fit', 'ebayes']
+
+
+def design_matrix(test_groups:Collection[str]) -> tuple[np.ndarray, list[str]]:
+    """No intercept design, columns of levels in sorted order, as
+    model.matrix(~0+as.factor(test_groups)). Returns design and levels."""
+    test_groups = np.asarray([str(g) for g in test_groups])
+    levels = sorted(set(test_groups))
+    design = (test_groups[:, None] == np.array(levels)[None, :]).astype(np.float64)
+    return design, levels
+
+
+# characters that can be part of an R name
+_RNAME = r'[A-Za-z0-9._]'
+
+def contrast_matrix(formulas:Collection[str], levels:Collection[str]) -> np.ndarray:
+    """Contrast matrix (levels × contrasts) from formulas such as
+    "T1 - C" or "(T2 - C2) - (T1 - C1)", as limma::makeContrasts.
+
+    Formulas are linear combinations of levels, using +, -, and * or /
+    by numbers."""
+    levels = list(levels)
+    # levels can be valid R names but not python names, so swap them for placeholders.
+    #   Longest first so that levels that are substrings of others aren't replaced.
+    by_length = sorted(range(len(levels)), key=lambda i: -len(levels[i]))
+    patterns = [
+        (re.compile(f"(?<!{_RNAME}){re.escape(levels[i])}(?!{_RNAME})"), f"__L{i}__")
+        for i in by_length
+    ]
+
+    def evaluate(node) -> np.ndarray:
+        if isinstance(node, ast.Expression):
+            return evaluate(node.body)
+        if isinstance(node, ast.Name):
+            if not node.id.startswith('__L'):
+                raise ValueError(f"Unknown level '{node.id}' in contrast formula.")
+            vec = np.zeros(len(levels))
+            vec[int(node.id[3:-2])] = 1
+            return vec
+        if isinstance(node, ast.Constant) and isinstance(node.value, (int, float)):
+            return float(node.value)
+        if isinstance(node, ast.UnaryOp) and isinstance(node.op, (ast.USub, ast.UAdd)):
+            v = evaluate(node.operand)
+            return -v if isinstance(node.op, ast.USub) else v
+        if isinstance(node, ast.BinOp):
+            left, right = evaluate(node.left), evaluate(node.right)
+            if isinstance(node.op, ast.Add):
+                return left + right
+            if isinstance(node.op, ast.Sub):
+                return left - right
+            if isinstance(node.op, ast.Mult) and (np.isscalar(left) or np.isscalar(right)):
+                return left * right
+            if isinstance(node.op, ast.Div) and np.isscalar(right):
+                return left / right
+        raise ValueError(f"Contrast formulas must be linear combinations of levels, "
+                         f"got {ast.unparse(node)}")
+
+    columns = []
+    for formula in formulas:
+        expr = formula
+        for pattern, placeholder in patterns:
+            expr = pattern.sub(placeholder, expr)
+        vec = evaluate(ast.parse(expr, mode='eval'))
+        if np.isscalar(vec):
+            raise ValueError(f"Contrast '{formula}' doesn't contain any levels.")
+        columns.append(vec)
+    return np.column_stack(columns)
+
+
+def lm_fit(y:np.ndarray, design:np.ndarray) -> dict[str, np.ndarray]:
+    """Fit the cell means design to every row of y. Missing values are
+    dropped per gene, as limma::lmFit.
+
+    Returns dict of coefficients & stdev_unscaled (genes × groups),
+    and sigma, df_residual & Amean (genes)."""
+    design = np.asarray(design, dtype=np.float64)
+    if not (np.isin(design, (0, 1)).all() and (design.sum(axis=1) == 1).all()):
+        raise ValueError("Only no-intercept designs with one column per group are supported.")
+
+    y = np.asarray(y, dtype=np.float64)
+    observed = ~np.isnan(y)
+    y0 = np.where(observed, y, 0)
+
+    # with one group per sample, coefficients are group means of observed values
+    n_obs = observed.astype(np.float64) @ design
+    with np.errstate(invalid='ignore', divide='ignore'):
+        coefficients = (y0 @ design) / n_obs
+        stdev_unscaled = 1 / np.sqrt(n_obs)
+    estimable = n_obs > 0
+    coefficients[~estimable] = np.nan
+    stdev_unscaled[~estimable] = np.nan
+
+    fitted = np.nan_to_num(coefficients) @ design.T
+    rss = (np.where(observed, y0 - fitted, 0) ** 2).sum(axis=1)
+    df_residual = observed.sum(axis=1) - estimable.sum(axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        sigma = np.where(df_residual > 0, np.sqrt(rss / df_residual), np.nan)
+        amean = np.nanmean(y, axis=1) if observed.all() else \
+            np.where(observed.any(axis=1), y0.sum(axis=1) / observed.sum(axis=1), np.nan)
+
+    return dict(
+        coefficients=coefficients,
+        stdev_unscaled=stdev_unscaled,
+        sigma=sigma,
+        df_residual=df_residual.astype(np.float64),
+        Amean=amean,
+    )
+
+
+def contrasts_fit(fit:Mapping[str, np.ndarray], contrasts:np.ndarray) -> dict[str, np.ndarray]:
+    """limma::contrasts.fit for an orthogonal design. Returns a new fit dict
+    with coefficients & stdev_unscaled for the contrasts."""
+    coefficients = fit['coefficients'].copy()
+    stdev_unscaled = fit['stdev_unscaled'].copy()
+
+    # as limma, NA coefficients are replaced with 0 with a huge SE, and
+    #   contrasts they're used in are set back to NA
+    na_coef = ~np.isfinite(coefficients)
+    coefficients[na_coef] = 0
+    stdev_unscaled[na_coef] = 1e30
+
+    new_coef = coefficients @ contrasts
+    new_su = np.sqrt((stdev_unscaled ** 2) @ (contrasts ** 2))
+    reinstate_na = new_su > 1e20
+    new_coef[reinstate_na] = np.nan
+    new_su[reinstate_na] = np.nan
+
+    return dict(fit) | dict(coefficients=new_coef, stdev_unscaled=new_su)
+
+
+def trigamma_inverse(x:float) -> float:
+    """Solve trigamma(y) = x for y, as limma::trigammaInverse."""
+    if x > 1e7:
+        return 1 / np.sqrt(x)
+    if x < 1e-6:
+        return 1 / x
+    y = 0.5 + 1 / x
+    for _ in range(50):
+        tri = special.polygamma(1, y)
+        dif = tri * (1 - tri / x) / special.polygamma(2, y)
+        y += dif
+        if -dif / y < 1e-8:
+            break
+    else:
+        logger.warning("trigamma_inverse: iteration limit exceeded")
+    return y
+
+
+def fit_f_dist(x:np.ndarray, df1:np.ndarray) -> tuple[float, float]:
+    """Moment estimation of a scaled F-distribution, as limma::fitFDist.
+    Returns (scale, df2)."""
+    ok = np.isfinite(df1) & (df1 > 1e-15) & np.isfinite(x) & (x > -1e-15)
+    x = np.maximum(x[ok], 0)
+    df1 = df1[ok]
+    if len(x) <= 1:
+        return np.nan, np.nan
+
+    m = np.median(x)
+    if m == 0:
+        logger.warning("More than half of residual variances are exactly zero: eBayes unreliable")
+        m = 1
+    elif (x == 0).any():
+        logger.warning("Zero sample variances detected, have been offset away from zero")
+    x = np.maximum(x, 1e-5 * m)
+
+    e = np.log(x) - special.digamma(df1 / 2) + np.log(df1 / 2)
+    emean = e.mean()
+    evar = ((e - emean) ** 2).sum() / (len(x) - 1)
+    evar -= special.polygamma(1, df1 / 2).mean()
+    if evar > 0:
+        df2 = 2 * trigamma_inverse(evar)
+        s20 = np.exp(emean + special.digamma(df2 / 2) - np.log(df2 / 2))
+    else:
+        df2 = np.inf
+        s20 = x.mean()
+    return s20, df2
+
+
+def squeeze_var(var:np.ndarray, df:np.ndarray) -> tuple[np.ndarray, float, float]:
+    """Empirical Bayes posterior variances, as limma::squeezeVar.
+    Returns var_post, var_prior, df_prior."""
+    var = np.where(df == 0, 0, var)
+    var_prior, df_prior = fit_f_dist(var, df)
+    if np.isinf(df_prior):
+        var_post = np.full(var.shape, var_prior)
+    else:
+        var_post = (df * var + df_prior * var_prior) / (df + df_prior)
+    return var_post, var_prior, df_prior
+
+
+def _tmixture_vector(tstat, stdev_unscaled, df, proportion, v0_lim) -> float:
+    """Estimate prior variance of non-zero coefficients, as limma::tmixture.vector"""
+    ok = ~np.isnan(tstat)
+    tstat, stdev_unscaled, df = tstat[ok], stdev_unscaled[ok], df[ok]
+    ngenes = len(tstat)
+    ntarget = int(np.ceil(proportion / 2 * ngenes))
+    if ntarget < 1:
+        return np.nan
+    p = max(ntarget / ngenes, proportion)
+
+    tstat = np.abs(tstat)
+    max_df = df.max()
+    lower_df = df < max_df
+    if lower_df.any():
+        tail_p = stats.t.logsf(tstat[lower_df], df[lower_df])
+        tstat[lower_df] = stats.t.isf(np.exp(tail_p), max_df)
+
+    o = np.argsort(-tstat, kind='stable')[:ntarget]
+    tstat = tstat[o]
+    v1 = stdev_unscaled[o] ** 2
+    r = np.arange(1, ntarget + 1)
+    p0 = 2 * stats.t.sf(tstat, max_df)
+    ptarget = ((r - 0.5) / ngenes - (1 - p) * p0) / p
+    v0 = np.zeros(ntarget)
+    pos = ptarget > p0
+    if pos.any():
+        qtarget = stats.t.isf(ptarget[pos] / 2, max_df)
+        v0[pos] = v1[pos] * ((tstat[pos] / qtarget) ** 2 - 1)
+    v0 = np.clip(v0, v0_lim[0], v0_lim[1])
+    return v0.mean()
+
+
+def ebayes(fit:Mapping[str, np.ndarray], proportion=0.01, stdev_coef_lim=(0.1, 4)) \
+        -> dict[str, np.ndarray]:
+    """limma::eBayes with default arguments. Returns a new fit dict with
+    t, p_value, lods (B statistic), s2_post, df_total, s2_prior & df_prior."""
+    coefficients = fit['coefficients']
+    stdev_unscaled = fit['stdev_unscaled']
+    sigma = fit['sigma']
+    df_residual = fit['df_residual']
+    if (df_residual == 0).all():
+        raise ValueError("No residual degrees of freedom in linear model fits")
+    if not np.isfinite(sigma).any():
+        raise ValueError("No finite residual standard deviations")
+
+    s2_post, s2_prior, df_prior = squeeze_var(sigma ** 2, df_residual)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        t = coefficients / stdev_unscaled / np.sqrt(s2_post)[:, None]
+    df_total = np.minimum(df_residual + df_prior, np.nansum(df_residual))
+    p_value = 2 * stats.t.sf(np.abs(t), df_total[:, None])
+
+    # B-statistic
+    var_prior_lim = np.array(stdev_coef_lim) ** 2 / s2_prior
+    var_prior = np.array([
+        _tmixture_vector(t[:, j].copy(), stdev_unscaled[:, j], df_total,
+                         proportion, var_prior_lim)
+        for j in range(t.shape[1])
+    ])
+    if np.isnan(var_prior).any():
+        logger.warning("Estimation of var.prior failed - set to default value")
+        var_prior[np.isnan(var_prior)] = 1 / s2_prior
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        r = (stdev_unscaled ** 2 + var_prior[None, :]) / stdev_unscaled ** 2
+        t2 = t ** 2
+        if df_prior > 1e6:
+            kernel = t2 * (1 - 1 / r) / 2
+        else:
+            dft = df_total[:, None]
+            kernel = (1 + dft) / 2 * np.log((t2 + dft) / (t2 / r + dft))
+        lods = np.log(proportion / (1 - proportion)) - np.log(r) / 2 + kernel
+
+    return dict(fit) | dict(
+        t=t, p_value=p_value, lods=lods, s2_post=s2_post, df_total=df_total,
+        s2_prior=s2_prior, df_prior=df_prior, var_prior=var_prior,
+    )
+
+
+class PyLimma:
+
+    def __init__(self,
+                 counts:pd.DataFrame,
+                 sample_details:pd.DataFrame,
+                 comparisons:CompDict,
+                 test_groups:Collection[str],
+                 block:Collection[str] = None,
+                 voom_counts:bool = False,
+                 analysis_version:str=None,):
+        """Limma analysis in NumPy, with the same interface as
+        `bioscreen.rinterfaces.limma.Limma`. See module docstring for
+        limitations.
+
+        Arguments:
+            counts: Appropriate abundance quantifications for limma.
+            sample_details: Table indexed by Sample column, in the same
+                order as counts columns.
+            comparisons: List of Comparisons to form contrasts.
+            test_groups: Test group names in order of appearance in counts.
+                Will probably just be SampleGroups.
+            block: Not supported, raises ValueError.
+            voom_counts: Not supported, raises ValueError if True.
+            analysis_version: A string identifying this specific analysis.
+                Currently is just recorded in the class instance.
+
+        Methods:
+            run: call all functions required to run analysis and return
+                LimmaResults.
+        """
+        if block is not None:
+            raise ValueError("block (duplicateCorrelation) not supported by PyLimma, use Limma.")
+        if voom_counts:
+            raise ValueError("voom not supported by PyLimma, use Limma.")
+
+        self.counts = counts
+        self.sample_details = sample_details
+        self.comparisons = comparisons
+        self.test_groups = list(test_groups)
+        self.analysis_version = analysis_version
+
+        self.design = None
+        self.levels = None
+        self.fit_res = None
+        self.contrast_res = None
+
+    def prep_data(self):
+        """Create the design matrix."""
+        if not (self.sample_details.index == self.counts.columns).all():
+            raise ValueError("sample_details index doesn't match counts columns.")
+        self.design, self.levels = design_matrix(self.test_groups)
+
+    def fit(self):
+        """Equivalent to limma::lmFit. Adds result to self.fit_res"""
+        if self.design is None:
+            raise RuntimeError("Run prep_data first.")
+        self.fit_res = lm_fit(self.counts.to_numpy(dtype=np.float64), self.design)
+
+    def fit_contrasts(self):
+        """contrasts.fit & eBayes for all comparisons."""
+        cm = contrast_matrix(self.comparisons.to_formulas(), self.levels)
+        self.contrast_res = ebayes(contrasts_fit(self.fit_res, cm))
+
+    def get_results(self) -> LimmaResults:
+        res = self.contrast_res
+        ncomp = res['t'].shape[1]
+        stat_arrays = {
+            'LFC': res['coefficients'],
+            'p': res['p_value'],
+            'FDR': bh_fdr(res['p_value']),
+            'Expr': np.repeat(res['Amean'][:, None], ncomp, axis=1),
+            't': res['t'],
+            'LogOdds': res['lods'],
+        }
+        return LimmaResults.from_arrays(stat_arrays, self.counts.index, self.comparisons)
+
+    def run(self) -> LimmaResults:
+        """Prep data do fits and produce contrast tables."""
+        self.prep_data()
+        self.fit()
+        self.fit_contrasts()
+        return self.get_results()
@@ -0,0 +1,135 @@
+"""Run many independent Limma analyses in parallel.
+
+Each worker process has its own embedded R session, started, with
+limmaFunctions.R sourced, when the worker starts. Importing this module
+doesn't start R in the calling process."""
+
+import dataclasses
+import multiprocessing
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Callable, Collection, Optional, Iterable
+
+import pandas as pd
+
+from bioscreen.classes.comparison import CompDict
+from bioscreen.classes.differential_gene_expression import LimmaResults
+
+import logging
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+
+__all__ = ['LimmaJob', 'LimmaJobResult', 'run_limma_jobs', 'limma_analysis']
+
+
+@dataclasses.dataclass
+class LimmaJob:
+    """Arguments for a single Limma analysis, see `Limma` for details.
+
+    Set rnaseq=True to use Limma.run_rnaseq rather than Limma.run."""
+    name: str
+    counts: pd.DataFrame
+    sample_details: pd.DataFrame
+    comparisons: CompDict
+    test_groups: Collection[str]
+    block: Collection[str] = None
+    voom_counts: bool = False
+    rnaseq: bool = False
+
+
+@dataclasses.dataclass
+class LimmaJobResult:
+    """Results of a LimmaJob. If the job failed results is None and error
+    gives the traceback."""
+    name: str
+    results: Optional[LimmaResults]
+    seconds: float
+    error: Optional[str] = None
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+
+def _init_worker():
+    # starts R and sources limmaFunctions.R, once per worker
+    import bioscreen.rinterfaces.limma
+
+
+def limma_analysis(job:LimmaJob) -> LimmaResults:
+    """Default analysis of run_limma_jobs, runs Limma on the job."""
+    from bioscreen.rinterfaces.limma import Limma
+
+    limma = Limma(
+        counts=job.counts,
+        sample_details=job.sample_details,
+        comparisons=job.comparisons,
+        test_groups=job.test_groups,
+        block=job.block,
+        voom_counts=job.voom_counts,
+        loglevel='WARNING',
+    )
+    return limma.run_rnaseq() if job.rnaseq else limma.run()
+
+
+def _run_job(job:LimmaJob, analysis:Callable[[LimmaJob], LimmaResults]) -> LimmaJobResult:
+    t0 = time.perf_counter()
+    try:
+        results = analysis(job)
+    except Exception:
+        return LimmaJobResult(job.name, None, time.perf_counter() - t0,
+                              error=traceback.format_exc())
+    return LimmaJobResult(job.name, results, time.perf_counter() - t0)
+
+
+def run_limma_jobs(jobs:Iterable[LimmaJob], n_workers:int=None,
+                   analysis:Callable[[LimmaJob], LimmaResults]=None) \
+        -> dict[str, LimmaJobResult]:
+    """Run LimmaJobs across a pool of worker processes, each with its own
+    R session.
+
+    A job raising an error doesn't affect other jobs, the error is recorded
+    in the job's LimmaJobResult. A worker process dying (e.g. R crashing)
+    breaks the pool, and all unfinished jobs are recorded as failed.
+
+    Args:
+        jobs: LimmaJob with unique names.
+        n_workers: number of processes, defaults to number of CPUs.
+        analysis: function run on each job in the workers, returning
+            LimmaResults. Default is `limma_analysis`, with R started when
+            each worker starts. Must be picklable, i.e. defined at module
+            level.
+
+    Returns:
+        {job.name: LimmaJobResult} in the order of jobs.
+    """
+    jobs = list(jobs)
+    names = [job.name for job in jobs]
+    if len(set(names)) != len(names):
+        raise ValueError("LimmaJob names must be unique.")
+
+    # R can't be safely forked, so workers are fresh processes
+    ctx = multiprocessing.get_context('spawn')
+    initializer = _init_worker if analysis is None else None
+    analysis = analysis or limma_analysis
+    results = {}
+    t0 = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=n_workers, mp_context=ctx,
+                             initializer=initializer) as pool:
+        futures = {pool.submit(_run_job, job, analysis): job.name for job in jobs}
+        for fut in as_completed(futures):
+            name = futures[fut]
+            try:
+                res = fut.result()
+            except Exception:
+                res = LimmaJobResult(name, None, float('nan'), error=traceback.format_exc())
+
+            results[name] = res
+            if res.ok:
+                logger.info(f"{len(results)}/{len(jobs)} Limma job {name} finished in {res.seconds:.1f}s")
+            else:
+                logger.warning(f"{len(results)}/{len(jobs)} Limma job {name} failed:\n{res.error}")
+
+    logger.info(f"{len(jobs)} Limma jobs run in {time.perf_counter() - t0:.1f}s")
+    return {name:results[name] for name in names}
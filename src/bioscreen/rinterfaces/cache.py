@@ -0,0 +1,209 @@
+"""On-disk cache of LimmaResults keyed on the inputs to a Limma analysis.
+
+Entries are keyed on a hash of the counts, sample details, test groups,
+block, voom flag and the run method. Within an entry each contrast is
+stored with its formula, so a run that adds comparisons only needs the new
+contrasts fitted (eBayes moderation doesn't depend on which other
+contrasts are fitted)."""
+
+import hashlib
+import json
+import os
+import pathlib
+import shutil
+import time
+import typing
+
+import pandas as pd
+
+from bioscreen.utils import Pathy
+from bioscreen.classes.comparison import CompDict
+from bioscreen.classes.differential_gene_expression import LimmaResults
+
+import logging
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+
+if typing.TYPE_CHECKING:
+    from bioscreen.rinterfaces.limma import Limma
+
+__all__ = ['LimmaCache']
+
+
+def _hash_df(h, df:pd.DataFrame):
+    h.update(pd.util.hash_pandas_object(df, index=True).to_numpy().tobytes())
+    h.update(repr(list(df.columns)).encode())
+
+
+class LimmaCache:
+    """Store LimmaResults on disk, retrieving them when Limma is run with
+    the same inputs. Pass to `Limma(..., cache=LimmaCache(directory))`.
+
+    Least recently used entries are removed when the total size of the
+    cache goes over max_bytes.
+
+    Attributes:
+        hits: Runs where all comparisons were cached.
+        partial_hits: Runs where some comparisons were cached.
+        misses: Runs where nothing was cached.
+    """
+    _index_fn = 'cache_index.json'
+
+    def __init__(self, directory:Pathy, max_bytes:int=10 * 2**30):
+        self.directory = pathlib.Path(directory)
+        self.max_bytes = max_bytes
+        os.makedirs(self.directory, exist_ok=True)
+        self.hits = 0
+        self.partial_hits = 0
+        self.misses = 0
+
+    @property
+    def counters(self) -> dict[str, int]:
+        return dict(hits=self.hits, partial_hits=self.partial_hits, misses=self.misses)
+
+    @staticmethod
+    def input_key(limma:'Limma', method:str) -> str:
+        """Hash of the Limma inputs that affect results of every contrast."""
+        h = hashlib.blake2b(digest_size=16)
+        _hash_df(h, limma.counts)
+        _hash_df(h, limma.sample_details)
+        for thing in (
+                list(limma.test_groups),
+                None if limma.block is None else [str(b) for b in limma.block],
+                limma.voom_counts,
+                method
+        ):
+            h.update(repr(thing).encode())
+        return h.hexdigest()
+
+    def _read_index(self) -> dict[str, dict]:
+        fn = self.directory / self._index_fn
+        if not fn.exists():
+            return {}
+        with open(fn) as f:
+            return json.load(f)
+
+    def _write_index(self, index:dict[str, dict]):
+        with open(self.directory / self._index_fn, 'w') as f:
+            json.dump(index, f)
+
+    def _formulas(self, key) -> dict[str, str]:
+        fn = self.directory / key / 'formulas.json'
+        if not fn.exists():
+            return {}
+        with open(fn) as f:
+            return json.load(f)
+
+    def get(self, key:str, comparisons:CompDict) \
+            -> tuple[typing.Optional[LimmaResults], CompDict]:
+        """Return cached results for any comparisons that have them, and a
+        CompDict of the comparisons that aren't cached.
+
+        Cached results are None if no comparison was found."""
+        cached_formulas = self._formulas(key)
+        found = {k for k, cmp in comparisons.items()
+                 if cached_formulas.get(k) == cmp.formula_str()}
+        missing = CompDict({k:cmp for k, cmp in comparisons.items() if k not in found})
+
+        if not found:
+            self.misses += 1
+            logger.info(f"Limma cache miss, {key}")
+            return None, missing
+
+        if missing:
+            self.partial_hits += 1
+            logger.info(f"Limma cache partial hit, {key}: {len(missing)} comparisons not cached.")
+        else:
+            self.hits += 1
+            logger.info(f"Limma cache hit, {key}")
+
+        index = self._read_index()
+        index.setdefault(key, dict(nbytes=0))['last_used'] = time.time()
+        self._write_index(index)
+
+        results = LimmaResults.load(self.directory / key / 'results', lazy=False)
+        results = self.select_comparisons(
+            results.table, CompDict({k:comparisons[k] for k in comparisons.keys() if k in found})
+        )
+        return results, missing
+
+    @staticmethod
+    def select_comparisons(table:pd.DataFrame, comparisons:CompDict) -> LimmaResults:
+        """LimmaResults of comparisons from a results table, in the order of comparisons."""
+        table = pd.concat({k:table[k] for k in comparisons.keys()}, axis='columns')
+        return LimmaResults.build(table, comparisons=comparisons)
+
+    @staticmethod
+    def _merge(first:LimmaResults, second:LimmaResults) -> LimmaResults:
+        """Combine results, comparisons in second replace those of the same name in first."""
+        comparisons = CompDict(
+            {k:cmp for k, cmp in first.comparisons.items() if k not in second.comparisons}
+            | dict(second.comparisons.items())
+        )
+        tables = {k:first.table[k] for k in comparisons.keys() if k not in second.comparisons} \
+            | {k:second.table[k] for k in second.comparisons.keys()}
+        return LimmaCache.select_comparisons(pd.concat(tables, axis='columns'), comparisons)
+
+    def put(self, key:str, results:LimmaResults, cached:LimmaResults=None) -> LimmaResults:
+        """Store results, adding them to any previously stored for the same
+        inputs. Returns results merged with cached, if given."""
+        if cached is not None:
+            results = self._merge(cached, results)
+
+        entry = self.directory / key
+        to_store = results
+        if (entry / 'results').exists():
+            previous = LimmaResults.load(entry / 'results', lazy=False)
+            to_store = self._merge(previous, results)
+            shutil.rmtree(entry / 'results')
+
+        to_store.save(entry / 'results')
+        with open(entry / 'formulas.json', 'w') as f:
+            json.dump({k:cmp.formula_str() for k, cmp in to_store.comparisons.items()}, f)
+
+        nbytes = sum(fn.stat().st_size for fn in entry.rglob('*') if fn.is_file())
+        index = self._read_index()
+        index[key] = dict(last_used=time.time(), nbytes=nbytes)
+        self._evict(index, keep=key)
+        self._write_index(index)
+
+        return results
+
+    def _evict(self, index:dict[str, dict], keep:str):
+        """Remove least recently used entries, modifying index in place."""
+        total = sum(v['nbytes'] for v in index.values())
+        for k in sorted(index, key=lambda k: index[k]['last_used']):
+            if total <= self.max_bytes:
+                break
+            if k == keep:
+                continue
+            logger.info(f"Limma cache, evicting {k}")
+            shutil.rmtree(self.directory / k, ignore_errors=True)
+            total -= index.pop(k)['nbytes']
+
+    def run(self, limma:'Limma', method:str, runner:typing.Callable[[], LimmaResults]) \
+            -> LimmaResults:
+        """Get results for limma.comparisons from the cache, calling runner
+        with limma.comparisons set to only those that aren't cached.
+
+        Used by Limma.run & Limma.run_rnaseq."""
+        key = self.input_key(limma, method)
+        cached, missing = self.get(key, limma.comparisons)
+        if not missing:
+            return cached
+
+        # only fit the contrasts that aren't cached
+        comparisons = limma.comparisons
+        limma.comparisons = missing
+        try:
+            results = runner()
+        finally:
+            limma.comparisons = comparisons
+
+        results = self.put(key, results, cached)
+        return self.select_comparisons(results.table, limma.comparisons)
+
+    def clear(self):
+        for k in self._read_index():
+            shutil.rmtree(self.directory / k, ignore_errors=True)
+        self._write_index({})
@@ -19,8 +19,7 @@ from bioscreen.experiment_classes import CompDict
 from bioscreen.classes.differential_gene_expression import LimmaResults, LIMMACOLS
 
 from jttools.data_wrangling import AttrMapAC
-from jttools.statistics import neglog10
-from bioscreen.classes.base import SigCols
+from bioscreen.rinterfaces.cache import LimmaCache
 
 
 __all__ = ['Limma']
@@ -92,7 +91,8 @@ class Limma:
                  #included_samples:Collection[str] = 'all',
                  voom_counts:bool = False,
                  analysis_version:str=None,
-                 loglevel:Literal['INFO','DEBUG','WARNING']='INFO'):
+                 loglevel:Literal['INFO','DEBUG','WARNING']='INFO',
+                 cache:LimmaCache=None):
         """Interface for running Limma in R.
 
         Implimentation not use formulas. test_groups should identify combinations of
@@ -113,6 +113,9 @@ class Limma:
                 counts and need VST.
             analysis_version: A string identifying this specific analysis.
                 Currently is just recorded in the class instance.
+            cache: Optional LimmaCache. When given, run & run_rnaseq return
+                stored results for previously run inputs, only fitting
+                contrasts that aren't in the cache.
 
         Methods:
             run: call all functions required to run analysis and return dict of DF
@@ -129,6 +132,7 @@ class Limma:
         self.voom_counts = voom_counts
         #self.filter_expr = filter_expr
         self.block:Collection[str] = block
+        self.cache = cache
         self.robj = LimmaRObjects()
 
     #todo Limma.from_experiment
@@ -149,10 +153,9 @@ class Limma:
         robj = self.robj
 
 
-        with pd_context():
-            self.robj.counts = R.prep_rnaseq_counts(
-                self.counts, robj.sample_factors
-            )
+        self.robj.counts = R.prep_rnaseq_counts(
+            df_to_rmatrix(self.counts), robj.sample_factors
+        )
 
         if self.voom_counts:
             # iteratively does variance corr if block
@@ -184,7 +187,8 @@ class Limma:
             list(self.sample_details.SampleGroup)
         ))
 
-        robj.counts = pd_convert(self.counts)
+        # numeric matrix, copied to R in one go
+        robj.counts = df_to_rmatrix(self.counts)
         robj.sample_details = pd_convert(self.sample_details)
 
         robj.design = R.get_design(
@@ -226,17 +230,35 @@ class Limma:
         robj.contrast_res = R.fit_contrasts(robj.fit, robj.design, contrasts, names)
 
 
-    def get_results(self) -> LimmaResults:
+    def get_results(self, bulk=True) -> LimmaResults:
+        """Results of all contrasts. When bulk, every stat is returned from R
+        as a single (genes × contrasts) matrix in one call, otherwise
+        topTable is called for each contrast."""
+        if not bulk:
+            return self._get_results_toptables()
+
+        res = R.get_all_results(self.robj.contrast_res)
+        stats = {k:rmatrix_to_np(res.rx2(k)) for k in ('LFC', 'p', 'FDR', 't', 'LogOdds')}
+        ncomp = stats['LFC'].shape[1]
+        stats['Expr'] = np.repeat(rvector_to_np(res.rx2('Expr'))[:, None], ncomp, axis=1)
+
+        contrast_names = list(R.colnames(res.rx2('LFC')))
+        if contrast_names != self.comparisons.names():
+            raise RuntimeError(f"Contrasts from R don't match comparisons: {contrast_names}")
+
+        return LimmaResults.from_arrays(
+            stats,
+            index=list(R.rownames(res.rx2('LFC'))),
+            comparisons=self.comparisons,
+        )
 
+    def _get_results_toptables(self) -> LimmaResults:
         contrast_names = list(R.colnames(self.robj.contrast_res[0]))
         tables = AttrMapAC()
         for cntrst in contrast_names:
-            with pd_context():
-
-                tables[cntrst] = table = R.get_toptable(self.robj.contrast_res, cntrst)
+            tables[cntrst] = rdf_to_pd(R.get_toptable(self.robj.contrast_res, cntrst))
 
-                table.loc[:, SigCols.p10] = table[LIMMACOLS.p.original].apply(neglog10)
-                table.loc[:, SigCols.FDR10] = table[LIMMACOLS.FDR.original].apply(neglog10)
+        # p10 & FDR10 are added for all contrasts at once by build
         return LimmaResults.build(
             tables,
             comparisons=self.comparisons,
@@ -249,22 +271,36 @@ class Limma:
     #
     #     return tables
 
-    def run_rnaseq(self) -> LimmaResults:
-        """Prep data (using prep_rnaseq_data), do fits and produce
-        contrast tables."""
+    def _run_with_cache(self, method:Literal['run', 'run_rnaseq'], runner) -> LimmaResults:
+        """Get results from self.cache, calling runner for comparisons
+        that aren't cached."""
+        if self.cache is None:
+            return runner()
+
+        return self.cache.run(self, method, runner)
+
+    def _run_rnaseq(self) -> LimmaResults:
         self.prep_rnaseq_data()
         self.fit()
         self.fit_contrasts()
         return self.get_results()
 
-    def run(self) -> LimmaResults:
-        """Prep data do fits and produce
-        contrast tables."""
+    def _run(self) -> LimmaResults:
         self.prep_data()
         self.fit()
         self.fit_contrasts()
         return self.get_results()
 
+    def run_rnaseq(self) -> LimmaResults:
+        """Prep data (using prep_rnaseq_data), do fits and produce
+        contrast tables."""
+        return self._run_with_cache('run_rnaseq', self._run_rnaseq)
+
+    def run(self) -> LimmaResults:
+        """Prep data do fits and produce
+        contrast tables."""
+        return self._run_with_cache('run', self._run)
+
 
 if __name__ == '__main__':
     pass
@@ -1,3 +1,6 @@
+import time
+
+import numpy as np
 import pandas as pd
 import rpy2
 import rpy2.rinterface
@@ -25,6 +28,73 @@ def r_to_pd(r_obj):
     return res
 
 
+# R's integer NA is the smallest int32
+R_NA_INTEGER = np.iinfo(np.int32).min
+
+
+def df_to_rmatrix(df:pd.DataFrame) -> ro.vectors.FloatMatrix:
+    """Numeric DataFrame to an R matrix with dimnames, via a single copy
+    of the values into R memory (rather than pandas2ri's column by column
+    conversion to a data.frame).
+
+    R can't use memory it doesn't own, so one copy is the minimum."""
+    values = df.to_numpy(dtype=np.float64)
+    # R matrices are column major
+    flat = np.ravel(values, order='F')
+    vec = rpy2.rinterface.FloatSexpVector.from_memoryview(memoryview(flat))
+    vec.do_slot_assign('dim', rpy2.rinterface.IntSexpVector(list(values.shape)))
+    vec.do_slot_assign('dimnames', rpy2.rinterface.ListSexpVector([
+        rpy2.rinterface.StrSexpVector([str(i) for i in df.index]),
+        rpy2.rinterface.StrSexpVector([str(c) for c in df.columns]),
+    ]))
+    return ro.vectors.FloatMatrix(vec)
+
+
+def rvector_to_np(r_vec) -> np.ndarray:
+    """NumPy view of a numeric R vector, without copying. The array keeps
+    the R object alive. Factors become Categorical and other non numeric
+    vectors are copied to an object array."""
+    if isinstance(r_vec, ro.vectors.FactorVector):
+        codes = np.frombuffer(r_vec.memoryview(), dtype=np.int32)
+        codes = np.where(codes == R_NA_INTEGER, -1, codes - 1)
+        return pd.Categorical.from_codes(codes, categories=list(r_vec.levels))
+    if isinstance(r_vec, rpy2.rinterface.FloatSexpVector):
+        return np.frombuffer(r_vec.memoryview(), dtype=np.float64)
+    if isinstance(r_vec, (rpy2.rinterface.IntSexpVector, rpy2.rinterface.BoolSexpVector)):
+        values = np.frombuffer(r_vec.memoryview(), dtype=np.int32)
+        if (values == R_NA_INTEGER).any():
+            return np.where(values == R_NA_INTEGER, np.nan, values)
+        return values
+    return np.array(list(r_vec), dtype=object)
+
+
+def rmatrix_to_np(r_mat) -> np.ndarray:
+    """NumPy (rows × columns) view of a numeric R matrix, without copying."""
+    nrow, ncol = r_mat.do_slot('dim')
+    return rvector_to_np(r_mat).reshape((nrow, ncol), order='F')
+
+
+def rmatrix_to_pd(r_mat) -> pd.DataFrame:
+    """Numeric R matrix, with dimnames, to a DataFrame."""
+    rownames, colnames = R.rownames(r_mat), R.colnames(r_mat)
+    return pd.DataFrame(
+        rmatrix_to_np(r_mat),
+        index=None if rownames is NULL else list(rownames),
+        columns=None if colnames is NULL else list(colnames),
+        copy=False,
+    )
+
+
+def rdf_to_pd(r_df) -> pd.DataFrame:
+    """R data.frame to DataFrame with numeric columns taken directly from
+    R memory as NumPy arrays, rather than through pandas2ri."""
+    return pd.DataFrame(
+        {k:rvector_to_np(col) for k, col in zip(r_df.names, r_df)},
+        index=list(R.rownames(r_df)),
+        copy=False,
+    )
+
+
 from rpy2.rinterface_lib.embedded import RRuntimeError
 def rcatcher(func, verbosity=1):
     def wrapper(*args, **kwargs):
@@ -38,4 +108,34 @@ def rcatcher(func, verbosity=1):
 
 NULL = rpy2.rinterface.NULL
 
-pkgdir = os.path.dirname(__file__)
\ No newline at end of file
+pkgdir = os.path.dirname(__file__)
+
+
+def _benchmark_conversion(n_genes=60000, n_samples=200):
+    """Compare pandas2ri conversion of a counts table, and of a topTable
+    sized result, with the NumPy based conversions, printing the time taken
+    by each."""
+    rng = np.random.default_rng(0)
+    counts = pd.DataFrame(
+        rng.normal(size=(n_genes, n_samples)),
+        index=[f"g{i}" for i in range(n_genes)],
+        columns=[f"s{i}" for i in range(n_samples)],
+    )
+
+    def timeit(func, *args):
+        t0 = time.perf_counter()
+        res = func(*args)
+        return res, time.perf_counter() - t0
+
+    r_df, t_pd = timeit(pd_convert, counts)
+    r_mat, t_mat = timeit(df_to_rmatrix, counts)
+    print(f"pandas -> R: pandas2ri {t_pd:.3f}s, df_to_rmatrix {t_mat:.3f}s")
+
+    toptab = pd_convert(counts.iloc[:, :6])
+    _, t_pd = timeit(r_to_pd, toptab)
+    _, t_np = timeit(rdf_to_pd, toptab)
+    print(f"R data.frame -> pandas: pandas2ri {t_pd:.3f}s, rdf_to_pd {t_np:.3f}s")
+
+    back, t_np = timeit(rmatrix_to_pd, r_mat)
+    assert np.array_equal(back.to_numpy(), counts.to_numpy())
+    print(f"R matrix -> pandas: rmatrix_to_pd {t_np:.3f}s")
@@ -3,7 +3,12 @@ import sys
 import pandas as pd
 
 from bioscreen._imports import *
-import requests
+from bioscreen.utils import Pathy, atomic_write, save_array
+import contextlib
+import io
+import json
+import os
+import threading
 from pathlib import Path
 
 # when done use the stable address given here
@@ -11,20 +16,242 @@ from pathlib import Path
 APIURL = 'https://string-db.org/api/'
 APPNAME = 'JTs STRINGdb interface'
 
+logger = logging.getLogger(__name__)
+
 # note: identifiers are 9606.ENSP0000###
 def get_string_ids(genes:Collection[str], species='9606') \
         -> pd.DataFrame:
-
-    queryurl = APIURL+'json/get_string_ids'
-    params = dict(identifiers='\r'.join(genes),
-                  species=species,
-                  echo_query=1,
-                  limit=1)
-    res = requests.post(queryurl, data=params)
-    if res.ok:
-        return pd.DataFrame(res.json())
+    """Best STRING ID of each gene from the STRING API, genes that aren't
+    found are dropped. See `resolve_string_ids` for caching and offline
+    use."""
+    ids = resolve_string_ids(genes, species=species)
+    return ids.loc[ids.stringId.notna()].reset_index(drop=True)
+
+
+class StringAPI:
+    """Backend for `resolve_string_ids` using the STRING REST API, or a
+    server implementing the same endpoint (e.g. a local stand-in).
+
+    Requests share one pooled session and failed requests (connection
+    errors, 429 & 5xx responses) are retried with exponential backoff.
+
+    Args:
+        base_url: API address, ending in "/".
+        pool_size: connections kept open.
+        max_retries: retries per request.
+        backoff_factor: seconds, doubling each retry.
+        timeout: seconds.
+    """
+    def __init__(self, base_url=APIURL, pool_size=4, max_retries=5, backoff_factor=0.5,
+                 timeout=120):
+        self.base_url = base_url
+        self.pool_size = pool_size
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.timeout = timeout
+        self._session = None
+
+    @property
+    def cache_id(self) -> str:
+        return self.base_url
+
+    @property
+    def session(self):
+        if self._session is None:
+            import requests
+            from urllib3.util.retry import Retry
+            retry = Retry(total=self.max_retries, backoff_factor=self.backoff_factor,
+                          status_forcelist=(429, 500, 502, 503, 504),
+                          allowed_methods=None)
+            adapter = requests.adapters.HTTPAdapter(
+                pool_connections=self.pool_size, pool_maxsize=self.pool_size, max_retries=retry
+            )
+            self._session = requests.Session()
+            self._session.mount('http://', adapter)
+            self._session.mount('https://', adapter)
+        return self._session
+
+    def get_string_ids(self, identifiers:list[str], species='9606') -> list[dict]:
+        params = dict(identifiers='\r'.join(identifiers),
+                      species=species,
+                      echo_query=1,
+                      limit=1,
+                      caller_identity=APPNAME)
+        res = self.session.post(self.base_url + 'json/get_string_ids', data=params,
+                                timeout=self.timeout)
+        res.raise_for_status()
+        return res.json()
+
+
+class LocalStringIds:
+    """Offline backend for `resolve_string_ids`, from a StringNetwork (or
+    the directory it's saved in), a STRING protein.aliases file, or a
+    DataFrame with columns string_protein_id & alias."""
+    def __init__(self, source:typing.Union['StringNetwork', pd.DataFrame, Pathy]):
+        self.source = 'DataFrame' if isinstance(source, pd.DataFrame) else str(source)
+        if isinstance(source, (str, os.PathLike)) and os.path.isdir(source):
+            source = StringNetwork.load(source)
+        if isinstance(source, StringNetwork):
+            self._map = source.map_ids
+        else:
+            aliases = _read_aliases(source)
+            ids = pd.concat([
+                pd.Series(aliases.string_protein_id.to_numpy(), index=aliases.string_protein_id),
+                pd.Series(aliases.string_protein_id.to_numpy(), index=aliases.alias),
+            ])
+            lookup = ids[~ids.index.duplicated()]
+            self._map = lambda identifiers: lookup.reindex(identifiers)
+
+    @property
+    def cache_id(self) -> str:
+        return f"local:{self.source}"
+
+    def get_string_ids(self, identifiers:list[str], species='9606') -> list[dict]:
+        ids = self._map(identifiers)
+        return [dict(queryIndex=i, queryItem=q, stringId=sid,
+                     ncbiTaxonId=int(sid.split('.', 1)[0]))
+                for i, (q, sid) in enumerate(zip(identifiers, ids))
+                if isinstance(sid, str) and sid.startswith(f"{species}.")]
+
+
+_CACHE_WRITE_LOCK = threading.Lock()
+
+
+@contextlib.contextmanager
+def _file_lock(fn:Path):
+    """Exclusive lock on fn, across threads and, where fcntl is available,
+    processes."""
+    with _CACHE_WRITE_LOCK:
+        try:
+            import fcntl
+        except ImportError:
+            yield
+            return
+        with open(fn, 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+class StringIdCache:
+    """Persistent cache of STRING ID lookups: for each species and backend,
+    a JSON file of {identifier: result or None}, None for identifiers that
+    were not found. Writes merge with whatever is on disk, so caches in
+    different threads or processes can share a directory.
+
+    Attributes:
+        hits, misses: counts of identifiers looked up.
+    """
+    def __init__(self, directory:Pathy):
+        self.directory = Path(directory)
+        os.makedirs(self.directory, exist_ok=True)
+        self.hits = 0
+        self.misses = 0
+        self._tables = {}
+
+    def _fn(self, species, backend_id) -> Path:
+        import hashlib
+        h = hashlib.blake2b(backend_id.encode(), digest_size=8).hexdigest()
+        return self.directory / f"{species}-{h}.json"
+
+    @staticmethod
+    def _read(fn:Path) -> dict:
+        try:
+            with open(fn) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _table(self, species, backend_id) -> dict:
+        fn = self._fn(species, backend_id)
+        if fn not in self._tables:
+            self._tables[fn] = self._read(fn)
+        return self._tables[fn]
+
+    def get(self, identifiers:Collection[str], species, backend_id) -> tuple[dict, list[str]]:
+        """({identifier: result}, identifiers not in the cache)"""
+        table = self._table(species, backend_id)
+        found = {k:table[k] for k in identifiers if k in table}
+        missing = [k for k in identifiers if k not in table]
+        self.hits += len(found)
+        self.misses += len(missing)
+        return found, missing
+
+    def put(self, results:dict, species, backend_id):
+        fn = self._fn(species, backend_id)
+        with _file_lock(fn.with_suffix('.lock')):
+            # others may have written since this table was read
+            table = self._read(fn)
+            table.update(self._table(species, backend_id))
+            table.update(results)
+            with atomic_write(fn) as f:
+                json.dump(table, f)
+        self._tables[fn] = table
+
+
+def resolve_string_ids(identifiers:Collection[str], species='9606',
+                       backend:typing.Union[StringAPI, LocalStringIds]=None,
+                       cache:StringIdCache=None,
+                       chunk_size=2000, n_workers=4) -> pd.DataFrame:
+    """Best STRING ID for each identifier (gene symbol, Ensembl ID etc).
+
+    Cached identifiers are not queried again. Others are sent in chunks
+    of chunk_size, concurrently.
+
+    Args:
+        identifiers: to be resolved, duplicates are resolved once.
+        species: NCBI taxon ID.
+        backend: StringAPI (default) or LocalStringIds.
+        cache: optional StringIdCache.
+        chunk_size: identifiers per request.
+        n_workers: concurrent requests.
+
+    Returns:
+        Table with a row per unique identifier, in order, with columns
+        queryIndex, queryItem, stringId and whatever else the backend gives.
+        stringId is NaN for unresolved identifiers, which are also listed
+        in `.attrs['unresolved']`.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    if backend is None:
+        backend = StringAPI(pool_size=n_workers)
+    identifiers = list(dict.fromkeys(identifiers))
+
+    if cache is not None:
+        results, todo = cache.get(identifiers, species, backend.cache_id)
     else:
-        logging.warning(f'Query failed with reason {res.reason}')
+        results, todo = {}, identifiers
+
+    chunks = [todo[i:i + chunk_size] for i in range(0, len(todo), chunk_size)]
+    if chunks:
+        with ThreadPoolExecutor(max_workers=n_workers) as pool:
+            responses = list(pool.map(lambda c: backend.get_string_ids(c, species), chunks))
+        new = {k:None for k in todo}
+        for chunk, response in zip(chunks, responses):
+            for row in response:
+                # queryIndex is the position in the chunk
+                query = row.get('queryItem', chunk[row['queryIndex']])
+                if new.get(query) is None:
+                    new[query] = row
+        results |= new
+        if cache is not None:
+            cache.put(new, species, backend.cache_id)
+
+    table = pd.DataFrame([results[k] or {} for k in identifiers])
+    table.loc[:, 'queryItem'] = identifiers
+    table.loc[:, 'queryIndex'] = np.arange(len(identifiers))
+    if 'stringId' not in table.columns:
+        table.loc[:, 'stringId'] = np.nan
+    first = ['queryIndex', 'queryItem', 'stringId']
+    table = table[first + [c for c in table.columns if c not in first]]
+    unresolved = [k for k in identifiers if results[k] is None]
+    table.attrs['unresolved'] = unresolved
+    if unresolved:
+        logger.warning(f"{len(unresolved)} of {len(identifiers)} identifiers not resolved, "
+                       f"e.g. {unresolved[:5]}")
+    return table
 
 
 # def get_network_table(
@@ -50,125 +277,416 @@ def get_string_ids(genes:Collection[str], species='9606') \
 
 import gzip
 
-def pair_score_no_textmining(fullscores_fn, out_picklefn, min_score=99):
-    # assume it's a test string
-    if type(fullscores_fn) is list:
-        opener = lambda x: iter(x)
-    elif fullscores_fn.endswith('.gz'):
-        opener = lambda fn: gzip.open(fn, mode='rt')
-    else:
-        opener = open
-    prior = 0.041
-
-    def compute_prior_away(score, prior):
-
-        if score < prior: score = prior
-        score_no_prior = (score - prior) / (1 - prior)
-
-        return score_no_prior
-
-    scores_no_txt = {}
-    failures = 0
-    f = opener(fullscores_fn, )
-    next(f)
-    for line in f:
-        line = line
-        l = line.split()
-        ## load the line
-
-        try:
-            (protein1, protein2,
-             neighborhood, neighborhood_transferred,
-             fusion, cooccurrence,
-             homology,
-             coexpression, coexpression_transferred,
-             experiments, experiments_transferred,
-             database, database_transferred,
-             textmining, textmining_transferred,
-             initial_combined) = l
-        except:
-            failures += 1
-            continue
-
-        ## divide by 1000
-
-        neighborhood = float(neighborhood) / 1000
-        neighborhood_transferred = float(neighborhood_transferred) / 1000
-        fusion = float(fusion) / 1000
-        cooccurrence = float(cooccurrence) / 1000
-        #homology = float(homology) / 1000 # Missing on purpose
-        coexpression = float(coexpression) / 1000
-        coexpression_transferred = float(coexpression_transferred) / 1000
-        experiments = float(experiments) / 1000
-        experiments_transferred = float(experiments_transferred) / 1000
-        database = float(database) / 1000
-        database_transferred = float(database_transferred) / 1000
-        #textmining = float(textmining) / 1000
-        #textmining_transferred = float(textmining_transferred) / 1000
-
-
-        ## compute prior away
-
-        neighborhood_prior_corrected = compute_prior_away(neighborhood, prior)
-        neighborhood_transferred_prior_corrected = compute_prior_away(neighborhood_transferred, prior)
-        fusion_prior_corrected = compute_prior_away(fusion, prior)
-        cooccurrence_prior_corrected = compute_prior_away(cooccurrence, prior)
-        coexpression_prior_corrected = compute_prior_away(coexpression, prior)
-        coexpression_transferred_prior_corrected = compute_prior_away(coexpression_transferred, prior)
-        experiments_prior_corrected = compute_prior_away(experiments, prior)
-        experiments_transferred_prior_corrected = compute_prior_away(experiments_transferred, prior)
-        database_prior_corrected = compute_prior_away(database, prior)
-        database_transferred_prior_corrected = compute_prior_away(database_transferred, prior)
-        #textmining_prior_corrected = compute_prior_away(textmining, prior)
-        #textmining_transferred_prior_corrected = compute_prior_away(textmining_transferred, prior)
-
-        ## then, combine the direct and transferred scores for each category:
-
-        neighborhood_both_prior_corrected = 1.0 - (1.0 - neighborhood_prior_corrected) * (
-                    1.0 - neighborhood_transferred_prior_corrected)
-        coexpression_both_prior_corrected = 1.0 - (1.0 - coexpression_prior_corrected) * (
-                    1.0 - coexpression_transferred_prior_corrected)
-        experiments_both_prior_corrected = 1.0 - (1.0 - experiments_prior_corrected) * (
-                    1.0 - experiments_transferred_prior_corrected)
-        database_both_prior_corrected = 1.0 - (1.0 - database_prior_corrected) * (
-                    1.0 - database_transferred_prior_corrected)
-        #textmining_both_prior_corrected = 1.0 - (1.0 - textmining_prior_corrected) * (
-         #           1.0 - textmining_transferred_prior_corrected)
-
-        ## next, do the 1 - multiplication:
-
-        combined_score_one_minus = (
-                (1.0 - neighborhood_both_prior_corrected) *
-                (1.0 - fusion_prior_corrected) *
-                (1.0 - cooccurrence_prior_corrected) *
-                (1.0 - coexpression_both_prior_corrected) *
-                (1.0 - experiments_both_prior_corrected) *
-                (1.0 - database_both_prior_corrected)
-                #(1.0 - textmining_both_prior_corrected) *
+# score channels of protein.links.full files, "_transferred" versions are
+#   combined with the direct score where present
+STRING_CHANNELS = ('neighborhood', 'fusion', 'cooccurence', 'homology', 'coexpression',
+                   'experiments', 'database', 'textmining')
+NO_TEXTMINING = ('neighborhood', 'fusion', 'cooccurence', 'coexpression',
+                 'experiments', 'database')
+STRING_PRIOR = 0.041
+
+
+def combine_channel_scores(table:pd.DataFrame, channels:Collection[str]=NO_TEXTMINING,
+                           prior=STRING_PRIOR) -> np.ndarray:
+    """STRING combined scores (0-1000) from a subset of score channels, as
+    STRING calculate them: the prior is removed from each channel, direct and
+    transferred scores are combined, channels are combined as independent
+    probabilities and the prior is added back once.
+
+    Args:
+        table: columns of a protein.links.full file, at least the channels,
+            and the "_transferred" version of channels where they exist.
+        channels: channel names, as columns in the table.
+        prior: the STRING prior.
+
+    Returns:
+        int32 array of scores, truncated as STRING.
+    """
+    def prior_away(scores):
+        scores = np.asarray(scores, dtype=np.float64) / 1000
+        return (np.maximum(scores, prior) - prior) / (1 - prior)
+
+    one_minus = None
+    for channel in channels:
+        if channel not in table.columns:
+            raise KeyError(f"Channel '{channel}' not in columns: {list(table.columns)}")
+        corrected = prior_away(table[channel])
+        transferred = channel + '_transferred'
+        if transferred in table.columns:
+            corrected = 1.0 - (1.0 - corrected) * (1.0 - prior_away(table[transferred]))
+        one_minus = (1.0 - corrected) if one_minus is None else one_minus * (1.0 - corrected)
+    if one_minus is None:
+        raise ValueError("No channels given.")
+
+    combined = 1.0 - one_minus
+    combined *= (1.0 - prior)
+    combined += prior
+    return (combined * 1000).astype(np.int32)
+
+
+def _read_full_scores(fullscores_fn, chunksize:int) -> typing.Iterator[pd.DataFrame]:
+    """Chunks of a protein.links.full file (possibly gzipped), or a list of
+    lines including the header."""
+    if isinstance(fullscores_fn, list):
+        fullscores_fn = io.StringIO('\n'.join(line.strip() for line in fullscores_fn))
+    # channels are ints 0-1000, exact in float32 at half the memory of float64
+    header = pd.read_csv(fullscores_fn, sep=r'\s+', nrows=0).columns
+    if isinstance(fullscores_fn, io.IOBase):
+        fullscores_fn.seek(0)
+    dtypes = {c:(str if c in ('protein1', 'protein2') else np.float32) for c in header}
+    yield from pd.read_csv(fullscores_fn, sep=r'\s+', dtype=dtypes, chunksize=chunksize,
+                           on_bad_lines='skip')
+
+
+class EdgeTable:
+    """Protein pairs and combined scores, with proteins encoded as integers.
+
+    Stored as a directory of .npy files that are memory mapped on load, so
+    opening even the full human network is instant.
+
+    Attributes:
+        proteins: STRING IDs, the integer code is the position.
+        protein1, protein2: int32 codes of each edge.
+        score: uint16 combined scores, 0-1000.
+        meta: channels, min_score and prior used.
+    """
+    def __init__(self, proteins:np.ndarray, protein1:np.ndarray, protein2:np.ndarray,
+                 score:np.ndarray, meta:dict=None):
+        self.proteins = proteins
+        self.protein1 = protein1
+        self.protein2 = protein2
+        self.score = score
+        self.meta = meta or {}
+
+    def __len__(self):
+        return len(self.score)
+
+    def save(self, out_dir:Pathy):
+        os.makedirs(out_dir, exist_ok=True)
+        out_dir = Path(out_dir)
+        # replace rather than overwrite files, tables loaded with mmap
+        #   may be using them
+        for k in ('proteins', 'protein1', 'protein2', 'score'):
+            save_array(out_dir / f'{k}.npy', getattr(self, k))
+        with atomic_write(out_dir / 'meta.json') as f:
+            json.dump(self.meta, f)
+
+    @classmethod
+    def load(cls, edge_dir:Pathy, mmap=True) -> 'EdgeTable':
+        edge_dir = Path(edge_dir)
+        mode = 'r' if mmap else None
+        arrays = {k:np.load(edge_dir / f'{k}.npy', mmap_mode=mode)
+                  for k in ('proteins', 'protein1', 'protein2', 'score')}
+        with open(edge_dir / 'meta.json') as f:
+            meta = json.load(f)
+        return cls(**arrays, meta=meta)
+
+    def to_frame(self) -> pd.DataFrame:
+        return pd.DataFrame({
+            'protein1': self.proteins[self.protein1],
+            'protein2': self.proteins[self.protein2],
+            'score': self.score,
+        })
+
+
+def build_edge_table(fullscores_fn, out_dir:Pathy=None,
+                     channels:Collection[str]=NO_TEXTMINING,
+                     min_score=99, prior=STRING_PRIOR,
+                     chunksize=1_000_000) -> EdgeTable:
+    """Combined scores from selected channels of a STRING
+    protein.links.full file, keeping pairs with score > min_score.
+
+    The file is read in chunks, so memory use is set by the chunksize and
+    the size of the output.
+
+    Args:
+        fullscores_fn: path of a protein.links.full file, may be gzipped.
+        out_dir: if given, the EdgeTable is saved here, see `EdgeTable.load`.
+        channels: score channels to use, see STRING_CHANNELS.
+        min_score: scores must be greater than this.
+        prior: see `combine_channel_scores`.
+        chunksize: lines per chunk.
+    """
+    channels = list(channels)
+    codes = {}
+    p1s, p2s, scores = [], [], []
+    n_lines = 0
+    for chunk in _read_full_scores(fullscores_fn, chunksize):
+        n_lines += len(chunk)
+        chunk = chunk.dropna()
+        score = combine_channel_scores(chunk, channels, prior)
+        keep = score > min_score
+        # intern chunk's proteins into the global vocabulary
+        chunk_codes, uniques = pd.factorize(
+            np.concatenate([chunk.protein1.to_numpy()[keep], chunk.protein2.to_numpy()[keep]])
         )
+        lookup = np.fromiter((codes.setdefault(p, len(codes)) for p in uniques),
+                             dtype=np.int32, count=len(uniques))
+        chunk_codes = lookup[chunk_codes]
+        n = keep.sum()
+        p1s.append(chunk_codes[:n])
+        p2s.append(chunk_codes[n:])
+        scores.append(score[keep].astype(np.uint16))
+
+    def cat(arrays, dtype):
+        return np.concatenate(arrays).astype(dtype) if arrays else np.array([], dtype=dtype)
+
+    edges = EdgeTable(
+        proteins=np.array(list(codes), dtype=str),
+        protein1=cat(p1s, np.int32),
+        protein2=cat(p2s, np.int32),
+        score=cat(scores, np.uint16),
+        meta=dict(channels=channels, min_score=min_score, prior=prior),
+    )
+    logger.info(f"{len(edges)} of {n_lines} pairs have score > {min_score}, "
+                f"{len(edges.proteins)} proteins.")
+    if out_dir is not None:
+        edges.save(out_dir)
+    return edges
 
-        ## and lastly, do the 1 - conversion again, and put back the prior *exactly once*
-
-        combined_score = (1.0 - combined_score_one_minus)  ## 1- conversion
-        combined_score *= (1.0 - prior)  ## scale down
-        combined_score += prior  ## and add prior.
-
-        ## round
 
-        combined_score = int(combined_score * 1000)
-        if combined_score > min_score:
-            scores_no_txt[(protein1, protein2)] = combined_score
-    print(failures)
+def pair_score_no_textmining(fullscores_fn, out_picklefn, min_score=99):
+    """Pickle {(protein1, protein2): score} of combined scores without
+    textmining. See `build_edge_table`, which is more flexible and
+    gives a much more compact output."""
+    edges = build_edge_table(fullscores_fn, channels=NO_TEXTMINING, min_score=min_score)
+    scores_no_txt = dict(zip(
+        zip(edges.proteins[edges.protein1].tolist(), edges.proteins[edges.protein2].tolist()),
+        edges.score.tolist()
+    ))
     import pickle
     with open(out_picklefn, 'wb') as f:
         pickle.dump(scores_no_txt, f)
 
+def _read_aliases(aliases) -> pd.DataFrame:
+    """(string_protein_id, alias) table from a STRING protein.aliases file
+    or a DataFrame with those columns."""
+    if isinstance(aliases, pd.DataFrame):
+        return aliases[['string_protein_id', 'alias']].astype(str)
+    return pd.read_csv(aliases, sep='\t', usecols=[0, 1], names=['string_protein_id', 'alias'],
+                       header=0, dtype=str).dropna()
+
+
+class StringNetwork:
+    """Local, read only, STRING network for fast neighbour and subgraph
+    queries without network access.
+
+    The network is undirected, held as CSR adjacency over integer protein
+    codes with neighbours of each protein sorted by descending score, and
+    an index of identifiers (aliases and STRING IDs) sorted for binary
+    search. Everything is stored as .npy files and memory mapped on load,
+    so queries only touch the pages they need.
+
+    Build with `StringNetwork.build` from an EdgeTable (see
+    `build_edge_table`) and optionally a protein.aliases file, then open
+    with `StringNetwork.load`.
+
+    Attributes:
+        proteins: STRING IDs, the code of a protein is its position.
+        indptr, indices, scores: CSR adjacency, neighbours of protein i are
+            indices[indptr[i]:indptr[i+1]] with scores in the same positions.
+        alias_keys: sorted utf-8 identifiers.
+        alias_codes: protein code of each alias key.
+    """
+    _arrays = ('proteins', 'indptr', 'indices', 'scores', 'alias_keys', 'alias_codes')
+
+    def __init__(self, proteins:np.ndarray, indptr:np.ndarray, indices:np.ndarray,
+                 scores:np.ndarray, alias_keys:np.ndarray, alias_codes:np.ndarray,
+                 meta:dict=None):
+        self.proteins = proteins
+        self.indptr = indptr
+        self.indices = indices
+        self.scores = scores
+        self.alias_keys = alias_keys
+        self.alias_codes = alias_codes
+        self.meta = meta or {}
+
+    @property
+    def n_proteins(self) -> int:
+        return len(self.proteins)
+
+    @classmethod
+    def build(cls, edges:typing.Union[EdgeTable, Pathy], out_dir:Pathy=None,
+              aliases:typing.Union[pd.DataFrame, Pathy]=None) -> 'StringNetwork':
+        """Build the network from an edge table.
+
+        Args:
+            edges: EdgeTable or the directory it was saved to. Pairs may be
+                given in one or both directions, duplicates keep the highest
+                score.
+            out_dir: if given, the network is saved here.
+            aliases: STRING protein.aliases file, or DataFrame with columns
+                string_protein_id & alias. Proteins are always found by
+                their STRING ID and by the ID without the taxon prefix.
+                Where an alias belongs to several proteins the first in
+                the file is used.
+        """
+        if not isinstance(edges, EdgeTable):
+            edges = EdgeTable.load(edges, mmap=False)
+        proteins = np.asarray(edges.proteins)
+        if aliases is not None:
+            aliases = _read_aliases(aliases)
+            # proteins without edges can still be mapped
+            new = pd.unique(aliases.string_protein_id[~aliases.string_protein_id.isin(proteins)])
+            proteins = np.concatenate([proteins, np.asarray(new, dtype=proteins.dtype)])
+        n = len(proteins)
+
+        # both directions, sorted by source then descending score, duplicate
+        #   pairs keep the first, highest, score
+        p1 = np.asarray(edges.protein1, dtype=np.int64)
+        p2 = np.asarray(edges.protein2, dtype=np.int64)
+        sc = np.asarray(edges.score)
+        src = np.concatenate([p1, p2])
+        dst = np.concatenate([p2, p1])
+        sc = np.concatenate([sc, sc])
+        order = np.lexsort((dst, -sc.astype(np.int32), src))
+        src, dst, sc = src[order], dst[order], sc[order]
+        pair = src * n + dst
+        _, first = np.unique(pair, return_index=True)
+        first.sort()
+        src, dst, sc = src[first], dst[first], sc[first]
+
+        indptr = np.zeros(n + 1, dtype=np.int64)
+        np.cumsum(np.bincount(src, minlength=n), out=indptr[1:])
+
+        # identifier index
+        ids = pd.Series(proteins)
+        keys = [ids, ids.str.split('.', n=1).str[-1]]
+        codes = [np.arange(n), np.arange(n)]
+        if aliases is not None:
+            lookup = pd.Index(proteins)
+            keys.append(aliases.alias)
+            codes.append(lookup.get_indexer(aliases.string_protein_id))
+        keys = pd.concat(keys, ignore_index=True)
+        codes = np.concatenate(codes)
+        # STRING IDs take precedence over aliases, otherwise file order
+        dup = keys.duplicated(keep='first').to_numpy()
+        keys, codes = keys.to_numpy()[~dup], codes[~dup]
+        alias_keys = np.char.encode(keys.astype(str), 'utf-8')
+        key_order = np.argsort(alias_keys, kind='stable')
+
+        network = cls(
+            proteins=proteins,
+            indptr=indptr,
+            indices=dst.astype(np.int32),
+            scores=sc.astype(np.uint16),
+            alias_keys=alias_keys[key_order],
+            alias_codes=codes[key_order].astype(np.int32),
+            meta=dict(edges=edges.meta, n_edges=int(len(dst) // 2)),
+        )
+        if out_dir is not None:
+            network.save(out_dir)
+        return network
+
+    def save(self, out_dir:Pathy):
+        os.makedirs(out_dir, exist_ok=True)
+        out_dir = Path(out_dir)
+        # replace rather than overwrite, see EdgeTable.save
+        for k in self._arrays:
+            save_array(out_dir / f'{k}.npy', getattr(self, k))
+        with atomic_write(out_dir / 'meta.json') as f:
+            json.dump(self.meta, f)
+
+    @classmethod
+    def load(cls, network_dir:Pathy, mmap=True) -> 'StringNetwork':
+        network_dir = Path(network_dir)
+        mode = 'r' if mmap else None
+        arrays = {k:np.load(network_dir / f'{k}.npy', mmap_mode=mode) for k in cls._arrays}
+        with open(network_dir / 'meta.json') as f:
+            meta = json.load(f)
+        return cls(**arrays, meta=meta)
+
+    def protein_codes(self, identifiers:Collection[str]) -> np.ndarray:
+        """Code of each identifier, -1 where not found."""
+        query = np.char.encode(np.asarray(list(identifiers), dtype=str), 'utf-8')
+        keys = self.alias_keys
+        if not len(query) or not len(keys):
+            return np.full(len(query), -1, dtype=np.int32)
+        # queries longer than the keys can't match, and would be truncated
+        query = np.where(np.char.str_len(query) <= keys.dtype.itemsize, query, b'')
+        pos = np.searchsorted(keys, query.astype(keys.dtype)).clip(max=len(keys) - 1)
+        found = (keys[pos] == query) & (query != b'')
+        return np.where(found, self.alias_codes[pos], -1).astype(np.int32)
+
+    def map_ids(self, identifiers:Collection[str]) -> pd.Series:
+        """STRING ID of each identifier, indexed by identifier, NaN where
+        not found."""
+        identifiers = list(identifiers)
+        codes = self.protein_codes(identifiers)
+        ids = pd.Series(np.asarray(self.proteins)[codes.clip(min=0)], index=identifiers,
+                        dtype=object, name='string_protein_id')
+        ids[codes < 0] = np.nan
+        return ids
+
+    def _codes_or_raise(self, identifiers):
+        codes = self.protein_codes(identifiers)
+        if (codes < 0).any():
+            missing = list(np.asarray(identifiers, dtype=object)[codes < 0])
+            raise KeyError(f"Identifiers not found in network: {missing[:10]}"
+                           f"{' ...' if len(missing) > 10 else ''}")
+        return codes
+
+    def _edges_of(self, codes:np.ndarray, min_score:int):
+        """Positions in indices/scores of edges from codes with score >=
+        min_score, and the source code of each."""
+        starts = np.asarray(self.indptr[codes])
+        lengths = np.asarray(self.indptr[codes + 1]) - starts
+        pos = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+        src = np.repeat(codes, lengths)
+        keep = np.asarray(self.scores[pos]) >= min_score
+        return pos[keep], src[keep]
+
+    def _edge_frame(self, src, dst, scores) -> pd.DataFrame:
+        proteins = np.asarray(self.proteins)
+        return pd.DataFrame({
+            'protein1': proteins[src],
+            'protein2': proteins[dst],
+            'score': scores,
+        })
+
+    def neighbours(self, identifiers:typing.Union[str, Collection[str]],
+                   min_score=400) -> pd.DataFrame:
+        """Edges from proteins to all neighbours with score >= min_score,
+        highest scores first for each protein.
+
+        Args:
+            identifiers: one or more STRING IDs or aliases.
+            min_score: 0-1000, STRING use 400 for medium confidence.
+
+        Returns:
+            Table with columns protein1 (the queried protein), protein2 &
+            score. Unknown identifiers raise a KeyError.
+        """
+        if isinstance(identifiers, str):
+            identifiers = [identifiers]
+        codes = self._codes_or_raise(identifiers)
+        pos, src = self._edges_of(codes, min_score)
+        return self._edge_frame(src, self.indices[pos], self.scores[pos])
+
+    def subgraph(self, identifiers:Collection[str], min_score=400) -> pd.DataFrame:
+        """Edges between proteins in identifiers with score >= min_score,
+        each edge once. Unknown identifiers are ignored.
+
+        Returns:
+            Table with columns protein1, protein2 & score.
+        """
+        codes = np.unique(self.protein_codes(identifiers))
+        codes = codes[codes >= 0]
+        members = np.zeros(self.n_proteins, dtype=bool)
+        members[codes] = True
+        pos, src = self._edges_of(codes, min_score)
+        dst = np.asarray(self.indices[pos])
+        keep = members[dst] & (src < dst)
+        return self._edge_frame(src[keep], dst[keep], self.scores[pos[keep]])
+
+
 def _test():
     tabl = '''protein1 protein2 neighborhood neighborhood_transferred fusion cooccurence homology coexpression coexpression_transferred experiments experiments_transferred database database_transferred textmining textmining_transferred combined_score
     9606.ENSP00000000233 9606.ENSP00000356607 0 0 0 0 0 0 45 0 134 0 0 0 81 173
     9606.ENSP00000000233 9606.ENSP00000427567 0 0 0 0 0 0 0 0 128 0 0 0 70 154'''.split('\n')
 
-    pair_score_no_textmining('/mnt/m/tmp/string.txt', '/mnt/m/tmp/fff.pickle')
+    edges = build_edge_table(tabl, min_score=0)
+    print(edges.to_frame())
 
 
 
@@ -195,4 +713,8 @@ testset = """9606.ENSP00000265986
 
 if __name__ == '__main__':
     if sys.argv[1] == 'scorenotext':
-        pair_score_no_textmining(sys.argv[2], sys.argv[3])
\ No newline at end of file
+        pair_score_no_textmining(sys.argv[2], sys.argv[3])
+    elif sys.argv[1] == 'network':
+        # stringdb.py network protein.links.full.txt.gz out_dir [protein.aliases.txt.gz]
+        StringNetwork.build(build_edge_table(sys.argv[2]), sys.argv[3],
+                            aliases=sys.argv[4] if len(sys.argv) > 4 else None)
\ No newline at end of file
@@ -1,4 +1,5 @@
 import logging
+import os
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
@@ -51,4 +52,932 @@ def test_validate_screen_input():
             else:
                 raise e
 
-    logger.setLevel(logging.WARNING)
\ No newline at end of file
+    logger.setLevel(logging.WARNING)
+
+def test_results_store_roundtrip(tmp_path):
+    import numpy as np
+    from bioscreen.classes.comparison import Comparison, CompDict
+    from bioscreen.classes.differential_gene_expression import LimmaResults, LIMMACOLS
+
+    comparisons = CompDict([Comparison(control='C', test=t) for t in ('T1', 'T2')])
+    rng = np.random.default_rng(1)
+    tables = {
+        k:pd.DataFrame(rng.random((10, 3)), columns=['LFC', 'p', 'FDR'],
+                       index=[f"g{i}" for i in range(10)])
+        for k in comparisons.keys()
+    }
+    res = LimmaResults(table=pd.concat(tables, axis='columns'), comparisons=comparisons,
+                       columns=LIMMACOLS, scorekey='LFC')
+    res.save(tmp_path / 'store')
+
+    loaded = LimmaResults.load(tmp_path / 'store')
+    pd.testing.assert_frame_equal(loaded.result_table('T2-C'), res.result_table('T2-C'))
+    pd.testing.assert_frame_equal(loaded.score_table, res.score_table)
+    assert loaded._lazy
+    assert loaded.comparisons['T1-C'] == comparisons['T1-C']
+    assert loaded.columns.to_records() == res.columns.to_records()
+    pd.testing.assert_frame_equal(loaded.table, res.table)
+
+
+def test_add_log10_sig_cols_all():
+    import numpy as np
+    from bioscreen.classes.results import add_log10_sig_cols_all, MIN_SIG_VALUE
+
+    tables = {
+        c:pd.DataFrame({'LFC':[1., -1., 0.], 'p':[0.01, 0., np.nan], 'FDR':[0.1, 1., 0.]})
+        for c in ('A-C', 'B-C')
+    }
+    table = add_log10_sig_cols_all(pd.concat(tables, axis='columns'))
+
+    assert list(table['A-C'].columns) == ['LFC', 'p', 'FDR', 'p10', 'FDR10']
+    p10 = table[('B-C', 'p10')]
+    assert np.isclose(p10[0], 2)
+    assert np.isclose(p10[1], -np.log10(MIN_SIG_VALUE))
+    assert np.isnan(p10[2])
+    assert np.isclose(table[('A-C', 'FDR10')][1], 0)
+
+
+def _pylimma_test_data():
+    import numpy as np
+    from bioscreen.classes.comparison import Comparison, CompDict
+
+    rng = np.random.default_rng(2)
+    groups = ['C']*3 + ['T1']*3 + ['T2']*4
+    samples = [f"s{i}" for i in range(len(groups))]
+    y = rng.normal(5, 1, (500, len(groups)))
+    y[:50, 3:6] += 2
+    y[3, 1] = np.nan
+    counts = pd.DataFrame(y, columns=samples, index=[f"g{i}" for i in range(len(y))])
+    details = pd.DataFrame({'SampleGroup':groups}, index=samples)
+    comparisons = CompDict([Comparison(control='C', test=t) for t in ('T1', 'T2')])
+    return counts, details, comparisons, groups
+
+
+def test_pylimma_lm_fit():
+    import numpy as np
+    from bioscreen.pylimma import lm_fit, design_matrix, contrast_matrix
+
+    counts, _, _, groups = _pylimma_test_data()
+    y = counts.to_numpy()
+    design, levels = design_matrix(groups)
+    fit = lm_fit(y, design)
+
+    for i in (0, 3):
+        obs = ~np.isnan(y[i])
+        coef, rss = np.linalg.lstsq(design[obs], y[i, obs], rcond=None)[:2]
+        assert np.allclose(fit['coefficients'][i], coef)
+        df = obs.sum() - design.shape[1]
+        assert fit['df_residual'][i] == df
+        assert np.isclose(fit['sigma'][i], np.sqrt(rss[0] / df))
+
+    cm = contrast_matrix(['T1 - C', '(T2 - C) - (T1 - C)'], levels)
+    assert np.array_equal(cm, [[-1, 0], [1, -1], [0, 1]])
+
+    import pytest
+    from bioscreen.pylimma import PyLimma
+    counts, details, comparisons, _ = _pylimma_test_data()
+    for unsupported in (dict(block=groups), dict(voom_counts=True)):
+        with pytest.raises(ValueError):
+            PyLimma(counts=counts, sample_details=details, comparisons=comparisons,
+                    test_groups=groups, **unsupported)
+
+
+PYLIMMA_REFERENCE = os.path.join(os.path.dirname(__file__), 'tests_data', 'pylimma')
+
+def test_pylimma_matches_limma():
+    """Compare with stored limma topTable output, see
+    tests_data/pylimma/make_reference.R. Data has no missing values, as
+    newer limma estimates the prior differently when residual df vary."""
+    import numpy as np
+    from bioscreen.classes.comparison import Comparison, CompDict
+    from bioscreen.pylimma import PyLimma
+
+    ref_fns = {t: os.path.join(PYLIMMA_REFERENCE, f"{t}-C.csv") for t in ('T1', 'T2')}
+    missing = [fn for fn in ref_fns.values() if not os.path.exists(fn)]
+    assert not missing, f"limma reference output {missing} missing, run tests_data/pylimma/make_reference.R"
+
+    counts = pd.read_csv(os.path.join(PYLIMMA_REFERENCE, 'counts.csv'), index_col=0)
+    details = pd.read_csv(os.path.join(PYLIMMA_REFERENCE, 'sample_details.csv'), index_col=0)
+    comparisons = CompDict([Comparison(control='C', test=t) for t in ref_fns])
+    result = PyLimma(counts=counts, sample_details=details, comparisons=comparisons,
+                     test_groups=details.SampleGroup).run()
+
+    ref_cols = {'LFC': 'logFC', 'Expr': 'AveExpr', 't': 't', 'p': 'P.Value',
+                'FDR': 'adj.P.Val', 'LogOdds': 'B'}
+    for test, fn in ref_fns.items():
+        comp = Comparison(control='C', test=test)
+        expected = pd.read_csv(fn, index_col=0).loc[counts.index]
+        res = result.table[str(comp)]
+        for k, rk in ref_cols.items():
+            assert np.allclose(res[k], expected[rk], rtol=1e-6, atol=1e-8), (comp, k)
+
+
+def test_rmatrix_roundtrip():
+    import numpy as np
+    import pytest
+    pytest.importorskip('rpy2')
+    from bioscreen.rinterfaces.utils import df_to_rmatrix, rmatrix_to_pd
+
+    df = pd.DataFrame(np.arange(12, dtype=float).reshape(4, 3),
+                      index=list('abcd'), columns=list('xyz'))
+    df.iloc[1, 2] = np.nan
+    pd.testing.assert_frame_equal(rmatrix_to_pd(df_to_rmatrix(df)), df)
+
+
+# seconds, cumulative cold import time of bioscreen.experiment_classes
+IMPORT_TIME_BUDGET = float(os.environ.get('BIOSCREEN_IMPORT_BUDGET', 2.0))
+
+def test_import_time():
+    """Heavy dependencies shouldn't be imported with the classes, and import
+    should fit in IMPORT_TIME_BUDGET."""
+    import subprocess
+    import sys
+
+    heavy = {'sklearn', 'statsmodels', 'matplotlib', 'seaborn', 'gseapy',
+             'xlsxwriter', 'rpy2', 'requests'}
+    proc = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import bioscreen.experiment_classes'],
+        capture_output=True, text=True, check=True,
+    )
+    cumulative = {}
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cum, module = line.split('|')
+        cumulative[module.strip()] = int(cum) / 1e6
+
+    imported_heavy = {m for m in cumulative if m.split('.')[0] in heavy}
+    assert not imported_heavy, f"Heavy modules imported: {sorted(imported_heavy)}"
+    assert cumulative['bioscreen.experiment_classes'] < IMPORT_TIME_BUDGET
+
+
+def test_geneset_index():
+    import numpy as np
+    from bioscreen.classes.geneset_cls import GeneSetCollections
+
+    gsc = GeneSetCollections({
+        'H': {'H_A': {'g1', 'g2', 'g3'}, 'H_B': {'g3'}},
+        'C2': {'C2_A': {'g2', 'g4'}},
+    })
+    index = gsc.index
+    assert gsc.index is index
+    assert list(index.set_sizes) == [3, 1, 2]
+    assert list(index.overlap_counts(['g2', 'g3', 'g3', 'x'])) == [2, 1, 1]
+    assert list(index.is_member(['H_A', 'H_B', 'C2_A'], ['g1', 'g1', 'g4'])) == [True, False, True]
+    assert set(index.sets_of_gene('g3')) == {'H_A', 'H_B'}
+    assert list(index.set_collections(['C2_A', 'H_B'])) == ['C2', 'H']
+    assert np.array_equal(index.membership(['g3', 'g4']), [[1, 0], [1, 0], [0, 1]])
+
+    gsc['New'] = {'N_A': {'g5'}}
+    assert gsc.index is not index
+    assert gsc.genes_by_setname('N_A') == {'g5'}
+
+
+def test_tsl_dir_cache(tmp_path, monkeypatch):
+    from bioscreen.classes.geneset_cls import GeneSetCollections
+
+    monkeypatch.setenv('BIOSCREEN_CACHE_DIR', str(tmp_path / 'cache'))
+
+    gsdir = tmp_path / 'genesets'
+    gsdir.mkdir()
+    (gsdir / 'H.tsl').write_text("H_A\tg1\tg2\tg2\nH_B\tg3\n")
+    (gsdir / 'C2.tsl').write_text("C2_A\tg1\tg4\tg5\n")
+    expected = {'H': {'H_A': {'g1', 'g2'}, 'H_B': {'g3'}}, 'C2': {'C2_A': {'g1', 'g4', 'g5'}}}
+
+    assert GeneSetCollections.from_tsl_dir(gsdir, n_workers=1) == expected
+    # nothing written next to the gene set directory
+    assert sorted(os.listdir(tmp_path)) == ['cache', 'genesets']
+    assert list((tmp_path / 'cache' / 'genesets').glob('genesets-*/manifest.json'))
+    # from the cache
+    assert GeneSetCollections.from_tsl_dir(gsdir, lazy=True) == expected
+
+    (gsdir / 'H.tsl').write_text("H_A\tg1\n")
+    loaded = GeneSetCollections.from_tsl_dir(gsdir, collections=['H'], n_workers=1)
+    assert loaded == {'H': {'H_A': {'g1'}}}
+
+    loaded = GeneSetCollections.from_tsl_dir(gsdir, min_size=2, max_size=2)
+    assert loaded == {'H': {}, 'C2': {}}
+
+    # rebuilding the cache leaves memory-mapped arrays of earlier loads intact
+    big = {f"S{i}": {f"g{j}" for j in range(i * 500, i * 500 + 2000)} for i in range(20)}
+    (gsdir / 'H.tsl').write_text(''.join('\t'.join([k, *sorted(v)]) + '\n' for k, v in big.items()))
+    GeneSetCollections.from_tsl_dir(gsdir, collections=['H'], n_workers=1)
+    old = GeneSetCollections.from_tsl_dir(gsdir, collections=['H'], lazy=True)['H']
+    (gsdir / 'H.tsl').write_text("H_A\tg1\n")
+    assert GeneSetCollections.from_tsl_dir(gsdir, collections=['H'], n_workers=1) == {'H': {'H_A': {'g1'}}}
+    assert old['S19'] == big['S19']
+
+
+def test_to_tidy_df(tmp_path):
+    from bioscreen.classes.geneset_cls import GeneSetCollections
+
+    gsc = GeneSetCollections({
+        'H': {'HALLMARK_A_B': ['g1', 'g2'], 'HALLMARK_C': ['g3']},
+        'C2': {'KEGG_C': ['g1']},
+    })
+    tidy = gsc.to_tidy_df()
+    assert list(tidy.geneID) == ['g1', 'g2', 'g3', 'g1']
+    assert list(tidy.termID) == ['HALLMARK_A_B', 'HALLMARK_A_B', 'HALLMARK_C', 'KEGG_C']
+    assert list(tidy.termName) == ['a b', 'a b', 'c', 'c']
+    assert list(tidy.description) == ['']*4
+    assert list(tidy.dbName) == ['H', 'H', 'H', 'C2']
+
+    gsc.write_tidy(tmp_path / 'tidy.tsv', chunk_rows=2)
+    written = pd.read_csv(tmp_path / 'tidy.tsv', sep='\t', keep_default_na=False)
+    pd.testing.assert_frame_equal(written, tidy.astype(object))
+
+
+def test_ora():
+    import numpy as np
+    from scipy.stats import hypergeom
+    from bioscreen.classes.comparison import Comparison, CompDict
+    from bioscreen.classes.differential_gene_expression import LimmaResults
+    from bioscreen.classes.geneset_cls import GeneSetCollections
+    from bioscreen.ora import ora_from_results, hypergeom_sf
+
+    k, N, K, n = np.meshgrid(np.arange(0, 30), [200, 1000], [10, 50], [20, 60])
+    assert np.allclose(hypergeom_sf(k, N, K, n), hypergeom.sf(k - 1, N, K, n), rtol=1e-8, atol=1e-300)
+
+    genes = [f"g{i}" for i in range(100)]
+    gsc = GeneSetCollections({
+        'H': {'H_UP': set(genes[:10]), 'H_OTHER': set(genes[50:70])},
+        'C2': {'C2_DOWN': set(genes[90:]) | {'notmeasured'}},
+    })
+    comparisons = CompDict([Comparison(control='C', test='T')])
+    lfc = np.zeros(100)
+    lfc[:10], lfc[90:] = 2, -2
+    table = pd.DataFrame({'LFC': lfc, 'p': 0.5, 'FDR': np.where(lfc != 0, 0.01, 0.5)}, index=genes)
+    results = LimmaResults.build({'T-C': table}, comparisons)
+
+    enrichment = ora_from_results(results, gsc)
+    up = enrichment['up'].table['T-C']
+    assert up.loc['H_UP', 'Overlap'] == 10
+    assert np.isclose(up.loc['H_UP', 'p'], hypergeom.sf(9, 100, 10, 10))
+    assert up.loc['H_OTHER', 'p'] == 1
+    down = enrichment['down'].table
+    assert down.loc['C2_DOWN', ('T-C', 'Size')] == 10
+    assert down.loc['C2_DOWN', 'Collection'].item() == 'C2'
+
+    # by default the universe is genes in sets, other list genes are dropped
+    from bioscreen.ora import ora
+    sets = GeneSetCollections({'H': {'S1': set(genes[:10]), 'S2': set(genes[10:40])}})
+    extra = [f"x{i}" for i in range(50)]
+    res = ora({'with': genes[:8] + extra, 'without': genes[:8]}, sets)
+    assert (res.loc[:, (slice(None), 'ListSize')].values == 8).all()
+    assert np.isclose(res.loc['S1', ('with', 'p')], hypergeom.sf(7, 40, 10, 8))
+    pd.testing.assert_series_equal(res['with'].loc[:, 'p'], res['without'].loc[:, 'p'], check_names=False)
+
+
+def test_gsea_prerank():
+    import numpy as np
+    from bioscreen.classes.geneset_cls import GeneSetCollections
+    from bioscreen.geneset_enrichment import gsea_prerank, GSEACOLS, _count_beyond
+
+    rng = np.random.default_rng(1)
+    genes = np.array([f"g{i}" for i in range(500)])
+    scores = pd.Series(rng.normal(size=500), index=genes)
+    ranked = scores.sort_values(ascending=False).index
+    gsc = GeneSetCollections({
+        'H': {'TOP': set(ranked[:40:2]), 'RANDOM': set(rng.choice(genes, 30, replace=False))},
+        'C2': {'BOTTOM': set(ranked[-60::3]) | {'notmeasured'}, 'SMALL': set(genes[:5])},
+    })
+    res = gsea_prerank(scores, gsc, permutation_num=200)
+    assert list(res.columns) == GSEACOLS
+    res = res.set_index('Term')
+    assert 'SMALL' not in res.index
+
+    # ES against the full running sum
+    ranking = scores.loc[ranked]
+    for term in res.index:
+        hit = ranking.index.isin(gsc['H'].get(term, gsc['C2'].get(term)))
+        w = np.where(hit, ranking.abs(), 0)
+        running = np.cumsum(w / w.sum() - (~hit) / (~hit).sum())
+        es = running.max() if running.max() > -running.min() else running.min()
+        assert np.isclose(res.loc[term, 'ES'], es)
+        assert res.loc[term, 'Size'] == hit.sum()
+
+    assert res.loc['TOP', 'NES'] > 0 and res.loc['TOP', 'FDR'] < 0.05
+    assert res.loc['BOTTOM', 'NES'] < 0 and res.loc['BOTTOM', 'LeadingLen'] == 20
+
+    # ties with the null count as beyond, for either sign
+    null = np.array([-2., -1., -1., 0., 1., 1.])
+    assert list(_count_beyond(null, np.array([-1., 1.]), np.array([False, True]))) == [3, 2]
+
+
+def test_gsea_from_results():
+    import numpy as np
+    from bioscreen.classes.comparison import Comparison, CompDict
+    from bioscreen.classes.differential_gene_expression import LimmaResults
+    from bioscreen.classes.geneset_cls import GeneSetCollections
+    from bioscreen.geneset_enrichment import gsea_from_results, signed_p10_scores
+
+    rng = np.random.default_rng(2)
+    genes = [f"g{i}" for i in range(300)]
+    comparisons = CompDict([Comparison(control='C', test='A'), Comparison(control='C', test='B')])
+    tables = {}
+    for comp, sign in zip(comparisons, (1, -1)):
+        lfc = rng.normal(size=300)
+        lfc[:20] = sign * 3
+        p = np.where(np.arange(300) < 20, 1e-6, rng.random(300))
+        tables[comp] = pd.DataFrame({'LFC': lfc, 'p': p, 'FDR': p}, index=genes)
+    results = LimmaResults.build(tables, comparisons)
+
+    # two rows per symbol, the most significant is kept
+    symbols = pd.Series([f"S{i // 2}" for i in range(300)], index=genes)
+    scores = signed_p10_scores(results, symbols)
+    assert scores.shape == (150, 2)
+    assert scores.loc['S0', 'B-C'] == -6
+
+    gsc = GeneSetCollections({'H': {
+        'HITS': {f"S{i}" for i in range(16)},
+        'OTHER': {f"S{i}" for i in range(100, 130)},
+    }})
+    gres = gsea_from_results(results, gsc, symbol_map=symbols, n_workers=1,
+                             permutation_num=100)
+    assert list(gres.comparisons) == ['A-C', 'B-C']
+    assert gres.table.loc['HITS', ('A-C', 'NES')] > 0
+    assert gres.table.loc['HITS', ('B-C', 'NES')] < 0
+    assert gres.table.loc['HITS', 'Collection'].item() == 'H'
+    assert gres.fdr10_table.shape == (2, 2)
+
+
+def test_count_remapper_with_duplicates():
+    import numpy as np
+    from bioscreen.classes.comparison import Comparison, CompDict
+    from bioscreen.classes.geneset_cls import CountRemapperWithDuplicates
+
+    idx = ['p1', 'p2', 'p3', 'p4', 'p5']
+    sample_details = pd.DataFrame({'Sample': ['c1', 'c2', 't1', 't2'],
+                                   'SampleGroup': ['C', 'C', 'T', 'T']})
+    counts = pd.DataFrame(np.arange(20.).reshape(5, 4), index=idx, columns=sample_details.Sample)
+    comparisons = CompDict([Comparison(control='C', test='T')])
+    result_table = pd.concat({'T-C': pd.DataFrame({
+        'LFC': [1, -2, 0.5, 1, 1],
+        'p10': [2, 5, 3, np.nan, 1],
+    }, index=idx)}, axis=1)
+    # p5 has no symbol
+    symbols = pd.Series(['A', 'A', 'A', 'B', np.nan], index=idx[:4] + ['p5'])
+
+    remapper = CountRemapperWithDuplicates(counts, sample_details, symbols, result_table, comparisons)
+    tables = {d:t for d, _, t in remapper}
+    # up: p3 is most significant going up, down: p2
+    assert list(tables['up'].index) == ['A', 'B']
+    assert (tables['up'].loc['A'] == counts.loc['p3']).all()
+    assert (tables['down'].loc['A'] == counts.loc['p2']).all()
+    assert (tables['down'].loc['B'] == counts.loc['p4']).all()
+
+    # NaN significance ranks above everything, as the original
+    #   implementation, ties going to the last row
+    counts.loc['p6'] = 100.
+    counts.loc['p7'] = 200.
+    result_table.loc['p6'] = [1, np.nan]
+    result_table.loc['p7'] = [-1, np.nan]
+    symbols['p6'] = symbols['p7'] = 'A'
+    symbols['p5'] = 'B'
+    remapper = CountRemapperWithDuplicates(counts, sample_details, symbols, result_table, comparisons)
+    for direction in ('up', 'down'):
+        table = remapper.remap_count_index_keeping_better_duplicates(direction, 'T-C')
+        assert (table.loc['A'] == 200.).all()
+        assert (table.loc['B'] == counts.loc['p4']).all()
+
+    # lazy views only build tables when asked
+    views = {d: t for d, _, t in remapper.iter(lazy=True)}
+    assert views['up'].shape == (2, 4)
+    assert list(views['up'].rows) == [6, 3]
+    pd.testing.assert_frame_equal(views['up'].to_frame(),
+                                  remapper.remap_count_index_keeping_better_duplicates('up', 'T-C'))
+
+
+_TEST_OBO = """format-version: 1.2
+
+[Term]
+id: GO:0000001
+name: root
+namespace: biological_process
+
+[Term]
+id: GO:0000002
+name: middle
+namespace: biological_process
+alt_id: GO:0000099
+is_a: GO:0000001 ! root
+
+[Term]
+id: GO:0000003
+name: other middle
+namespace: biological_process
+is_a: GO:0000001 ! root
+
+[Term]
+id: GO:0000004
+name: leaf
+namespace: biological_process
+is_a: GO:0000003 ! other middle
+is_a: GO:0000002 ! middle
+relationship: part_of GO:0000001 ! root
+
+[Typedef]
+id: part_of
+name: part of
+is_a: GO:0000004
+"""
+
+
+def test_go_dag(tmp_path, monkeypatch):
+    import numpy as np
+    from bioscreen.go_dag import GODag
+    from bioscreen.gene_ontology import parse_go_hierarchy, term_hierarchy
+
+    obo = tmp_path / 'test.obo'
+    obo.write_text(_TEST_OBO)
+    assert parse_go_hierarchy(obo)['GO:0000004'] == ['GO:0000003', 'GO:0000002']
+
+    monkeypatch.setenv('BIOSCREEN_CACHE_DIR', str(tmp_path / 'cache'))
+    dag = GODag.load(obo)
+    # cache isn't written next to the OBO
+    assert sorted(os.listdir(tmp_path)) == ['cache', 'test.obo']
+    dag = GODag.load(obo)
+    assert isinstance(dag.parent_indptr, np.memmap)
+    assert isinstance(dag.ancestor_indptr, np.memmap)
+
+    # from a parent map, ancestors are computed when first needed
+    from_map = GODag.from_parent_map(dag.to_parent_map())
+    assert 'ancestor_indptr' not in from_map._arrays
+    assert set(from_map.ancestors('GO:0000004')) == {'GO:0000001', 'GO:0000002', 'GO:0000003'}
+
+    assert list(dag.parents('GO:0000004')) == ['GO:0000003', 'GO:0000002']
+    assert set(dag.ancestors('GO:0000004')) == {'GO:0000001', 'GO:0000002', 'GO:0000003'}
+    assert set(dag.descendants('GO:0000001')) == {'GO:0000002', 'GO:0000003', 'GO:0000004'}
+    assert list(dag.is_ancestor(['GO:0000001', 'GO:0000004', 'GO:0000099'],
+                                ['GO:0000004', 'GO:0000001', 'GO:0000004'])) == [True, False, True]
+    assert dag.names(['GO:0000099']) == ['middle']
+
+    structure = term_hierarchy(pd.Series(['GO:0000004', 'GO:0000002', 'GO:0000001']), dag)
+    assert structure == [{'GO:0000004': [{'GO:0000002': [{'GO:0000001': []}]}]}]
+
+    # a changed OBO rebuilds the cache without altering DAGs mapped from it
+    obo.write_text(_TEST_OBO.replace('GO:0000004', 'GO:0000000') + '\n')
+    rebuilt = GODag.load(obo)
+    assert GODag.load(obo).ids[0] == 'GO:0000000'
+    assert list(dag.ids) == ['GO:0000001', 'GO:0000002', 'GO:0000003', 'GO:0000004']
+    assert set(dag.ancestors('GO:0000004')) == {'GO:0000001', 'GO:0000002', 'GO:0000003'}
+    assert set(rebuilt.ancestors('GO:0000000')) == {'GO:0000001', 'GO:0000002', 'GO:0000003'}
+
+
+def test_transcribe_structure(tmp_path):
+    from bioscreen.gene_ontology import term_hierarchy, transcribe_structure, load_go_dag
+
+    obo = tmp_path / 'test.obo'
+    obo.write_text(_TEST_OBO)
+    terms = ['GO:0000004', 'GO:0000003', 'GO:0000002', 'GO:0000001']
+    results = pd.DataFrame({'GO_ID': terms, 'GO_label': ['leaf', 'mid3', 'mid2', 'root'],
+                            'fdr': [0.01, 0.02, 0.03, 0.04]}, index=terms)
+
+    # root is reached through both middle terms
+    structure = term_hierarchy(results.GO_ID, load_go_dag(obo))
+    table, strings = transcribe_structure(structure, results, 'GO_label')
+    assert list(table.GO_ID) == ['GO:0000004', 'GO:0000003', 'GO:0000001', 'GO:0000002', 'GO:0000001']
+    assert list(table.Level) == [0, 1, 2, 1, 2]
+    assert strings == ['GO label hierarchy', 'leaf', ' + mid3', ' + + root', ' + mid2']
+
+
+def test_local_panther_backend(tmp_path):
+    from bioscreen.gene_ontology import (LocalPantherBackend, PantherCache,
+                                         query_panther_batch, query_panther_and_parse_results)
+
+    obo = tmp_path / 'test.obo'
+    obo.write_text(_TEST_OBO)
+    genes = [f"G{i}" for i in range(40)]
+    annot = pd.DataFrame({
+        'Gene': genes[:10] + genes[:4] + genes,
+        'GO_ID': ['GO:0000004'] * 10 + ['GO:0000002'] * 4 + ['GO:0000001'] * 40,
+    })
+    annot.loc[:, 'GO_label'] = annot.GO_ID.map({'GO:0000004': 'leaf', 'GO:0000002': 'middle',
+                                                 'GO:0000001': 'root'})
+    backend = LocalPantherBackend(annot)
+    cache = PantherCache(tmp_path / 'cache')
+
+    lists = {'a': genes[:8], 'b': genes[20:30]}
+    res = query_panther_batch(lists, backend=backend, cache=cache, n_workers=2)
+    assert list(res) == ['a', 'b']
+    assert cache.misses == 2
+    groups = {g['term']['id']: g for g in res['a']['overrepresentation']['group']}
+    assert groups['GO:0000004']['number_in_list'] == 8
+    assert groups['GO:0000004']['fdr'] < 0.01
+    assert groups['GO:0000001']['pValue'] == 1
+
+    # threads writing the same key don't collide
+    same = {f'same{i}': genes[30:36] for i in range(64)}
+    res_same = query_panther_batch(same, backend=backend, cache=PantherCache(tmp_path / 'cache2'),
+                                   n_workers=8)
+    assert len({str(r) for r in res_same.values()}) == 1
+    assert [fn.suffix for fn in (tmp_path / 'cache2').iterdir()] == ['.json']
+
+    # list order doesn't matter for the cache
+    parsed = query_panther_and_parse_results(genes[:8][::-1], hierarchy_fn=obo,
+                                             backend=backend, cache=cache)
+    assert cache.hits == 1
+    assert list(parsed['full_table'].index) == ['GO:0000004', 'GO:0000002', 'GO:0000001']
+    assert 'leaf' in parsed['string']
+
+
+def test_string_edge_table(tmp_path):
+    import io
+    import numpy as np
+    from bioscreen.stringdb import build_edge_table, EdgeTable
+
+    lines = '''protein1 protein2 neighborhood neighborhood_transferred fusion cooccurence homology coexpression coexpression_transferred experiments experiments_transferred database database_transferred textmining textmining_transferred combined_score
+    9606.A 9606.B 0 0 0 0 0 0 45 0 134 0 0 0 81 173
+    9606.A 9606.C 0 0 0 0 0 0 0 0 128 0 0 0 70 154
+    9606.B 9606.A 0 0 0 0 0 0 45 0 134 0 0 0 81 173
+    9606.C 9606.A 0 0 0 0 0 0 0 0 128 900 0 0 70 154'''.split('\n')
+
+    def reference(row, prior=0.041):
+        away = lambda s: (max(s / 1000, prior) - prior) / (1 - prior)
+        one_minus = 1.
+        for c in ('neighborhood', 'fusion', 'cooccurence', 'coexpression', 'experiments', 'database'):
+            p = away(row[c])
+            if c + '_transferred' in row:
+                p = 1 - (1 - p) * (1 - away(row[c + '_transferred']))
+            one_minus *= 1 - p
+        return int(((1 - one_minus) * (1 - prior) + prior) * 1000)
+
+    table = pd.read_csv(io.StringIO('\n'.join(l.strip() for l in lines)), sep=' ')
+    expected = [reference(row) for _, row in table.iterrows()]
+
+    edges = build_edge_table(lines, tmp_path / 'edges', min_score=0, chunksize=2)
+    assert list(edges.score) == expected
+    assert list(edges.proteins) == ['9606.A', '9606.B', '9606.C']
+    loaded = EdgeTable.load(tmp_path / 'edges')
+    assert isinstance(loaded.score, np.memmap) and loaded.score.dtype == np.uint16
+    frame = loaded.to_frame()
+    assert list(frame.protein2) == ['9606.B', '9606.C', '9606.A', '9606.A']
+
+    edges = build_edge_table(lines, min_score=150, channels=['database'])
+    assert list(edges.proteins[edges.protein1]) == ['9606.C']
+
+    # saving over a loaded table leaves its mapped arrays intact
+    edges.save(tmp_path / 'edges')
+    assert len(EdgeTable.load(tmp_path / 'edges')) == 1
+    assert list(loaded.score) == expected
+
+
+def test_string_network(tmp_path):
+    import numpy as np
+    from bioscreen.stringdb import EdgeTable, StringNetwork
+
+    edges = EdgeTable(
+        proteins=np.array(['9606.A', '9606.B', '9606.C', '9606.D']),
+        protein1=np.array([0, 1, 0, 2, 1], dtype=np.int32),
+        protein2=np.array([1, 0, 2, 3, 3], dtype=np.int32),
+        score=np.array([900, 900, 500, 300, 150], dtype=np.uint16),
+    )
+    aliases = pd.DataFrame({'string_protein_id': ['9606.A', '9606.B', '9606.E', '9606.B'],
+                            'alias': ['GA', 'GB', 'GE', 'GA']})
+    StringNetwork.build(edges, tmp_path / 'net', aliases=aliases)
+    net = StringNetwork.load(tmp_path / 'net')
+    assert isinstance(net.indices, np.memmap)
+
+    ids = net.map_ids(['GA', 'GB', 'C', '9606.D', 'GE', 'nope'])
+    assert list(ids.iloc[:5]) == ['9606.A', '9606.B', '9606.C', '9606.D', '9606.E']
+    assert pd.isna(ids['nope'])
+
+    nb = net.neighbours('9606.A', min_score=0)
+    assert list(nb.protein2) == ['9606.B', '9606.C']
+    assert list(net.neighbours(['GB'], min_score=200).protein2) == ['9606.A']
+    assert len(net.neighbours('GE', min_score=0)) == 0
+
+    sg = net.subgraph(['GA', 'GB', 'D', 'GE', 'nope'], min_score=100)
+    assert sorted(map(tuple, sg.values.tolist())) == [('9606.A', '9606.B', 900),
+                                                     ('9606.B', '9606.D', 150)]
+
+
+def test_resolve_string_ids(tmp_path):
+    import json
+    import threading
+    import urllib.parse
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from bioscreen.stringdb import resolve_string_ids, StringAPI, LocalStringIds, StringIdCache
+
+    aliases = pd.DataFrame({'string_protein_id': ['9606.A', '9606.B', '9606.C'],
+                            'alias': ['GA', 'GB', 'GC']})
+    requested = []
+
+    class StandIn(BaseHTTPRequestHandler):
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers['Content-Length'])).decode()
+            query = urllib.parse.parse_qs(body)['identifiers'][0].split('\r')
+            requested.append(query)
+            rows = LocalStringIds(aliases).get_string_ids(query)
+            self.send_response(200)
+            self.end_headers()
+            self.wfile.write(json.dumps(rows).encode())
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer(('127.0.0.1', 0), StandIn)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        api = StringAPI(base_url=f'http://127.0.0.1:{server.server_port}/')
+        cache = StringIdCache(tmp_path)
+        query = ['GA', 'nope', 'GC', 'GA', '9606.B']
+        ids = resolve_string_ids(query, backend=api, cache=cache, chunk_size=2)
+        assert list(ids.stringId.fillna('')) == ['9606.A', '', '9606.C', '9606.B']
+        assert ids.attrs['unresolved'] == ['nope']
+        assert sorted(map(len, requested)) == [2, 2]
+
+        # second time everything comes from the cache, unresolved included
+        ids = resolve_string_ids(query, backend=api, cache=StringIdCache(tmp_path))
+        assert len(requested) == 2
+        assert list(ids.queryItem) == ['GA', 'nope', 'GC', '9606.B']
+    finally:
+        server.shutdown()
+
+    offline = resolve_string_ids(['GB', 'GX'], backend=LocalStringIds(aliases))
+    assert list(offline.stringId.fillna('')) == ['9606.B', '']
+
+    # concurrent writes of the same table don't collide
+    from concurrent.futures import ThreadPoolExecutor
+    shared = tmp_path / 'shared'
+    def put(i):
+        StringIdCache(shared).put({f'G{i}': None}, '9606', 'local')
+    with ThreadPoolExecutor(8) as pool:
+        list(pool.map(put, range(64)))
+    assert not list(shared.glob('*.tmp'))
+    found, missing = StringIdCache(shared).get([f'G{i}' for i in range(64)], '9606', 'local')
+    assert len(found) == 64 and not missing
+
+
+def test_count_pca_anova():
+    import numpy as np
+    from scipy import stats
+    from bioscreen.PCA import CountPCA
+
+    rng = np.random.default_rng(0)
+    samples = [f"s{i}" for i in range(30)]
+    table = pd.DataFrame(rng.normal(size=(100, 30)), columns=samples)
+    details = pd.DataFrame({
+        'batch': rng.integers(0, 3, 30).astype(str),
+        'const': 'a',
+        'missing': np.where(np.arange(30) < 5, np.nan, np.arange(30) % 2),
+    }, index=samples[::-1])
+    pca = CountPCA(table, details, n_components=5, random_state=0)
+
+    res = pca.anova()
+    assert list(res.index) == ['batch', 'missing']
+    for factor in res.index:
+        for pc in ['PC1', 'PC5']:
+            groups = [pca.scores.loc[idx, pc] for idx in pca.sample_details.groupby(factor).groups.values()]
+            expected = stats.f_oneway(*groups)
+            assert np.isclose(res.loc[factor, ('F', pc)], expected.statistic)
+            assert np.isclose(res.loc[factor, ('p', pc)], expected.pvalue)
+
+    # max_pc is zero indexed
+    assert list(pca.anova(max_pc=1)['F'].columns) == ['PC1', 'PC2']
+
+
+def test_count_pca_methods():
+    import numpy as np
+    from bioscreen.PCA import CountPCA
+
+    rng = np.random.default_rng(0)
+    latent = rng.normal(size=(300, 3)) @ rng.normal(size=(3, 60)) * 3
+    table = pd.DataFrame(latent + rng.normal(size=(300, 60)),
+                         columns=[f"s{i}" for i in range(60)])
+    # genes with no variance, never selected
+    table.iloc[:100] = 1.
+
+    full = CountPCA(table, method='full')
+    for kw in [dict(method='randomized', random_state=0),
+               dict(method='incremental', batch_size=16),
+               dict(method='randomized', dtype=np.float32, random_state=0),
+               dict(method='full', top_genes=200)]:
+        pca = CountPCA(table, n_components=3, **kw)
+        assert pca.scores.shape == (60, 3)
+        assert pca.loadings.shape == (3, len(pca.genes))
+        for pc in ['PC1', 'PC2', 'PC3']:
+            r = np.corrcoef(pca.scores[pc], full.scores[pc])[0, 1]
+            assert abs(r) > 0.999
+    assert pca.genes.equals(table.index[100:])
+    assert CountPCA(table, n_components=3, dtype=np.float32).scores.dtypes.iloc[0] == np.float32
+
+
+def test_count_pca_transform(tmp_path):
+    import numpy as np
+    from bioscreen.PCA import CountPCA
+
+    rng = np.random.default_rng(0)
+    genes = [f"g{i}" for i in range(200)]
+    samples = [f"s{i}" for i in range(40)]
+    table = pd.DataFrame(rng.normal(size=(200, 40)), index=genes, columns=samples)
+    details = pd.DataFrame({'batch': ['a', 'b'] * 20}, index=samples)
+    pca = CountPCA(table, details, n_components=4, random_state=0)
+
+    # shuffled rows, extra genes & batches give the fitted scores
+    shuffled = pd.concat([table.sample(frac=1, random_state=0),
+                          pd.DataFrame(1., index=['extra'], columns=samples)])
+    scores = pca.transform(shuffled, batch_size=7)
+    assert np.allclose(scores, pca.scores)
+    assert np.allclose(scores, pca.pca.transform(table.T.to_numpy()))
+
+    pca.save(tmp_path / 'pca.npz')
+    loaded = CountPCA.load(tmp_path / 'pca.npz')
+    assert np.allclose(loaded.transform(table), pca.scores)
+    assert loaded.scores.equals(pca.scores)
+    assert loaded.sample_details.equals(pca.sample_details)
+    assert list(loaded.anova()['F'].columns) == ['PC1', 'PC2', 'PC3', 'PC4']
+
+
+def test_comp_results_from_dir_parallel(tmp_path):
+    import numpy as np
+    from bioscreen.classes.comparison import Comparison
+    from bioscreen.classes.differential_gene_expression import LIMMACOLS
+    from bioscreen.classes.results import comp_results_from_dir, comp_results_from_dir_parallel
+
+    rng = np.random.default_rng(3)
+    genes = [f"g{i}" for i in range(20)]
+    for k, test in enumerate(['T1', 'T2', 'T3', 'T4']):
+        # different row orders, and rows missing from some files
+        rows = list(rng.permutation(genes)[:20 - k])
+        tbl = pd.DataFrame(rng.random((len(rows), 3)), columns=['logFC', 'P.Value', 'adj.P.Val'],
+                           index=rows)
+        tbl.to_csv(tmp_path / f"{test}.csv")
+    tbl.loc['extra'] = 0.5
+    tbl.to_csv(tmp_path / 'T4.csv')
+
+    fn_to_comp = lambda fn: Comparison(control='C', test=fn.split('.')[0])
+    serial, _ = comp_results_from_dir(tmp_path, fn_to_comp, columns=LIMMACOLS)
+    for _ in range(3):
+        table, comps = comp_results_from_dir_parallel(tmp_path, fn_to_comp, LIMMACOLS, n_workers=4)
+        first = pd.read_csv(tmp_path / 'T1.csv', index_col=0).index
+        assert list(table.index) == list(first) + ['extra']
+        pd.testing.assert_frame_equal(
+            table.sort_index(axis=0).sort_index(axis=1),
+            serial.sort_index(axis=0).sort_index(axis=1),
+            check_names=False,
+        )
+
+    # stat columns missing from the first file are kept for the others
+    pd.read_csv(tmp_path / 'T1.csv', index_col=0).drop(columns='adj.P.Val').to_csv(tmp_path / 'T1.csv')
+    table, _ = comp_results_from_dir_parallel(tmp_path, fn_to_comp, LIMMACOLS)
+    assert table['T1-C']['FDR'].isna().all()
+    assert not table['T2-C']['FDR'].isna().all()
+
+    import pytest
+    from bioscreen.utils import ValidationError
+    with pytest.raises(ValidationError, match='same comparison'):
+        comp_results_from_dir_parallel(tmp_path, lambda fn: Comparison(control='C', test='T'),
+                                       LIMMACOLS)
+    (tmp_path / 'empty').mkdir()
+    with pytest.raises(FileNotFoundError):
+        comp_results_from_dir_parallel(tmp_path / 'empty', fn_to_comp, LIMMACOLS)
+
+
+def test_limma_cache(tmp_path):
+    import types
+    import numpy as np
+    from bioscreen.classes.comparison import Comparison, CompDict
+    from bioscreen.classes.differential_gene_expression import LimmaResults
+    from bioscreen.rinterfaces.cache import LimmaCache
+
+    samples = [f"s{i}" for i in range(6)]
+    details = pd.DataFrame({'SampleGroup': ['C', 'C', 'T1', 'T1', 'T2', 'T2']}, index=samples)
+    fitted = []
+
+    def stub_limma(seed, tests):
+        """Stands in for Limma, the runner records which contrasts it fits."""
+        rng = np.random.default_rng(seed)
+        limma = types.SimpleNamespace(
+            counts=pd.DataFrame(rng.normal(size=(20, 6)), columns=samples),
+            sample_details=details, test_groups=list(details.SampleGroup), block=None,
+            voom_counts=False,
+            comparisons=CompDict([Comparison(control='C', test=t) for t in tests]),
+        )
+
+        def runner():
+            fitted.append(list(limma.comparisons.keys()))
+            tables = {k: pd.DataFrame({'logFC': rng.normal(size=20), 'P.Value': rng.random(20),
+                                       'adj.P.Val': rng.random(20)}, index=limma.counts.index)
+                      for k in limma.comparisons.keys()}
+            return LimmaResults.build(tables, limma.comparisons)
+        return limma, runner
+
+    cache = LimmaCache(tmp_path / 'cache')
+    limma, runner = stub_limma(0, ['T1'])
+    first = cache.run(limma, 'run', runner)
+    assert cache.counters == dict(hits=0, partial_hits=0, misses=1)
+
+    # adding a comparison only fits the new contrast
+    limma, runner = stub_limma(0, ['T1', 'T2'])
+    both = cache.run(limma, 'run', runner)
+    assert fitted == [['T1-C'], ['T2-C']]
+    assert cache.counters == dict(hits=0, partial_hits=1, misses=1)
+    assert list(both.comparisons.keys()) == ['T1-C', 'T2-C']
+    pd.testing.assert_frame_equal(both.table['T1-C'], first.table['T1-C'])
+
+    again = cache.run(limma, 'run', runner)
+    assert len(fitted) == 2 and cache.hits == 1
+    pd.testing.assert_frame_equal(again.table, both.table)
+    # a different method is a different entry
+    cache.run(limma, 'run_rnaseq', runner)
+    assert cache.misses == 2
+
+    # least recently used entries go when over max_bytes
+    index = cache._read_index()
+    entry_bytes = max(v['nbytes'] for v in index.values())
+    cache.clear()
+    cache.max_bytes = int(entry_bytes * 2.5)
+    keys = []
+    for seed in (1, 2, 3):
+        limma, runner = stub_limma(seed, ['T1', 'T2'])
+        keys.append(cache.input_key(limma, 'run'))
+        cache.run(limma, 'run', runner)
+        if seed == 2:
+            # use the first entry again, so the second is least recent
+            cache.run(stub_limma(1, ['T1', 'T2'])[0], 'run', runner)
+    assert set(cache._read_index()) == {keys[0], keys[2]}
+    assert not (tmp_path / 'cache' / keys[1]).exists()
+
+
+def test_write_streaming_workbook(tmp_path):
+    import numpy as np
+    from bioscreen.classes.comparison import Comparison, CompDict
+    from bioscreen.classes.differential_gene_expression import LimmaResults, LIMMACOLS
+
+    comparisons = CompDict([Comparison(control='C', test=t) for t in ('T1', 'T2', 'T3')])
+    genes = ['a', 'b', 'c', 'd', 'e', 'f']
+    tables = {
+        k: pd.DataFrame({'LFC': [1., -3., 2., np.nan, np.nan, 0.5],
+                         'p': [0.5, 0.01, 0.01, np.nan, np.nan, 0.2],
+                         'FDR': [0.6, 0.05, 0.05, 0.9, np.nan, np.nan]}, index=genes)
+        for k in comparisons.keys()
+    }
+    res = LimmaResults(table=pd.concat(tables, axis='columns'), comparisons=comparisons,
+                       columns=LIMMACOLS, scorekey='LFC')
+
+    fn = tmp_path / 'res.xlsx'
+    written = res.write_comp_results_to_excel(fn, streaming=True, comparisons_per_workbook=2)
+    assert written == [tmp_path / 'res.1.xlsx', tmp_path / 'res.2.xlsx']
+    sheets = [pd.read_excel(f, sheet_name=None, index_col=0) for f in written]
+    assert [list(s) for s in sheets] == [[c.arrow_str() for c in list(comparisons.values())[:2]],
+                                         [list(comparisons.values())[2].arrow_str()]]
+
+    sheet = sheets[1][list(comparisons.values())[2].arrow_str()]
+    # sorted by p then descending score, all NaN row "e" dropped,
+    #   missing p & FDR are 1, other missing values 0
+    assert list(sheet.index) == ['c', 'b', 'f', 'a', 'd']
+    assert list(sheet.columns) == ['LFC', 'p', 'FDR']
+    assert sheet.loc['d'].tolist() == [0, 1, 0.9]
+    assert sheet.loc['f'].tolist() == [0.5, 0.2, 1]
+
+    # written in parallel, same result
+    par = res.write_comp_results_to_excel(tmp_path / 'par.xlsx', streaming=True,
+                                          comparisons_per_workbook=2, n_processes=2)
+    for f, expected in zip(par, sheets):
+        for name, sheet in pd.read_excel(f, sheet_name=None, index_col=0).items():
+            pd.testing.assert_frame_equal(sheet, expected[name])
+
+
+def _stub_limma_analysis(job):
+    """Stands in for Limma in run_limma_jobs workers, fails for job 'bad'."""
+    import time
+    from bioscreen.classes.differential_gene_expression import LimmaResults
+    if job.name == 'bad':
+        raise ValueError("deliberate failure")
+    time.sleep(0.05)
+    tables = {k: pd.DataFrame({'logFC': job.counts.mean(axis=1), 'P.Value': 0.5, 'adj.P.Val': 0.5})
+              for k in job.comparisons.keys()}
+    return LimmaResults.build(tables, job.comparisons)
+
+
+def test_run_limma_jobs():
+    import numpy as np
+    import pytest
+    from bioscreen.classes.comparison import Comparison, CompDict
+    from bioscreen.rinterfaces.batch import LimmaJob, run_limma_jobs
+
+    samples = ['s1', 's2', 's3', 's4']
+    details = pd.DataFrame({'SampleGroup': ['C', 'C', 'T', 'T']}, index=samples)
+    comparisons = CompDict([Comparison(control='C', test='T')])
+
+    def job(name, offset):
+        counts = pd.DataFrame(np.full((5, 4), float(offset)), columns=samples,
+                              index=[f"g{i}" for i in range(5)])
+        return LimmaJob(name, counts, details, comparisons, details.SampleGroup)
+
+    jobs = [job('a', 1), job('bad', 2), job('c', 3)]
+    res = run_limma_jobs(jobs, n_workers=2, analysis=_stub_limma_analysis)
+
+    # other jobs unaffected by the failure, results in order of jobs
+    assert list(res) == ['a', 'bad', 'c']
+    assert res['a'].ok and res['c'].ok
+    assert (res['c'].results.table['T-C']['LFC'] == 3).all()
+    assert not res['bad'].ok and res['bad'].results is None
+    assert 'deliberate failure' in res['bad'].error
+    # every job timed, failed ones included
+    assert all(np.isfinite(r.seconds) and r.seconds >= 0 for r in res.values())
+    assert res['a'].seconds >= 0.05
+
+    with pytest.raises(ValueError):
+        run_limma_jobs([job('a', 1), job('a', 2)], analysis=_stub_limma_analysis)
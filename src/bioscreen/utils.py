@@ -1,6 +1,11 @@
+import contextlib
+import hashlib
 import logging
 import os
+import pathlib
+import tempfile
 
+import numpy as np
 import pandas as pd
 from jttools.data_wrangling import AttrMapAC, is_numeric
 import typing
@@ -19,6 +24,47 @@ class ValidationError(Exception):
     pass
 
 
+def user_cache_dir(*parts:str) -> pathlib.Path:
+    """bioscreen's cache directory, $BIOSCREEN_CACHE_DIR if set, otherwise
+    $XDG_CACHE_HOME/bioscreen (~/.cache/bioscreen), joined with parts."""
+    base = os.environ.get('BIOSCREEN_CACHE_DIR')
+    if not base:
+        xdg = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+        base = os.path.join(xdg, 'bioscreen')
+    return pathlib.Path(base).joinpath(*parts)
+
+
+def path_cache_dir(kind:str, source:Pathy) -> pathlib.Path:
+    """Cache directory for a source file or directory, in the user cache
+    dir, unique to the absolute path of source."""
+    source = pathlib.Path(source).resolve()
+    h = hashlib.blake2b(str(source).encode(), digest_size=8).hexdigest()
+    return user_cache_dir(kind, f"{source.name}-{h}")
+
+
+@contextlib.contextmanager
+def atomic_write(fn:Pathy, mode='w'):
+    """Open a temp file next to fn for writing, and rename it to fn on
+    success. Readers, including ones that have fn memory-mapped, keep the
+    old file rather than seeing it change under them."""
+    fn = pathlib.Path(fn)
+    f = tempfile.NamedTemporaryFile(mode, dir=fn.parent, prefix=f".{fn.name}.",
+                                    suffix='.tmp', delete=False)
+    try:
+        with f:
+            yield f
+        os.replace(f.name, fn)
+    except BaseException:
+        os.unlink(f.name)
+        raise
+
+
+def save_array(fn:Pathy, array:np.ndarray):
+    """np.save to fn via `atomic_write`."""
+    with atomic_write(fn, 'wb') as f:
+        np.save(f, array)
+
+
 def validate_cols(columns:pd.Index, required_cols, tablename='Some', ):
 
     if not all([(k in columns) for k in required_cols]):
@@ -38,3 +84,30 @@ def validate_sample_details(deets:pd.DataFrame):
 def validate_comparisons_table(comps:pd.DataFrame):
     validate_cols(comps.columns, ['Test', 'Control', ])
 
+
+def bh_fdr(p:np.ndarray, axis=0) -> np.ndarray:
+    """Benjamini-Hochberg adjusted p-values along axis, of a 1 or 2D array.
+
+    NaN are ignored, as with R's p.adjust, so each column (for axis=0)
+    is adjusted using the number of non-NaN values in that column."""
+    p = np.asarray(p, dtype=np.float64)
+    if p.ndim == 1:
+        return bh_fdr(p[:, None])[:, 0]
+    if axis == 1:
+        return bh_fdr(p.T).T
+
+    nans = np.isnan(p)
+    n = (~nans).sum(axis=0)
+    # NaN sorted to the end
+    order = np.argsort(np.where(nans, np.inf, p), axis=0, kind='stable')
+    p_sorted = np.take_along_axis(p, order, axis=0)
+    rank = np.arange(1, p.shape[0] + 1)[:, None]
+    q = p_sorted * n / rank
+    q[np.isnan(q)] = np.inf
+    q = np.minimum.accumulate(q[::-1], axis=0)[::-1]
+    q = np.minimum(q, 1)
+
+    adjusted = np.empty_like(p)
+    np.put_along_axis(adjusted, order, q, axis=0)
+    adjusted[nans] = np.nan
+    return adjusted